@@ -0,0 +1,225 @@
+# admission.py
+
+import os
+import time
+import random
+import sqlite3
+import inspect
+import functools
+import threading
+import contextvars
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Dict, Any, Callable, Optional, Tuple
+from metrics import span
+from resilience import ProviderError, check_cancelled
+
+# provider tokens-per-minute budgets (0 for no limit) - requests reserve their estimated tokens from a token bucket per provider
+# and model before calling the api, and wait for the bucket to refill rather than being sent only to fail with a 429
+OPENAI_TOKENS_PER_MINUTE = int(os.getenv('OPENAI_TOKENS_PER_MINUTE', 30000))
+ANTHROPIC_TOKENS_PER_MINUTE = int(os.getenv('ANTHROPIC_TOKENS_PER_MINUTE', 40000))
+TOKENS_PER_MINUTE = {'openai': OPENAI_TOKENS_PER_MINUTE, 'anthropic': ANTHROPIC_TOKENS_PER_MINUTE}
+# how long a request may queue for tokens before it is turned away (429 with a Retry-After)
+ADMISSION_MAX_WAIT_SECONDS = float(os.getenv('ADMISSION_MAX_WAIT_SECONDS', 20))
+# background work (a provider batch's up-front transcriptions) has no client waiting on it, so may queue for longer
+BATCH_ADMISSION_MAX_WAIT_SECONDS = float(os.getenv('BATCH_ADMISSION_MAX_WAIT_SECONDS', 600))
+# 'memory' (this process only) or 'sqlite' (a file shared by every worker process on the host)
+ADMISSION_STORAGE = os.getenv('ADMISSION_STORAGE', 'memory')
+ADMISSION_SQLITE_PATH = os.getenv('ADMISSION_SQLITE_PATH', '/tmp/admission.sqlite3')
+# rough input sizes for estimating a request before it is sent - instructions and category prompt, and each page of a pdf/image
+ADMISSION_PROMPT_TOKENS = int(os.getenv('ADMISSION_PROMPT_TOKENS', 600))
+ADMISSION_TOKENS_PER_PAGE = int(os.getenv('ADMISSION_TOKENS_PER_PAGE', 1000))
+
+class AdmissionError(ProviderError):
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class BucketStore(ABC):
+    # token buckets keyed by provider and model - subclasses only need an atomic read-modify-write of one bucket's
+    # (tokens, updated_at), so a shared store (eg redis) can be added alongside these
+    @abstractmethod
+    def transact(self, key: str, update: Callable[[Optional[Tuple[float, float]]], Tuple[Tuple[float, float], Any]]) -> Any:
+        pass
+
+    def take(self, key: str, capacity: float, amount: float) -> Tuple[bool, float]:
+        # takes amount tokens if the bucket has enough (or is full, for requests bigger than the whole bucket), leaving it in
+        # debt if need be - returns (admitted, seconds until it would be)
+        rate = capacity / 60
+        def update(bucket):
+            tokens, now = self._refill(bucket, capacity, rate)
+            needed = min(amount, capacity)
+            if tokens >= needed:
+                return (tokens - amount, now), (True, 0.0)
+            return (tokens, now), (False, (needed - tokens) / rate)
+        return self.transact(key, update)
+
+    def give(self, key: str, capacity: float, amount: float):
+        # returns tokens that were reserved but not used (or takes more, if amount is negative)
+        rate = capacity / 60
+        def update(bucket):
+            tokens, now = self._refill(bucket, capacity, rate)
+            return (min(capacity, tokens + amount), now), None
+        self.transact(key, update)
+
+    def _refill(self, bucket: Optional[Tuple[float, float]], capacity: float, rate: float) -> Tuple[float, float]:
+        now = time.time()
+        if bucket is None:
+            return capacity, now
+        tokens, updated_at = bucket
+        return min(capacity, tokens + max(0.0, now - updated_at) * rate), now
+
+class MemoryBucketStore(BucketStore):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def transact(self, key, update):
+        with self._lock:
+            self._buckets[key], result = update(self._buckets.get(key))
+            return result
+
+class SQLiteBucketStore(BucketStore):
+    # buckets in a sqlite file, updated in an immediate (write-locked) transaction so every worker process sees the same budget
+    def __init__(self, path: str = ADMISSION_SQLITE_PATH):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)')
+
+    def transact(self, key, update):
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._conn.execute('SELECT tokens, updated_at FROM buckets WHERE key = ?', (key,)).fetchone()
+                (tokens, updated_at), result = update(tuple(row) if row else None)
+                self._conn.execute('INSERT OR REPLACE INTO buckets (key, tokens, updated_at) VALUES (?, ?, ?)', (key, tokens, updated_at))
+                self._conn.execute('COMMIT')
+                return result
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+
+def get_bucket_store(storage: str = ADMISSION_STORAGE) -> BucketStore:
+    if storage == 'sqlite':
+        return SQLiteBucketStore()
+    if storage == 'memory':
+        return MemoryBucketStore()
+    raise ValueError(f"Invalid admission storage: {storage} (must be 'memory' or 'sqlite')")
+
+class AdmissionController:
+    def __init__(self, store: BucketStore, tokens_per_minute: Dict[str, int] = TOKENS_PER_MINUTE, max_wait: float = ADMISSION_MAX_WAIT_SECONDS):
+        self.store = store
+        self.tokens_per_minute = tokens_per_minute
+        self.max_wait = max_wait
+
+    def acquire(self, provider: str, model: str, tokens: int, max_wait: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        # reserves tokens for one request, queueing for up to max_wait seconds (self.max_wait by default) - returns the reservation
+        # to release once the actual usage is known (None if the provider has no limit)
+        capacity = self.tokens_per_minute.get(provider) or 0
+        if capacity <= 0:
+            return None
+        key = f'{provider}:{model}'
+        with span('admission', provider=provider):
+            deadline = time.time() + (self.max_wait if max_wait is None else max_wait)
+            while True:
+                admitted, wait = self.store.take(key, capacity, tokens)
+                if admitted:
+                    return {"key": key, "capacity": capacity, "tokens": tokens}
+                remaining = deadline - time.time()
+                if wait > remaining:
+                    raise AdmissionError(f"{provider} is at its token rate limit, try again in {wait:.0f}s", wait)
+                # a little jitter so queued requests don't all retry at the same moment
+                time.sleep(min(remaining, wait * random.uniform(1.0, 1.2)))
+                # a cancelled call stops queueing rather than take tokens it no longer needs
+                check_cancelled()
+
+    def release(self, reservation: Optional[Dict[str, Any]], actual_tokens: Optional[int]):
+        # corrects the reservation to the tokens actually used, when the provider reported them (otherwise the estimate stands)
+        if reservation is None or actual_tokens is None:
+            return
+        self.store.give(reservation['key'], reservation['capacity'], reservation['tokens'] - actual_tokens)
+
+admission_controller = AdmissionController(get_bucket_store())
+
+def estimate_input_tokens(value: Optional[str]) -> int:
+    if not value:
+        return 0
+    if not os.path.isfile(value):
+        return len(value) // 4
+    extension = os.path.splitext(value)[1].lower()
+    if extension == '.pdf':
+        import fitz
+        with fitz.open(value) as document:
+            return len(document) * ADMISSION_TOKENS_PER_PAGE
+    if extension in ('.png', '.jpg', '.jpeg', '.gif', '.webp'):
+        return ADMISSION_TOKENS_PER_PAGE
+    return os.path.getsize(value) // 4
+
+def estimate_request_tokens(request: Dict[str, Any]) -> int:
+    # every category sends the instructions, submission and mark scheme, and may use up to max_completion_tokens (the providers
+    # count max_tokens against the limit too, until the response comes back)
+    categories = request['feedback_category'] if isinstance(request['feedback_category'], list) else [request['feedback_category']]
+    prompt_tokens = ADMISSION_PROMPT_TOKENS + estimate_input_tokens(request.get('submission')) + estimate_input_tokens(request.get('mark_scheme'))
+    return len(categories) * (prompt_tokens + int(request['max_completion_tokens']))
+
+# transcriptions made outside an admitted generate_feedback/stream_feedback (a provider batch's, which are all done up front)
+# reserve their own tokens - a context variable (like the request deadline in resilience.py), so it reaches the handlers'
+# transcription calls on any thread
+_transcription_max_wait = contextvars.ContextVar('transcription_max_wait', default=None)
+
+@contextmanager
+def admitted_transcriptions(max_wait: float = BATCH_ADMISSION_MAX_WAIT_SECONDS):
+    # transcriptions inside this block wait (for up to max_wait seconds) for their tokens under the provider's rate limit
+    token = _transcription_max_wait.set(max_wait)
+    try:
+        yield
+    finally:
+        _transcription_max_wait.reset(token)
+
+def admit_transcription(provider: str, model: str, file_path: str, max_completion_tokens: int):
+    # called by the handlers once a file's transcription isn't cached - inside admitted_transcriptions, reserves its pages in
+    # and up to max_completion_tokens out (the estimate stands, as transcription usage isn't reported back)
+    max_wait = _transcription_max_wait.get()
+    if max_wait is not None:
+        admission_controller.acquire(provider, model, estimate_input_tokens(file_path) + int(max_completion_tokens), max_wait)
+
+def count_usage_tokens(usage: Optional[Dict[str, Any]]) -> Optional[int]:
+    if not usage:
+        return None
+    return sum(count for token_type, count in usage.items() if isinstance(count, int) and token_type != 'total_tokens')
+
+def admitted(model: str):
+    # decorator for a handler's generate_feedback/stream_feedback - waits for the request's estimated tokens to be available
+    # under the provider's rate limit, then corrects the reservation to the usage the provider reports. a failed request keeps
+    # its reservation, as the provider may have counted it
+    def decorator(function: Callable) -> Callable:
+        signature = inspect.signature(function)
+        def get_request(self, args, kwargs) -> Dict[str, Any]:
+            request = signature.bind(self, *args, **kwargs)
+            request.apply_defaults()
+            return request.arguments
+
+        if inspect.isgeneratorfunction(function):
+            @functools.wraps(function)
+            def generator_wrapper(self, *args, **kwargs):
+                request = get_request(self, args, kwargs)
+                reservation = admission_controller.acquire(self.provider, model, estimate_request_tokens(request))
+                categories = request['feedback_category'] if isinstance(request['feedback_category'], list) else [request['feedback_category']]
+                usages = []
+                for event, data in function(self, *args, **kwargs):
+                    if event == 'category_done' and data.get('usage'):
+                        usages.append(count_usage_tokens(data['usage']))
+                    yield event, data
+                admission_controller.release(reservation, sum(usages) if len(usages) == len(categories) else None)
+            return generator_wrapper
+
+        @functools.wraps(function)
+        def wrapper(self, *args, **kwargs):
+            reservation = admission_controller.acquire(self.provider, model, estimate_request_tokens(get_request(self, args, kwargs)))
+            result = function(self, *args, **kwargs)
+            admission_controller.release(reservation, count_usage_tokens(result.get('usage')))
+            return result
+        return wrapper
+    return decorator
@@ -1,136 +1,285 @@
 # anthropic_handler.py
 
 import os
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Union, Iterator, Tuple, Optional
 import anthropic
 import base64
 import mimetypes
 import json
-import re
-import fitz 
-from PIL import Image
+from feedback_fanout import fan_out, fan_out_stream, merge_category_results, sum_usage, get_common_result, get_student_record, format_feedback_bullet
+from stream_parser import BulletStreamParser, parse_category_output
+from highlight_matching import get_highlight_index, get_correction_phrases
+from cache_store import transcription_cache, transcription_key, cached_feedback
+from utils import file_sha256
+from image_optimizer import optimize_images, render_optimized_pages
+from transcription import transcribe_pdf, get_submission_pages, add_submission_pages
+from transport import get_http_client, get_timeout, prewarm
+from metrics import timed, span, record_usage
+from admission import admitted, admitted_transcriptions, admit_transcription
+from batch_grading import BATCH_TRANSCRIPTION_MAX_WORKERS
+from resilience import provider_error
+
+ANTHROPIC_MODEL = "claude-3-5-sonnet-20240620"
+# the instructions, submission and mark scheme images are sent as a cached prompt prefix shared by every category call
+PROMPT_CACHING_HEADERS = {"anthropic-beta": "prompt-caching-2024-07-31"}
+MESSAGE_BATCHES_HEADERS = {"anthropic-beta": "message-batches-2024-09-24,prompt-caching-2024-07-31"}
+# with several categories, write the prefix to the cache with one tiny call first so the concurrent category calls all read it
+ANTHROPIC_PROMPT_CACHE_WARMUP = os.getenv('ANTHROPIC_PROMPT_CACHE_WARMUP', 'true').lower() == 'true'
 
 class AnthropicHandler:
+    provider = 'anthropic'
+
     def __init__(self):
         self.client = anthropic.Anthropic(
-            api_key=os.environ['ANTHROPIC_API_KEY']
+            api_key=os.environ['ANTHROPIC_API_KEY'],
+            http_client=get_http_client('anthropic'),
+            timeout=get_timeout(),
+            # retries are left to the shared transport (transport.py), so the sdk's own are off
+            max_retries=0
         )
+        prewarm('anthropic', self.client.base_url)
     
+    @timed('generate_feedback')
+    @cached_feedback('anthropic', ANTHROPIC_MODEL, ['_get_initial_messages', '_get_feedback_messages', '_format_category_output', 
+                                                     '_format_bullet', 'highlight_matching', 'stream_parser', 'feedback_fanout', 'transcription'])
+    @admitted(ANTHROPIC_MODEL)
     def generate_feedback(self, assignment_id: str, assignment_title: str, question_id: str, question_title: str, subject: str, 
-                          qualification: str, submission: str, mark_scheme: str, 
+                          qualification: str, feedback_category: Union[str, List[str]], submission: str, mark_scheme: str, 
                           max_completion_tokens: int, temperature: float) -> Dict[str, Any]:
+        feedback_categories = feedback_category if isinstance(feedback_category, list) else [feedback_category]
         try:
             print('submission=',submission)
+            submission_source = submission
             submission = self._get_submission(submission, max_completion_tokens, temperature)
             print('submission processed, new submission =', submission)
-            mark_scheme_payload = self._process_file(mark_scheme)
-            print('mark scheme payload obtained')
-            messages = self._get_initial_messages(assignment_title, question_title, subject, qualification, submission, mark_scheme_payload, max_completion_tokens)
+            mark_scheme_payloads = self._process_file(mark_scheme)
+            print('mark scheme payload obtained,', len(mark_scheme_payloads), 'pages')
+            messages = self._get_initial_messages(assignment_title, question_title, subject, qualification, submission, mark_scheme_payloads, max_completion_tokens)
             print('initial messages obtained')
-            # print('messages:', type(messages), len(messages), messages[-1])
-            
-            feedback = []
-            for category, input_message in self._get_feedback_messages(qualification, subject).items():
-                messages += [input_message]
-                # print('messages:', type(messages), len(messages), messages[-1])
-                output_message = self._get_run_output(messages, max_completion_tokens, temperature)
+            feedback_messages = self._get_feedback_messages(qualification, subject)
+            warmup_usage = self._warm_prompt_cache(messages, temperature) if len(feedback_categories) > 1 else None
+
+            # every category only depends on the shared (cached) initial messages, so they can all be queried at once
+            def run_category(category: str) -> Dict[str, Any]:
+                output_message = self._get_run_output(messages + [feedback_messages[category]], max_completion_tokens, temperature)
                 print('output_message:', type(output_message), output_message)
-                messages += [output_message]
-                print('output message type=',type(output_message),'category type=',type(category),'submission=',type(submission))
                 formatted_output = self._format_category_output(output_message, category, submission)
-                # print('formatted_output:', type(formatted_output), formatted_output)
-                feedback.extend(formatted_output)
+                # like the stream and batch paths, output cut off by max_tokens is incomplete (and so never cached)
+                status = "completed" if output_message['stop_reason'] == 'end_turn' else "incomplete"
+                return {"status": status, "feedback": formatted_output, "usage": output_message['usage']}
 
-            return {
-                "status": "completed", 
-                "submission": submission,
-                "feedback": feedback
-                }
+            feedback = merge_category_results(fan_out(run_category, feedback_categories), submission)
+            if warmup_usage:
+                feedback['usage'] = sum_usage([feedback['usage'], warmup_usage])
+            return get_common_result(add_submission_pages(feedback, submission_source), self.provider, ANTHROPIC_MODEL, feedback_categories)
 
         except anthropic.AnthropicError as e:
-            raise ValueError(f"Anthropic API error: {str(e)}")
+            raise provider_error(e, 'Anthropic')
         
+    @timed('stream_feedback')
+    @admitted(ANTHROPIC_MODEL)
+    def stream_feedback(self, assignment_id: str, assignment_title: str, question_id: str, question_title: str, subject: str, 
+                        qualification: str, feedback_category: Union[str, List[str]], submission: str, mark_scheme: str, 
+                        max_completion_tokens: int, temperature: float) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        # streaming counterpart of generate_feedback - yields (event, data) pairs, sending each bullet's highlights as soon as it is parsed
+        feedback_categories = feedback_category if isinstance(feedback_category, list) else [feedback_category]
+        try:
+            submission_source = submission
+            submission = self._get_submission(submission, max_completion_tokens, temperature)
+            yield 'submission', {"submission": submission, "pages": get_submission_pages(submission, submission_source)}
+            mark_scheme_payloads = self._process_file(mark_scheme)
+            messages = self._get_initial_messages(assignment_title, question_title, subject, qualification, submission, mark_scheme_payloads, max_completion_tokens)
+            if len(feedback_categories) > 1:
+                self._warm_prompt_cache(messages, temperature)
+        except anthropic.AnthropicError as e:
+            raise provider_error(e, 'Anthropic')
+        feedback_messages = self._get_feedback_messages(qualification, subject)
+
+        def stream_category(category: str, emit):
+            parser = BulletStreamParser()
+            with self.client.messages.stream(
+                model=ANTHROPIC_MODEL,
+                max_tokens=max_completion_tokens,
+                messages=messages + [feedback_messages[category]],
+                temperature=temperature,
+                extra_headers=PROMPT_CACHING_HEADERS
+                ) as stream:
+                for text in stream.text_stream:
+                    for bullet in parser.feed(text):
+                        emit('feedback', {"category": category, "feedback": self._format_bullet(bullet, category, submission)})
+                for bullet in parser.close():
+                    emit('feedback', {"category": category, "feedback": self._format_bullet(bullet, category, submission)})
+                message = stream.get_final_message()
+            usage = self._get_usage(message)
+            record_usage(self.provider, usage)
+            emit('category_done', {"category": category, "status": "completed" if message.stop_reason == 'end_turn' else "incomplete", "usage": usage})
+
+        yield from fan_out_stream(stream_category, feedback_categories)
+
+    def submit_batch(self, assignment_id: str, assignment_title: str, question_id: str, question_title: str, subject: str, 
+                     qualification: str, feedback_category: Union[str, List[str]], mark_scheme: str, submissions: Dict[str, str], 
+                     max_completion_tokens: int, temperature: float, **kwargs) -> Dict[str, Any]:
+        # submits every (student, category) request through the message batches api - the instructions and mark scheme are the
+        # same cached prefix for every student, so they are only written to the prompt cache once
+        feedback_categories = feedback_category if isinstance(feedback_category, list) else [feedback_category]
+        # a few submissions at a time, each transcription waiting for its tokens under the rate limit
+        with admitted_transcriptions():
+            submission_texts = fan_out(lambda student_id: self._get_submission(submissions[student_id], max_completion_tokens, temperature), 
+                                       list(submissions), max_workers=BATCH_TRANSCRIPTION_MAX_WORKERS)
+        mark_scheme_payloads = self._process_file(mark_scheme)
+        feedback_messages = self._get_feedback_messages(qualification, subject)
+
+        requests, custom_ids = [], {}
+        for i, (student_id, submission) in enumerate(submission_texts.items()):
+            if isinstance(submission, Exception):
+                raise ValueError(f"Could not transcribe submission for {student_id}: {str(submission)}")
+            messages = self._get_initial_messages(assignment_title, question_title, subject, qualification, submission, mark_scheme_payloads, max_completion_tokens)
+            for category in feedback_categories:
+                custom_id = f"{i}-{category}"
+                custom_ids[custom_id] = [student_id, category]
+                requests.append({
+                    "custom_id": custom_id,
+                    "params": {
+                        "model": ANTHROPIC_MODEL,
+                        "max_tokens": max_completion_tokens,
+                        "messages": messages + [feedback_messages[category]],
+                        "temperature": temperature,
+                    },
+                })
+        try:
+            # this sdk version predates the batches api, so it is called through the client's generic request methods
+            provider_batch = self.client.post("/v1/messages/batches", cast_to=object, body={"requests": requests}, options={"headers": MESSAGE_BATCHES_HEADERS})
+        except anthropic.AnthropicError as e:
+            raise provider_error(e, 'Anthropic')
+        print('anthropic batch created:', provider_batch['id'], len(requests), 'requests')
+        return {"provider_batch_id": provider_batch['id'], "submissions": submission_texts, "custom_ids": custom_ids}
+
+    def get_batch_results(self, batch: Dict[str, Any]) -> List[Dict[str, Any]]:
+        # returns one merged feedback record per student once the provider batch has ended, or None while it is still running
+        provider_batch = self.client.get(f"/v1/messages/batches/{batch['provider_batch_id']}", cast_to=object, options={"headers": MESSAGE_BATCHES_HEADERS})
+        if provider_batch['processing_status'] != 'ended':
+            return None
+
+        outputs = {}
+        lines = self.client.get(f"/v1/messages/batches/{batch['provider_batch_id']}/results", cast_to=str, options={"headers": MESSAGE_BATCHES_HEADERS})
+        for line in lines.splitlines():
+            if line.strip():
+                output = json.loads(line)
+                outputs[output['custom_id']] = output['result']
+        results = {student_id: {} for student_id in batch['submissions']}
+        for custom_id, (student_id, category) in batch['custom_ids'].items():
+            result = outputs.get(custom_id) or {"type": "missing"}
+            if result['type'] != 'succeeded':
+                results[student_id][category] = ValueError(f"request {custom_id} {result['type']}: {result.get('error')}")
+                continue
+            message = anthropic.types.Message.model_validate(result['message'])
+            output_message = {"role": "assistant", "content": message.content}
+            results[student_id][category] = {
+                "status": "completed" if message.stop_reason == 'end_turn' else "incomplete",
+                "feedback": self._format_category_output(output_message, category, batch['submissions'][student_id]),
+                "usage": self._get_usage(message),
+            }
+        return [get_student_record(student_id, category_results, batch['submissions'][student_id]) for student_id, category_results in results.items()]
+
+    @timed('transcription')
     def _get_submission(self, submission: str, max_completion_tokens: int, temperature: int):
         # if submission and submission.startswith('@'):
         #     file_path = submission[1:]
         if os.path.isfile(submission): # file_path
             print('submission = file')
+            cache_key = transcription_key('anthropic', ANTHROPIC_MODEL, file_sha256(submission))
+            cached_submission = transcription_cache.get(cache_key)
+            if cached_submission is not None:
+                print('submission transcription found in cache')
+                return cached_submission
+            admit_transcription(self.provider, ANTHROPIC_MODEL, submission, max_completion_tokens)
             try:
-                submission_payload = self._process_file(submission)
-                transcribe_message = [
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": (
-                                    "Please transcribe the following attachment to text, "
-                                    "preserving the exact layout and text of the attachment. "
-                                    "Include ONLY the transcription in your reply. "
-                                    "Here is the attachment:"
-                                ),
-                            },
-                            {
-                                "type": "image",
-                                "source": submission_payload,
-                            },
-                        ],
-                    },
-                ]
-                message = self.client.messages.create(
-                    model="claude-3-5-sonnet-20240620",
-                    messages=transcribe_message,
-                    max_tokens=max_completion_tokens,
-                    temperature=temperature
-                    )
-                return message.content[0].text
+                # pdfs are transcribed a page per call, all at once - and typed pages use their own text layer instead
+                messages = []
+                def transcribe_page(page_number: int) -> str:
+                    media_type, page_image = render_optimized_pages(submission, self.provider)[page_number]
+                    page_payload = {"type": "base64", "media_type": media_type, "data": base64.b64encode(page_image).decode('utf-8')}
+                    message = self._transcribe_images([page_payload], max_completion_tokens, temperature)
+                    messages.append(message)
+                    return message.content[0].text
+                transcription = transcribe_pdf(submission, transcribe_page, render_pages=lambda file_path: render_optimized_pages(file_path, self.provider))
+                if transcription is None:
+                    print('not a readable pdf, transcribing whole file')
+                    messages.append(self._transcribe_images(self._process_file(submission), max_completion_tokens, temperature))
+                    transcription = messages[-1].content[0].text
+                # don't cache transcriptions that were cut off by max_tokens
+                if all(message.stop_reason == 'end_turn' for message in messages):
+                    transcription_cache.set(cache_key, transcription)
+                return transcription
+            except (anthropic.AnthropicError, ValueError):
+                raise
             except Exception as e:
-                return f'Error processing file: {str(e)}'
+                # a failed transcription is an error, rather than text to grade (which would then be cached as a result)
+                raise ValueError(f'Error processing file: {str(e)}') from e
         # else:
         #     return 'File not found on the server'
         else:
             print('submission = text')
             return submission
+
+    def _transcribe_images(self, image_payloads: List[Dict[str, str]], max_completion_tokens: int, temperature: float):
+        transcribe_message = [
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": (
+                            "Please transcribe the following attachment to text, "
+                            "preserving the exact layout and text of the attachment. "
+                            "Include ONLY the transcription in your reply. "
+                            "Here is the attachment:"
+                        ),
+                    },
+                ] + [
+                    {
+                        "type": "image",
+                        "source": image_payload,
+                    }
+                    for image_payload in image_payloads
+                ],
+            },
+        ]
+        message = self.client.messages.create(
+            model=ANTHROPIC_MODEL,
+            messages=transcribe_message,
+            max_tokens=max_completion_tokens,
+            temperature=temperature
+            )
+        record_usage(self.provider, self._get_usage(message))
+        return message
         
-    def _process_file(self, mark_scheme):
+    @timed('process_file')
+    def _process_file(self, file_path: str) -> List[Dict[str, str]]:
+        # returns one base64 image source per page - pdfs are rendered in memory rather than written out as pngs next to the upload,
+        # and every image is optimised to fit the request's image token budget (see image_optimizer.py)
         image_extensions = ('.png', '.jpg', '.jpeg', '.gif', '.webp')
-        _, file_extension = os.path.splitext(mark_scheme)
+        _, file_extension = os.path.splitext(file_path)
         file_extension = file_extension.lower()
+        if not os.path.exists(file_path):
+            raise FileNotFoundError(f"File not found: {file_path}")
         if file_extension in image_extensions:
-            pass
-        # elif file_extension == '.pdf':
-        #     ms_name = os.path.splitext(os.path.basename(mark_scheme))[0]
-        #     images = convert_from_path(mark_scheme)
-        #     output_dir = os.path.dirname(mark_scheme)
-        #     mark_scheme = os.path.join(output_dir, f'{ms_name}.png')
-        #     images[0].save(mark_scheme, 'PNG')
+            with open(file_path, 'rb') as file:
+                images = optimize_images([file.read()], self.provider, media_type=mimetypes.guess_type(file_path)[0])
         elif file_extension == '.pdf':
-            ms_name = os.path.splitext(os.path.basename(mark_scheme))[0]
-            doc = fitz.open(mark_scheme)
-            # Convert the first page of the PDF to an image
-            page = doc.load_page(0)
-            pix = page.get_pixmap()
-            output_dir = os.path.dirname(mark_scheme)
-            mark_scheme = os.path.join(output_dir, f'{ms_name}.png')
-            # Save the first page as an image
-            pix.save(mark_scheme)
+            images = render_optimized_pages(file_path, self.provider)
         else:
             raise ValueError(f"Unsupported file type: {file_extension}")
-        if not os.path.exists(mark_scheme):
-            raise FileNotFoundError(f"File not found: {mark_scheme}")
-        with open(mark_scheme, 'rb') as file:
-            ms_content = file.read()
-        base64_encoded = base64.b64encode(ms_content).decode('utf-8')
-        media_type, _ = mimetypes.guess_type(mark_scheme)
-        if media_type is None:
-            media_type = 'application/octet-stream'
-        return {
+        return [
+            {
                 "type": "base64",
-                "media_type": media_type,
-                "data": base64_encoded
+                "media_type": media_type or 'application/octet-stream',
+                "data": base64.b64encode(image).decode('utf-8')
             }
+            for media_type, image in images
+        ]
         
-    def _get_initial_messages(self, assignment_title: str, question_title: str, subject: str, qualification: str, submission: str, mark_scheme_payload: Dict[str, Any], max_completion_tokens: int):
+    def _get_initial_messages(self, assignment_title: str, question_title: str, subject: str, qualification: str, submission: str, mark_scheme_payloads: List[Dict[str, Any]], max_completion_tokens: int):
         instructions = {
             "role": "user",
             "content": [
@@ -148,24 +297,28 @@ class AnthropicHandler:
                             ],
                         }}
                         Do NOT write anything in your reply outside of this JSON, and make sure you always using double quotation marks "" for each key or value string, and single quotation marks '' for punctuation ONLY.
+                        The mark scheme is attached to this message.
                         """,
                 }
+            ] + [
+                {
+                    "type": "image",
+                    "source": mark_scheme_payload
+                }
+                for mark_scheme_payload in mark_scheme_payloads
             ]
         }
-        submission_and_ms = {
+        # the instructions and mark scheme don't depend on the submission, so they are cached as their own prefix shared by every student's requests
+        instructions['content'][-1]['cache_control'] = {"type": "ephemeral"}
+        submission_message = {
             "role": "user",
             "content": [
                 {
                     "type": "text",
                     "text": f"""The user's submission to the question is below:
                         {submission}
-                        and the mark scheme is attached to this message. 
-                        Parse these both and await further instructions regarding the feedback categories required.
+                        Parse this and the mark scheme attached above and await further instructions regarding the feedback categories required.
                         """
-                },
-                {
-                    "type": "image",
-                    "source": mark_scheme_payload
                 }
             ]
         }
@@ -176,17 +329,19 @@ class AnthropicHandler:
                 "content": [
                     {
                         "type": "text",
-                        "text": "Thank you for the instructions. I will await the submission and mark scheme and then do my best to provide accurate feedback based on the categories requested."
+                        "text": "Thank you for the instructions and mark scheme. I will await the submission and then do my best to provide accurate feedback based on the categories requested."
                     }
                 ]
             },
-            submission_and_ms,
+            submission_message,
             {
                 "role": "assistant",
                 "content": [
                     {
                         "type": "text",
-                        "text": "I have received the submission and mark scheme. I will now begin to provide feedback based on the categories requested, following the preceding instructions."
+                        "text": "I have received the submission and mark scheme. I will now begin to provide feedback based on the categories requested, following the preceding instructions.",
+                        # everything up to and including this block is the prompt prefix shared by every category call
+                        "cache_control": {"type": "ephemeral"}
                     }
                 ]
             }
@@ -290,159 +445,65 @@ class AnthropicHandler:
             }
         }
     
+    @timed('completion')
     def _get_run_output(self, messages, max_completion_tokens, temperature):
         message = self.client.messages.create(
-                model="claude-3-5-sonnet-20240620",
+                model=ANTHROPIC_MODEL,
                 max_tokens=max_completion_tokens,
                 messages=messages,
-                temperature=temperature
+                temperature=temperature,
+                extra_headers=PROMPT_CACHING_HEADERS
                 )
+        usage = self._get_usage(message)
+        record_usage(self.provider, usage)
+        print('usage:', usage)
         return {
             "role": "assistant",
-            "content": message.content
+            "content": message.content,
+            "stop_reason": message.stop_reason,
+            "usage": usage
         }            
+
+    @timed('prompt_cache_warmup')
+    def _warm_prompt_cache(self, messages, temperature) -> Optional[Dict[str, int]]:
+        if not ANTHROPIC_PROMPT_CACHE_WARMUP:
+            return None
+        message = self.client.messages.create(
+                model=ANTHROPIC_MODEL,
+                max_tokens=1,
+                messages=messages + [{"role": "user", "content": [{"type": "text", "text": "Reply with OK."}]}],
+                temperature=temperature,
+                extra_headers=PROMPT_CACHING_HEADERS
+                )
+        usage = self._get_usage(message)
+        record_usage(self.provider, usage)
+        print('prompt cache warmed:', usage)
+        return usage
+
+    def _get_usage(self, message) -> Dict[str, int]:
+        # cache token counts aren't typed fields in this sdk version, but are kept as extra fields on the usage object
+        return {
+            "input_tokens": message.usage.input_tokens,
+            "output_tokens": message.usage.output_tokens,
+            "cache_creation_input_tokens": getattr(message.usage, 'cache_creation_input_tokens', None) or 0,
+            "cache_read_input_tokens": getattr(message.usage, 'cache_read_input_tokens', None) or 0,
+        }
             
     
     def _format_category_output(self, output_message, category, submission) -> List[Dict[str, Any]]:
-        colour_dict = {
-            "SPaG": "orange",
-            "historical_accuracy": "blue",
-            "overall_comments": "green",
-            "marking": "purple",
-        }
-        try:
-            data = json.loads(output_message["content"][0].text)
-        except json.JSONDecodeError as e:
-            print(f"JSON Decode Error: {e}")
-            print(f"Problematic JSON content: {output_message}")
-            try:
-                import ast
-                data = ast.literal_eval(output_message)
-            except:
-                print("Failed to parse JSON.")
-                return None
-            
-        # extract list of bullets from output and iterate through
-        json_key = list(data.keys())[0]
-        bullets = data[json_key]
-        # print('bullets=', bullets)
-        response_data = []
-        for bullet in bullets:
-            bullet = bullet.strip('- ').strip()
-
-            pattern = r'【([^】]+)】'
-            match = re.search(pattern, bullet)
-            if match:
-                citations = match.group(1)
-                bullet = re.sub(pattern, '', bullet).strip()
-            else:
-                citations = None
-            
-            # assemble JSON response for each bullet, noting categories are handled differently based on if the output must be split into parts
+        # extract list of bullets from output (tolerating fences, single quotes, trailing commas and truncation) and iterate through
+        with span('parse_output', provider=self.provider):
+            bullets = parse_category_output(output_message["content"][0].text if output_message["content"] else '')
+        with span('highlight', provider=self.provider):
+            # match every correction against the submission in one pass, before formatting the bullets one by one
             if category in ['SPaG', 'historical_accuracy']:
-                parts = re.split(r' -> ', bullet, maxsplit=1)
-                if len(parts) == 2:
-                    incorrect_response, correct_response = parts
-                    incorrect_response = incorrect_response.strip().strip('`').strip('...').strip("'")
-                    correct_response = correct_response.strip().strip('`').strip('...').strip("'")
-                    # print('incorrect_resp=',incorrect_response,'repr sub =', repr(submission))
-                    match_indices = find_matches(incorrect_response, submission)
-                    start_indices, end_indices = zip(*match_indices) if match_indices else ([], []) 
-                    # start_indices = [match.start() for match in re.finditer(re.escape(incorrect_response), submission, re.IGNORECASE | re.DOTALL)]
-                    # end_indices = [ind + len(incorrect_response) for ind in start_indices]
-                    
-                    response_data.append({
-                        'category': category,
-                        'incorrect_or_highlight': incorrect_response,
-                        'correct_or_feedback': correct_response,
-                        'citations': citations,
-                        'start': start_indices,
-                        'end': end_indices,
-                        'colour': colour_dict.get(category),
-                    })
-                else:
-                    print(f"Warning: LLM output correction '{bullet}' does not contain ' -> ' character")
-            
-            elif category in ['marking', 'overall_comments']:
-                bullet = bullet.strip().strip('`').strip('...')
-                response_data.append({
-                    'category': category,
-                    'incorrect_or_highlight': None,
-                    'correct_or_feedback': bullet,
-                    'citations': citations,
-                    'start': None,
-                    'end': None,
-                    'colour': colour_dict.get(category),
-                })
-            
-            else:
-                print(f"Warning: Invalid category '{category}'")
+                get_highlight_index(submission).find_all(get_correction_phrases(bullets))
+            response_data = []
+            for bullet in bullets:
+                response_data.extend(self._format_bullet(bullet, category, submission))
 
         return response_data
-    
-def find_matches(incorrect_response, submission):
-    submission_repr = repr(submission)
-
-    # Remove the leading/trailing quotes from the repr string
-    submission_repr = submission_repr.strip('"').replace('\\n', '\n')
-    
-    # Normalize the incorrect response
-    norm_incorrect = re.sub(r'\s+', r'\\s+', incorrect_response.strip())
-    
-    # Create a pattern that matches the incorrect response flexibly
-    pattern = r'(?:\b|\s)' + norm_incorrect + r'(?:\b|\s)'
-
-    # Find all matches in the submission
-    matches = list(re.finditer(pattern, submission_repr, re.IGNORECASE | re.DOTALL))
-
-    # Extract start and end indices
-    indices = [(match.start(), match.end()) for match in matches]
-
-    return indices
-    
-# def normalize_text(text):
-#     return re.sub(r'\s+', ' ', text.strip())
-
-# def find_matches(incorrect_response, submission):
-#     norm_incorrect = normalize_text(incorrect_response)
-#     norm_submission = normalize_text(submission)
-
-#     # Create a pattern that allows for flexible whitespace between words
-#     pattern = r'\b' + r'\s+'.join(re.escape(word) for word in norm_incorrect.split()) + r'\b'
-
-#     # Find matches in the normalized submission
-#     norm_matches = list(re.finditer(pattern, norm_submission, re.IGNORECASE))
-
-#     indices = []
-#     for match in norm_matches:
-#         # Find the corresponding start and end in the original submission
-#         start = find_original_index(submission, match.start())
-#         end = find_original_index(submission, match.end())
-#         indices.append((start, end))
-
-#     return indices
-
-# def find_original_index(original_text, normalized_index):
-#     # Count non-whitespace characters to find the corresponding index in the original text
-#     normalized_count = 0
-#     for i, char in enumerate(original_text):
-#         if not char.isspace():
-#             if normalized_count == normalized_index:
-#                 return i
-#             normalized_count += 1
-#     return len(original_text)
-    
-# def find_matches(incorrect_response, submission):
-#     # Normalize incorrect_response by replacing newlines and multiple spaces with a flexible pattern
-#     norm_incorrect = re.sub(r'\s+', r'\\s+', re.escape(incorrect_response.strip()))
-    
-#     # Create a pattern that matches the incorrect response flexibly
-#     pattern = r'(?:\b|\s)' + norm_incorrect + r'(?:\b|\s)'
-
-#     # Find all matches in the original submission
-#     matches = list(re.finditer(pattern, submission, re.IGNORECASE | re.DOTALL))
-
-#     # Extract start and end indices
-#     indices = [(match.start(), match.end()) for match in matches]
 
-#     return indices
\ No newline at end of file
+    def _format_bullet(self, bullet: str, category: str, submission: str) -> List[Dict[str, Any]]:
+        # the item schema is shared with the other providers (see feedback_fanout.format_feedback_bullet)
+        return format_feedback_bullet(bullet, category, submission)
@@ -1,19 +1,38 @@
 # app.py
 
 import os
-from flask import Flask, request, jsonify
+import json
+import threading
+import importlib
+import ipaddress
+from contextlib import nullcontext
+from flask import Flask, request, jsonify, Response, stream_with_context, send_file
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from dotenv import load_dotenv
-from openai_handler import OpenAIHandler
-from anthropic_handler import AnthropicHandler
-from utils import validate_input
+from utils import validate_input, get_batch_submissions, UPLOAD_MAX_REQUEST_BYTES
+from feedback_fanout import parse_feedback_categories
+from batch_grading import BatchStore, start_batch, poll_batch, get_batch_summary
+from job_queue import JobQueue
+from highlight_text import render_feedback, RENDER_FORMATS
+from cache_store import transcription_cache, result_cache
+from metrics import metrics
+from admission import AdmissionError
+from resilience import CircuitOpenError, deadline
 from flask_cors import CORS
 
 load_dotenv()  # load env vars from .env file
 
+# offline stand-in provider (model='stub') - see stub_handler.py
+STUB_ENABLED = os.getenv('ENABLE_STUB_PROVIDER', 'false').lower() == 'true'
+# handlers to create at startup rather than on their first request (comma-separated, eg 'openai,anthropic') - useful on a
+# long-running server, especially with HTTP_PREWARM_CONNECTIONS, but it slows down serverless cold starts
+PRELOAD_HANDLERS = [name.strip() for name in os.getenv('PRELOAD_HANDLERS', '').split(',') if name.strip()]
+
 app = Flask(__name__)
 CORS(app, supports_credentials=True, origins="*")
+# oversized requests are rejected before any of the body is read
+app.config['MAX_CONTENT_LENGTH'] = UPLOAD_MAX_REQUEST_BYTES
 
 # API schema
 API_SCHEMA = {
@@ -22,62 +41,307 @@ API_SCHEMA = {
         'assistant_id': None,
         'thread_id': None,
         'model': 'openai',
+        'engine': 'assistants',
+        'render': None,
         'max_completion_tokens': 1000,
-        'temperature': 0.0001
+        'temperature': 0.0001,
+        'image_token_budget': None
     },
     'file_fields': ['mark_scheme'],
     'text_or_file_fields': ['submission']
 }
 
-# set up rate limiting
+# batch API schema - as above, but with many 'submissions' files (and optional 'student_ids') instead of one 'submission'
+BATCH_API_SCHEMA = {
+    'required_fields': API_SCHEMA['required_fields'],
+    'optional_fields': {
+        'model': 'openai',
+        'engine': 'assistants',
+        'max_completion_tokens': 1000,
+        'temperature': 0.0001,
+        'batch_mode': 'auto'
+    },
+    'file_fields': ['mark_scheme'],
+    'text_or_file_fields': []
+}
+
+# set up rate limiting (RATELIMIT_ENABLED=false turns it off, eg for local load testing) - RATELIMIT_STORAGE_URI (eg
+# 'redis://...') shares the counts between workers. provider token limits are handled separately, by queueing in admission.py
+app.config['RATELIMIT_ENABLED'] = os.getenv('RATELIMIT_ENABLED', 'true').lower() == 'true'
+app.config['RATELIMIT_STORAGE_URI'] = os.getenv('RATELIMIT_STORAGE_URI', 'memory://')
+RATE_LIMIT = os.getenv('RATE_LIMIT', '10 per minute')
+# addresses (or networks, eg '10.0.0.0/8') of known integrations whose 'X-Client-ID' header is trusted - the header is set by
+# the caller, so from anywhere else it is ignored (or anyone could get a fresh limit by changing it on every request)
+RATE_LIMIT_TRUSTED_NETWORKS = [ipaddress.ip_network(network.strip(), strict=False) for network in os.getenv('RATE_LIMIT_TRUSTED_NETWORKS', '').split(',') if network.strip()]
+
+def get_client_id() -> str:
+    # limits are per remote address - and for trusted integrations, per client of theirs ('X-Client-ID', eg one per school),
+    # so a whole school behind one NAT'd address doesn't share a single limit
+    address = get_remote_address()
+    client_id = request.headers.get('X-Client-ID')
+    if client_id and is_trusted_address(address):
+        return f'{address}:{client_id}'
+    return address
+
+def is_trusted_address(address: str) -> bool:
+    try:
+        return any(ipaddress.ip_address(address) in network for network in RATE_LIMIT_TRUSTED_NETWORKS)
+    except ValueError:
+        return False
+
 limiter = Limiter(
-    get_remote_address,
+    get_client_id,
     app=app,
     # default_limits=["200 per day", "50 per hour"]
 )
 
-openai_handler = OpenAIHandler()
-anthropic_handler = AnthropicHandler()
+# provider handlers are created on first use - importing the provider sdks (and the pdf/image libraries the handlers use) is
+# most of the cost of a cold start, and a request only needs one of them
+HANDLERS = {
+    'openai': ('openai_handler', 'OpenAIHandler'),
+    'anthropic': ('anthropic_handler', 'AnthropicHandler'),
+    'stub': ('stub_handler', 'StubHandler'),
+    'auto': ('provider_router', 'ProviderRouter')
+}
+handlers = {}
+handlers_lock = threading.Lock()
+batch_store = BatchStore()
+
+def get_handler_name(model: str) -> str:
+    if model.lower() == 'anthropic':
+        return 'anthropic'
+    if model.lower() == 'stub' and STUB_ENABLED:
+        return 'stub'
+    if model.lower() == 'auto':
+        return 'auto'
+    return 'openai'
+
+def get_handler(model: str):
+    name = get_handler_name(model)
+    with handlers_lock:
+        if name not in handlers:
+            module, class_name = HANDLERS[name]
+            handler_class = getattr(importlib.import_module(module), class_name)
+            # the router picks one of the other handlers for each request
+            handlers[name] = handler_class(get_handler) if name == 'auto' else handler_class()
+        return handlers[name]
+
+for name in PRELOAD_HANDLERS:
+    get_handler(name)
+
+# the queue's workers are started by its first use, not on import
+job_queue = JobQueue(get_handler)
+
+@app.before_request
+def check_request_size():
+    # rejected before the routes start parsing the form (which would otherwise raise inside their error handling)
+    if request.content_length and request.content_length > UPLOAD_MAX_REQUEST_BYTES:
+        return jsonify({"error": f"Request too large (maximum {UPLOAD_MAX_REQUEST_BYTES} bytes)"}), 413
 
 @app.route('/')
 def start():
     return "Server is running !!"
 
+def get_image_token_budget(data):
+    # sizes the request's images to its own 'image_token_budget' if it set one - image_optimizer loads Pillow and PyMuPDF, so it
+    # is only imported here for those requests (the handlers import it themselves)
+    if data.get('image_token_budget') is None:
+        return nullcontext()
+    from image_optimizer import image_token_budget
+    return image_token_budget(data['image_token_budget'])
+
+def get_handler_and_args(data):
+    # 'feedback_category' may be a single category, a comma-separated list or 'all' - multiple categories are queried concurrently
+    feedback_categories = parse_feedback_categories(data['feedback_category'])
+    feedback_category = feedback_categories[0] if len(feedback_categories) == 1 else feedback_categories
+
+    feedback_args = dict(
+        assignment_id=data['assignment_id'],
+        assignment_title=data['assignment_title'],
+        question_id=data['question_id'],
+        question_title=data['question_title'],
+        subject=data['subject'],
+        qualification=data['qualification'],
+        feedback_category=feedback_category,
+        submission=data.get('submission'),
+        mark_scheme=data['mark_scheme'],
+        max_completion_tokens=data['max_completion_tokens'],
+        temperature=data['temperature']
+    )
+
+    # choose the appropriate handler based on the 'model' field
+    handler = get_handler(data['model'])
+    if get_handler_name(data['model']) in ('openai', 'auto'):
+        return handler, dict(assistant_id=data.get('assistant_id'), thread_id=data.get('thread_id'), engine=data['engine'], **feedback_args)
+    return handler, feedback_args
+
 @app.route('/api/feedback', methods=['POST'])
-@limiter.limit("10 per minute")
+@limiter.limit(RATE_LIMIT)
 def handle_feedback_request():
     try:
         # validate input data
         data = validate_input(request, API_SCHEMA)
+        handler, feedback_args = get_handler_and_args(data)
+        if data['render'] and data['render'] not in RENDER_FORMATS:
+            raise ValueError(f"Invalid render format: {data['render']} (must be one of {RENDER_FORMATS})")
 
-        # choose the appropriate handler based on the 'model' field
-        if data['model'].lower() == 'anthropic':
-            handler = anthropic_handler
-        else:
-            handler = openai_handler
-        
-        # generate feedback
-        feedback = handler.generate_feedback(
-            assignment_id=data['assignment_id'],
-            assignment_title=data['assignment_title'],
-            question_id=data['question_id'],
-            question_title=data['question_title'],
-            subject=data['subject'],
-            qualification=data['qualification'],
-            feedback_category=data['feedback_category'],
-            assistant_id=data['assistant_id'],
-            thread_id=data['thread_id'],
-            submission=data['submission'],
-            mark_scheme=data['mark_scheme'],
-            max_completion_tokens=data['max_completion_tokens'],
-            temperature=data['temperature']
-        )
+        # generate feedback (the provider calls must all finish within REQUEST_DEADLINE_SECONDS)
+        with deadline(), get_image_token_budget(data):
+            feedback = handler.generate_feedback(**feedback_args)
+        # optionally pre-render the highlighted submission, so clients don't have to apply the highlights themselves
+        if data['render']:
+            feedback = {**feedback, "rendered": render_feedback(feedback, data['render'])}
         
         # format feedback as JSON
         return jsonify(feedback), 200
     
+    except AdmissionError as e:
+        # the provider's token budget stayed exhausted for longer than requests are queued
+        return jsonify({"error": str(e), "retry_after": round(e.retry_after)}), 429, {'Retry-After': str(max(1, round(e.retry_after)))}
+    except CircuitOpenError as e:
+        # the provider has been failing, so the request wasn't sent
+        return jsonify({"error": str(e), "retry_after": round(e.retry_after)}), 503, {'Retry-After': str(max(1, round(e.retry_after)))}
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        app.logger.error(f"Unexpected error: {str(e)}")
+        return jsonify({"error": "An unexpected error occurred"}), 500
+
+@app.route('/api/feedback/stream', methods=['POST'])
+@limiter.limit(RATE_LIMIT)
+def handle_feedback_stream_request():
+    # same request as /api/feedback, but the response is a text/event-stream of 'submission', 'feedback' (one per bullet, with its
+    # highlight offsets), 'category_done' and finally 'done' (or 'error') events, sent as soon as each is available
+    try:
+        data = validate_input(request, API_SCHEMA)
+        handler, feedback_args = get_handler_and_args(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    def generate():
+        statuses = []
+        try:
+            with deadline(), get_image_token_budget(data):
+                for event, event_data in handler.stream_feedback(**feedback_args):
+                    if event == 'category_done':
+                        statuses.append(event_data['status'])
+                    yield f"event: {event}\ndata: {json.dumps(event_data)}\n\n"
+            status = "completed" if all(status == 'completed' for status in statuses) else "incomplete"
+            yield f"event: done\ndata: {json.dumps({'status': status})}\n\n"
+        except (AdmissionError, CircuitOpenError) as e:
+            yield f"event: error\ndata: {json.dumps({'error': str(e), 'retry_after': round(e.retry_after)})}\n\n"
+        except ValueError as e:
+            yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+        except Exception as e:
+            app.logger.error(f"Unexpected error: {str(e)}")
+            yield f"event: error\ndata: {json.dumps({'error': 'An unexpected error occurred'})}\n\n"
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/cache/stats', methods=['GET'])
+def handle_cache_stats_request():
+    # hit/miss/eviction counters for each cache in this server process, for monitoring (pdf_render and image_optimizer are
+    # imported here rather than at startup, as they load PyMuPDF)
+    from pdf_render import rendered_page_cache
+    from image_optimizer import optimized_image_cache
+    return jsonify([cache.get_stats() for cache in (result_cache, transcription_cache, rendered_page_cache, optimized_image_cache)]), 200
+
+@app.route('/metrics', methods=['GET'])
+def handle_metrics_request():
+    # per-stage latency histograms, error counts and token usage by provider - prometheus text format, or '?format=json'
+    if request.args.get('format') == 'json':
+        return jsonify(metrics.get_stats()), 200
+    return Response(metrics.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/transport/stats', methods=['GET'])
+def handle_transport_stats_request():
+    # connection pool metrics for each provider's http client - connections open/in use, reuse and time waiting for a connection
+    from transport import get_transport_stats
+    return jsonify(get_transport_stats()), 200
+
+@app.route('/api/router/stats', methods=['GET'])
+def handle_router_stats_request():
+    # rolling latency and error rate per provider, as used to route model='auto' requests
+    from provider_router import get_router_stats
+    return jsonify(get_router_stats()), 200
+
+@app.route('/api/feedback/jobs', methods=['POST'])
+@limiter.limit(RATE_LIMIT)
+def handle_feedback_job_request():
+    # same request as /api/feedback, but queued for a background worker - returns a job id straight away to poll for the result
+    try:
+        data = validate_input(request, API_SCHEMA)
+        handler, feedback_args = get_handler_and_args(data)
+        if data['render'] and data['render'] not in RENDER_FORMATS:
+            raise ValueError(f"Invalid render format: {data['render']} (must be one of {RENDER_FORMATS})")
+        job = job_queue.enqueue(data['model'].lower(), feedback_args, {"render": data['render'], "image_token_budget": data['image_token_budget']})
+        return jsonify(job), 202
+
     except ValueError as e:
         return jsonify({"error": str(e)}), 400
     except Exception as e:
         app.logger.error(f"Unexpected error: {str(e)}")
         return jsonify({"error": "An unexpected error occurred"}), 500
+
+@app.route('/api/feedback/jobs/<job_id>', methods=['GET'])
+def handle_feedback_job_status_request(job_id):
+    job = job_queue.get(job_id)
+    if not job:
+        return jsonify({"error": f"Job not found: {job_id}"}), 404
+    return jsonify(job), 200
+
+@app.route('/api/feedback/batch', methods=['POST'])
+@limiter.limit(RATE_LIMIT)
+def handle_feedback_batch_request():
+    # grades a class set of 'submissions' files against one mark scheme, returning a batch id to poll for the results
+    try:
+        data = validate_input(request, BATCH_API_SCHEMA)
+        submissions = get_batch_submissions(request, data)
+        handler, feedback_args = get_handler_and_args(data)
+        feedback_args.pop('submission')
+        batch = start_batch(batch_store, data['model'].lower(), handler, feedback_args, submissions, data['batch_mode'])
+        return jsonify(get_batch_summary(batch)), 202
+
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        app.logger.error(f"Unexpected error: {str(e)}")
+        return jsonify({"error": "An unexpected error occurred"}), 500
+
+@app.route('/api/feedback/batch/<batch_id>', methods=['GET'])
+def handle_feedback_batch_status_request(batch_id):
+    batch = batch_store.get(batch_id)
+    if not batch:
+        return jsonify({"error": f"Batch not found: {batch_id}"}), 404
+    try:
+        batch = poll_batch(batch_store, batch_id, get_handler(batch['model']))
+    except Exception as e:
+        app.logger.error(f"Unexpected error: {str(e)}")
+        return jsonify({"error": "An unexpected error occurred"}), 500
+    return jsonify(get_batch_summary(batch)), 200
+
+@app.route('/api/feedback/batch/<batch_id>/results', methods=['GET'])
+def handle_feedback_batch_results_request(batch_id):
+    # JSONL download with one line per student (so far, if the batch is still in progress) - '?render=html' (or 'ansi'/'runs')
+    # adds each student's highlighted submission, pre-rendered
+    batch = batch_store.get(batch_id)
+    if not batch:
+        return jsonify({"error": f"Batch not found: {batch_id}"}), 404
+    render_format = request.args.get('render')
+    if render_format:
+        if render_format not in RENDER_FORMATS:
+            return jsonify({"error": f"Invalid render format: {render_format} (must be one of {RENDER_FORMATS})"}), 400
+        def generate():
+            with open(batch_store.results_path(batch_id), 'r', encoding='utf-8') as file:
+                for line in file:
+                    record = json.loads(line)
+                    if record.get('feedback') is not None:
+                        record['rendered'] = render_feedback(record, render_format)
+                    yield json.dumps(record) + '\n'
+        return Response(generate(), mimetype='application/x-ndjson', headers={
+            'Content-Disposition': f'attachment; filename=feedback-{batch_id}.jsonl',
+            'X-Batch-Status': batch['status']
+        })
+    response = send_file(batch_store.results_path(batch_id), mimetype='application/x-ndjson', as_attachment=True, download_name=f'feedback-{batch_id}.jsonl')
+    response.headers['X-Batch-Status'] = batch['status']
+    return response
@@ -0,0 +1,102 @@
+# assistant_registry.py
+
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional
+
+REGISTRY_PATH = os.getenv('ASSISTANT_REGISTRY_PATH', '/tmp/assistant_registry.sqlite3')
+# registry entries are trusted without any API call until they are this old, after which they are re-checked on next use
+REGISTRY_VALIDATE_SECONDS = int(os.getenv('ASSISTANT_REGISTRY_VALIDATE_SECONDS', 24 * 60 * 60))
+
+class AssistantRegistry:
+    # persistent local map of (assignment, question, category, mark scheme hash) -> assistant/vector store ids,
+    # so finding an existing assistant doesn't need a scan over every assistant in the account
+    def __init__(self, path: str = REGISTRY_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS assistants (
+                    assignment_id TEXT NOT NULL,
+                    question_id TEXT NOT NULL,
+                    feedback_category TEXT NOT NULL,
+                    mark_scheme_sha256 TEXT NOT NULL,
+                    assistant_id TEXT NOT NULL,
+                    vector_store_id TEXT,
+                    validated_at REAL NOT NULL,
+                    PRIMARY KEY (assignment_id, question_id, feedback_category, mark_scheme_sha256)
+                )
+            """)
+            # mark schemes are uploaded once per unique file contents and the vector store shared by every assistant that uses it
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS vector_stores (
+                    mark_scheme_sha256 TEXT PRIMARY KEY,
+                    vector_store_id TEXT NOT NULL,
+                    file_id TEXT NOT NULL,
+                    validated_at REAL NOT NULL
+                )
+            """)
+
+    def get_assistant(self, assignment_id: str, question_id: str, feedback_category: str, mark_scheme_sha256: str) -> Optional[Dict[str, str]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT assistant_id, vector_store_id, validated_at FROM assistants "
+                "WHERE assignment_id = ? AND question_id = ? AND feedback_category = ? AND mark_scheme_sha256 = ?",
+                (assignment_id, question_id, feedback_category, mark_scheme_sha256)
+            ).fetchone()
+        if not row:
+            return None
+        return {
+            "assistant_id": row[0],
+            "vector_store_id": row[1],
+            "needs_validation": time.time() - row[2] > REGISTRY_VALIDATE_SECONDS
+        }
+
+    def put_assistant(self, assignment_id: str, question_id: str, feedback_category: str, mark_scheme_sha256: str,
+                      assistant_id: str, vector_store_id: Optional[str]):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO assistants VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (assignment_id, question_id, feedback_category, mark_scheme_sha256, assistant_id, vector_store_id, time.time())
+            )
+
+    def mark_validated(self, assistant_id: str):
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE assistants SET validated_at = ? WHERE assistant_id = ?", (time.time(), assistant_id))
+
+    def remove_assistant(self, assistant_id: str):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM assistants WHERE assistant_id = ?", (assistant_id,))
+
+    def get_vector_store(self, mark_scheme_sha256: str) -> Optional[Dict[str, str]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT vector_store_id, file_id, validated_at FROM vector_stores WHERE mark_scheme_sha256 = ?",
+                (mark_scheme_sha256,)
+            ).fetchone()
+        if not row:
+            return None
+        return {
+            "vector_store_id": row[0],
+            "file_id": row[1],
+            "needs_validation": time.time() - row[2] > REGISTRY_VALIDATE_SECONDS
+        }
+
+    def put_vector_store(self, mark_scheme_sha256: str, vector_store_id: str, file_id: str):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO vector_stores VALUES (?, ?, ?, ?)",
+                (mark_scheme_sha256, vector_store_id, file_id, time.time())
+            )
+
+    def mark_vector_store_validated(self, vector_store_id: str):
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE vector_stores SET validated_at = ? WHERE vector_store_id = ?", (time.time(), vector_store_id))
+
+    def remove_vector_store(self, vector_store_id: str):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM vector_stores WHERE vector_store_id = ?", (vector_store_id,))
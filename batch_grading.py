@@ -0,0 +1,142 @@
+# batch_grading.py
+
+import os
+import json
+import time
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional
+
+BATCH_DIR = os.getenv('FEEDBACK_BATCH_DIR', '/tmp/feedback_batches')
+BATCH_MAX_WORKERS = int(os.getenv('FEEDBACK_BATCH_MAX_WORKERS', 8))
+# submissions transcribed at once before a provider batch is submitted (each one's pages are transcribed concurrently too, up
+# to TRANSCRIPTION_MAX_WORKERS)
+BATCH_TRANSCRIPTION_MAX_WORKERS = int(os.getenv('FEEDBACK_BATCH_TRANSCRIPTION_MAX_WORKERS', 4))
+BATCH_MODES = ['auto', 'provider', 'concurrent']
+
+class BatchStore:
+    # batch metadata and per-student JSONL results, kept on disk so batches can be polled/downloaded after a restart
+    def __init__(self, batch_dir: str = BATCH_DIR):
+        self.batch_dir = batch_dir
+        self._lock = threading.Lock()
+        os.makedirs(batch_dir, exist_ok=True)
+
+    def create(self, batch: Dict[str, Any]) -> Dict[str, Any]:
+        batch = {"batch_id": uuid.uuid4().hex, "status": "in_progress", "created_at": time.time(), "completed": 0, "failed": 0, **batch}
+        with self._lock:
+            self._write(batch)
+            open(self.results_path(batch['batch_id']), 'w').close()
+        return batch
+
+    def get(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._meta_path(batch_id), 'r', encoding='utf-8') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def update(self, batch_id: str, **fields) -> Dict[str, Any]:
+        with self._lock:
+            batch = {**self.get(batch_id), **fields}
+            self._write(batch)
+        return batch
+
+    def append_result(self, batch_id: str, record: Dict[str, Any]):
+        with self._lock:
+            self._append(batch_id, [record])
+
+    def finish(self, batch_id: str, records: List[Dict[str, Any]], **fields) -> Dict[str, Any]:
+        # writes a provider batch's results and final status - only once, if it is still in progress, so concurrent polls of a
+        # finished batch can't append its results twice
+        with self._lock:
+            batch = self.get(batch_id)
+            if batch['status'] != 'in_progress':
+                return batch
+            self._append(batch_id, records)
+            batch = {**self.get(batch_id), **fields}
+            self._write(batch)
+        return batch
+
+    def results_path(self, batch_id: str) -> str:
+        return os.path.join(self.batch_dir, f'{os.path.basename(batch_id)}.jsonl')
+
+    def _meta_path(self, batch_id: str) -> str:
+        return os.path.join(self.batch_dir, f'{os.path.basename(batch_id)}.json')
+
+    def _append(self, batch_id: str, records: List[Dict[str, Any]]):
+        with open(self.results_path(batch_id), 'a', encoding='utf-8') as file:
+            file.writelines(json.dumps(record) + '\n' for record in records)
+        batch = self.get(batch_id)
+        for record in records:
+            batch['failed' if record['status'] == 'failed' else 'completed'] += 1
+        self._write(batch)
+
+    def _write(self, batch: Dict[str, Any]):
+        tmp_path = self._meta_path(batch['batch_id']) + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(batch, file)
+        os.replace(tmp_path, self._meta_path(batch['batch_id']))
+
+def start_batch(store: BatchStore, model: str, handler, feedback_args: Dict[str, Any], submissions: Dict[str, str], batch_mode: str = 'auto') -> Dict[str, Any]:
+    # grades many submissions against one mark scheme - through the provider's batch api where it has one ('provider', or 'auto'
+    # falling back on failure), otherwise ('concurrent') with handler.generate_feedback run for each submission in a thread pool.
+    # either way the work happens in the background, so the batch is returned straight away
+    if batch_mode not in BATCH_MODES:
+        raise ValueError(f"Invalid batch_mode: {batch_mode} (must be one of {BATCH_MODES})")
+    use_provider = batch_mode != 'concurrent' and getattr(handler, 'submit_batch', None) is not None
+    if batch_mode == 'provider' and not use_provider:
+        raise ValueError(f"No batch API available for model: {model}")
+
+    batch = store.create({"model": model, "mode": "provider" if use_provider else "concurrent", "students": list(submissions)})
+    args = (store, batch['batch_id'], handler, feedback_args, submissions)
+    if use_provider:
+        threading.Thread(target=_submit_provider_batch, args=args + (batch_mode,), daemon=True).start()
+    else:
+        threading.Thread(target=_run_concurrent_batch, args=args, daemon=True).start()
+    return batch
+
+def _submit_provider_batch(store: BatchStore, batch_id: str, handler, feedback_args: Dict[str, Any], submissions: Dict[str, str], batch_mode: str):
+    # transcribes the submissions and submits them to the provider - until then the batch has no provider_batch_id to poll
+    try:
+        provider_batch = handler.submit_batch(submissions=submissions, **feedback_args)
+    except Exception as e:
+        if batch_mode == 'provider' or not isinstance(e, ValueError):
+            print(f'batch {batch_id} could not be submitted:', e)
+            store.update(batch_id, status="failed", error=str(e))
+            return
+        print('provider batch unavailable, grading concurrently instead:', e)
+        store.update(batch_id, mode="concurrent")
+        _run_concurrent_batch(store, batch_id, handler, feedback_args, submissions)
+        return
+    store.update(batch_id, **provider_batch)
+
+def _run_concurrent_batch(store: BatchStore, batch_id: str, handler, feedback_args: Dict[str, Any], submissions: Dict[str, str]):
+    def grade(student_id: str):
+        try:
+            record = {"student_id": student_id, **handler.generate_feedback(submission=submissions[student_id], **feedback_args)}
+        except Exception as e:
+            print(f'batch {batch_id} student {student_id} failed:', e)
+            record = {"student_id": student_id, "status": "failed", "error": str(e)}
+        store.append_result(batch_id, record)
+
+    with ThreadPoolExecutor(max_workers=BATCH_MAX_WORKERS) as executor:
+        list(executor.map(grade, submissions))
+    store.update(batch_id, status="completed")
+
+def poll_batch(store: BatchStore, batch_id: str, handler) -> Optional[Dict[str, Any]]:
+    # provider batches are only checked when polled, writing out the results the first time the provider reports them finished
+    # (concurrent polls may both fetch them, but only the first writes them)
+    batch = store.get(batch_id)
+    if not batch or batch['mode'] != 'provider' or batch['status'] != 'in_progress' or not batch.get('provider_batch_id'):
+        return batch
+    try:
+        records = handler.get_batch_results(batch)
+    except ValueError as e:
+        return store.finish(batch_id, [], status="failed", error=str(e))
+    if records is None:
+        return batch
+    return store.finish(batch_id, records, status="completed")
+
+def get_batch_summary(batch: Dict[str, Any]) -> Dict[str, Any]:
+    return {key: batch.get(key) for key in ('batch_id', 'status', 'mode', 'model', 'students', 'completed', 'failed', 'created_at', 'error')}
@@ -0,0 +1,88 @@
+# benchmarks/compare_openai_engines.py
+
+# compares end-to-end latency of the openai 'assistants' and 'chat' engines on the same request, against the real api
+# (needs OPENAI_API_KEY), eg:
+#   python benchmarks/compare_openai_engines.py --mark-scheme "example_files/GCSE_History/8 marks/O26Q1_MS.pdf" \
+#       --submission "example_files/GCSE_History/8 marks/O26Q1_A.pdf" --runs 5
+# the first run of each engine is reported separately as 'cold' (assistant/vector store creation, uncached transcription)
+
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+from typing import Dict, Any, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dotenv import load_dotenv
+from openai_handler import OpenAIHandler, OPENAI_ENGINES
+from feedback_fanout import parse_feedback_categories
+
+def time_request(handler: OpenAIHandler, engine: str, args: Dict[str, Any]) -> Dict[str, float]:
+    # streams the request, recording the time to the first feedback bullet as well as the total time
+    start = time.perf_counter()
+    first_feedback = None
+    statuses = []
+    for event, data in handler.stream_feedback(engine=engine, assistant_id=None, thread_id=None, **args):
+        if event == 'feedback' and first_feedback is None:
+            first_feedback = time.perf_counter() - start
+        elif event == 'category_done':
+            statuses.append(data['status'])
+    return {"first_feedback": first_feedback, "total": time.perf_counter() - start, "completed": all(status == 'completed' for status in statuses)}
+
+def summarise(runs: List[Dict[str, float]]) -> Dict[str, Any]:
+    summary = {"runs": len(runs), "completed": sum(run['completed'] for run in runs)}
+    for key in ('first_feedback', 'total'):
+        values = sorted(run[key] for run in runs if run[key] is not None)
+        if values:
+            summary[key] = {
+                "median": round(statistics.median(values), 3),
+                "min": round(values[0], 3),
+                "max": round(values[-1], 3)
+            }
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare OpenAI assistants vs chat engine latency')
+    parser.add_argument('--mark-scheme', required=True)
+    parser.add_argument('--submission', required=True, help='submission file path or text')
+    parser.add_argument('--feedback-category', default='SPaG')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--engines', default=','.join(OPENAI_ENGINES))
+    parser.add_argument('--output', help='also write the results to this JSON file')
+    options = parser.parse_args()
+
+    load_dotenv()
+    categories = parse_feedback_categories(options.feedback_category)
+    args = dict(
+        assignment_id='benchmark',
+        assignment_title='Benchmark assignment',
+        question_id='1',
+        question_title='Benchmark question',
+        subject='History',
+        qualification='GCSE',
+        feedback_category=categories[0] if len(categories) == 1 else categories,
+        submission=options.submission,
+        mark_scheme=options.mark_scheme,
+        max_completion_tokens=1000,
+        temperature=0.0001
+    )
+
+    handler = OpenAIHandler()
+    results = {}
+    for engine in options.engines.split(','):
+        runs = [time_request(handler, engine, args) for _ in range(options.runs)]
+        results[engine] = {"cold": runs[0], "warm": summarise(runs[1:]) if len(runs) > 1 else None}
+
+    for engine, result in results.items():
+        warm = result['warm'] or {}
+        print(f"{engine:>10}: cold total {result['cold']['total']:.2f}s, "
+              f"warm first feedback {warm.get('first_feedback', {}).get('median', float('nan')):.2f}s, "
+              f"warm total {warm.get('total', {}).get('median', float('nan')):.2f}s (median of {warm.get('runs', 0)})")
+    if options.output:
+        with open(options.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+# benchmarks/load_test.py
+
+# load test of the server itself - starts the mock providers (benchmarks/mock_providers.py) and a server process pointed at them,
+# then sends concurrent feedback requests for the submissions and mark schemes in example_files/GCSE_History down each handler
+# path, reporting throughput, p50/p95/p99 latency, errors and server memory per request as JSON, eg:
+#   python benchmarks/load_test.py --paths openai-assistants,openai-chat,anthropic --concurrency 8 --requests 40 --output load.json
+# and to fail if any path's p95 latency is more than 25% worse than a previous run:
+#   python benchmarks/load_test.py --baseline load.json --max-regression 0.25
+# no api keys are needed and no real api calls are made
+
+import os
+import sys
+import json
+import glob
+import time
+import socket
+import argparse
+import tempfile
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Tuple
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from mock_providers import MockProviderServer
+
+CORPUS_DIR = os.path.join(ROOT, 'example_files', 'GCSE_History')
+# (route, form fields) for each handler path
+PATHS = {
+    'openai-assistants': ('/api/feedback', {'model': 'openai', 'engine': 'assistants'}),
+    'openai-chat': ('/api/feedback', {'model': 'openai', 'engine': 'chat'}),
+    'anthropic': ('/api/feedback', {'model': 'anthropic'}),
+    'openai-assistants-stream': ('/api/feedback/stream', {'model': 'openai', 'engine': 'assistants'}),
+    'openai-chat-stream': ('/api/feedback/stream', {'model': 'openai', 'engine': 'chat'}),
+    'anthropic-stream': ('/api/feedback/stream', {'model': 'anthropic'}),
+    'stub': ('/api/feedback', {'model': 'stub'}),
+}
+DEFAULT_PATHS = ['openai-assistants', 'openai-chat', 'anthropic', 'openai-chat-stream', 'anthropic-stream']
+
+def get_corpus() -> List[Dict[str, str]]:
+    # every student answer with its mark scheme - eg 'O26Q1_A.pdf' and 'O26Q1_MS.pdf' (some names have an extra '_' before the Q)
+    mark_schemes = {os.path.basename(path)[:-len('_MS.pdf')].replace('_', ''): path for path in glob.glob(os.path.join(CORPUS_DIR, '*', '*_MS.pdf'))}
+    corpus = []
+    for path in sorted(glob.glob(os.path.join(CORPUS_DIR, '*', '*_A.pdf'))):
+        question = os.path.basename(path)[:-len('_A.pdf')].replace('_', '')
+        if question in mark_schemes:
+            corpus.append({"question": question, "submission": path, "mark_scheme": mark_schemes[question]})
+    if not corpus:
+        raise SystemExit(f'no answer/mark scheme pairs found in {CORPUS_DIR}')
+    return corpus
+
+def get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def get_rss_kb(pid: int) -> Dict[str, Optional[int]]:
+    # current and peak resident memory of the server process (linux only - None elsewhere)
+    try:
+        with open(f'/proc/{pid}/status') as file:
+            fields = dict(line.split(':', 1) for line in file if ':' in line)
+        return {"rss_kb": int(fields['VmRSS'].split()[0]), "peak_rss_kb": int(fields['VmHWM'].split()[0])}
+    except (OSError, KeyError, ValueError):
+        return {"rss_kb": None, "peak_rss_kb": None}
+
+def start_server(mocks: MockProviderServer, work_dir: str, port: int, server_log) -> subprocess.Popen:
+    # the server gets its own caches/registry/uploads, so runs don't share state with each other (or a dev server)
+    env = dict(os.environ, **mocks.get_env(),
+               PORT=str(port),
+               RATELIMIT_ENABLED='false',
+               OPENAI_TOKENS_PER_MINUTE='0',
+               ANTHROPIC_TOKENS_PER_MINUTE='0',
+               ENABLE_STUB_PROVIDER='true',
+               PRELOAD_HANDLERS='',
+               ASSISTANT_REGISTRY_PATH=os.path.join(work_dir, 'assistant_registry.sqlite3'),
+               FEEDBACK_JOB_QUEUE_PATH=os.path.join(work_dir, 'feedback_jobs.sqlite3'),
+               FEEDBACK_BATCH_DIR=os.path.join(work_dir, 'batches'),
+               TRANSCRIPTION_CACHE_DIR=os.path.join(work_dir, 'transcription_cache'),
+               RESULT_CACHE_DIR=os.path.join(work_dir, 'result_cache'),
+               UPLOAD_DIR=os.path.join(work_dir, 'uploads'))
+    process = subprocess.Popen([sys.executable, 'index.py'], cwd=ROOT, env=env, stdout=server_log, stderr=subprocess.STDOUT)
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f'server exited during startup (code {process.returncode}) - see {server_log.name}')
+        try:
+            if requests.get(f'http://127.0.0.1:{port}/', timeout=1).ok:
+                return process
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    process.terminate()
+    raise SystemExit('server did not start within 60s')
+
+def send_request(session: requests.Session, base_url: str, route: str, fields: Dict[str, str], item: Dict[str, str],
+                 options: argparse.Namespace) -> Dict[str, Any]:
+    data = {
+        'assignment_id': f'load-test-{item["question"]}',
+        'assignment_title': 'GCSE History',
+        'question_id': item['question'],
+        'question_title': item['question'],
+        'subject': 'History',
+        'qualification': 'GCSE',
+        'feedback_category': options.categories,
+        'max_completion_tokens': str(options.max_completion_tokens),
+        # above RESULT_CACHE_MAX_TEMPERATURE by default, so every request does the full work rather than hitting the result cache
+        'temperature': str(options.temperature),
+        **fields
+    }
+    start = time.perf_counter()
+    first_event = None
+    with open(item['submission'], 'rb') as submission, open(item['mark_scheme'], 'rb') as mark_scheme:
+        files = {'submission': (os.path.basename(item['submission']), submission, 'application/pdf'),
+                 'mark_scheme': (os.path.basename(item['mark_scheme']), mark_scheme, 'application/pdf')}
+        try:
+            response = session.post(base_url + route, data=data, files=files, stream=True, timeout=options.timeout)
+            ok = response.ok
+            if response.headers.get('Content-Type', '').startswith('text/event-stream'):
+                # a stream responds 200 straight away, so failures show up as error events
+                for line in response.iter_lines(decode_unicode=True):
+                    if line.startswith('event: feedback') and first_event is None:
+                        first_event = time.perf_counter() - start
+                    elif line.startswith('event: error'):
+                        ok = False
+            else:
+                response.content
+            status = response.status_code
+        except requests.RequestException as e:
+            ok, status = False, type(e).__name__
+    return {"latency": time.perf_counter() - start, "first_event": first_event, "ok": ok, "status": status}
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    # nearest-rank percentile
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, max(0, int(round(q * len(values) + 0.5)) - 1))], 4)
+
+def summarise(results: List[Dict[str, Any]], elapsed: float, memory_before: Dict[str, Any], memory_after: Dict[str, Any]) -> Dict[str, Any]:
+    latencies = [result['latency'] for result in results if result['ok']]
+    first_events = [result['first_event'] for result in results if result['ok'] and result['first_event'] is not None]
+    statuses = {}
+    for result in results:
+        statuses[str(result['status'])] = statuses.get(str(result['status']), 0) + 1
+    summary = {
+        "requests": len(results),
+        "ok": len(latencies),
+        "errors": len(results) - len(latencies),
+        "statuses": statuses,
+        "elapsed_seconds": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 3) if elapsed else None,
+        "latency_seconds": {
+            "mean": round(sum(latencies) / len(latencies), 4) if latencies else None,
+            "p50": percentile(latencies, 0.5),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99),
+            "max": round(max(latencies), 4) if latencies else None
+        },
+        "first_feedback_seconds": {"p50": percentile(first_events, 0.5), "p95": percentile(first_events, 0.95)} if first_events else None,
+        "memory": {**{f'{key}_before': value for key, value in memory_before.items()}, **{f'{key}_after': value for key, value in memory_after.items()}}
+    }
+    if memory_before['rss_kb'] is not None and memory_after['rss_kb'] is not None and results:
+        summary['memory']['rss_delta_kb_per_request'] = round((memory_after['rss_kb'] - memory_before['rss_kb']) / len(results), 2)
+    return summary
+
+def run_path(name: str, base_url: str, pid: int, corpus: List[Dict[str, str]], options: argparse.Namespace) -> Dict[str, Any]:
+    route, fields = PATHS[name]
+    sessions = threading.local()
+    def send(index: int) -> Dict[str, Any]:
+        if not hasattr(sessions, 'session'):
+            sessions.session = requests.Session()
+        return send_request(sessions.session, base_url, route, fields, corpus[index % len(corpus)], options)
+
+    # warm-up requests (handler creation, assistants/vector stores, transcriptions) aren't counted
+    for index in range(options.warmup):
+        send(index)
+    memory_before = get_rss_kb(pid)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=options.concurrency) as executor:
+        results = list(executor.map(send, range(options.requests)))
+    elapsed = time.perf_counter() - start
+    return summarise(results, elapsed, memory_before, get_rss_kb(pid))
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], max_regression: float) -> List[str]:
+    # p95 latency and throughput of each path against a previous run's output
+    regressions = []
+    for name, summary in results['paths'].items():
+        previous = baseline.get('paths', {}).get(name)
+        if not previous:
+            continue
+        p95, previous_p95 = summary['latency_seconds']['p95'], previous['latency_seconds']['p95']
+        if p95 and previous_p95:
+            change = p95 / previous_p95 - 1
+            print(f'{name:>26}: p95 {previous_p95:.3f}s -> {p95:.3f}s ({change:+.1%})')
+            if change > max_regression:
+                regressions.append(f'{name} p95 latency {change:+.1%}')
+        rps, previous_rps = summary['throughput_rps'], previous['throughput_rps']
+        if rps and previous_rps and previous_rps / rps - 1 > max_regression:
+            regressions.append(f'{name} throughput {rps / previous_rps - 1:+.1%}')
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the feedback server against mock providers')
+    parser.add_argument('--paths', default=','.join(DEFAULT_PATHS), help=f'comma-separated, from: {", ".join(PATHS)}')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=40, help='requests per path (after the warm-up)')
+    parser.add_argument('--warmup', type=int, default=2, help='uncounted requests per path before measuring')
+    parser.add_argument('--categories', default='SPaG,historical_accuracy')
+    parser.add_argument('--temperature', type=float, default=0.5)
+    parser.add_argument('--max-completion-tokens', type=int, default=1000)
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('--latency', type=float, default=0.5, help='mock seconds before the first token of every model call')
+    parser.add_argument('--token-delay', type=float, default=0.01, help='mock seconds per streamed chunk')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of mock model calls that fail')
+    parser.add_argument('--error-status', type=int, default=500)
+    parser.add_argument('--poll-ms', type=int, default=100, help='assistant run polling interval the mock suggests')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='results JSON from a previous run to compare against')
+    parser.add_argument('--max-regression', type=float, default=0.25, help='with --baseline, the worst allowed fractional regression')
+    options = parser.parse_args()
+
+    names = [name.strip() for name in options.paths.split(',') if name.strip()]
+    unknown = [name for name in names if name not in PATHS]
+    if unknown:
+        parser.error(f'unknown paths: {", ".join(unknown)}')
+    corpus = get_corpus()
+
+    mocks = MockProviderServer(latency=options.latency, token_delay=options.token_delay, error_rate=options.error_rate,
+                               error_status=options.error_status, poll_ms=options.poll_ms, seed=options.seed).start()
+    port = get_free_port()
+    base_url = f'http://127.0.0.1:{port}'
+    with tempfile.TemporaryDirectory(prefix='feedback-load-test-') as work_dir, open(os.path.join(work_dir, 'server.log'), 'w') as server_log:
+        server = start_server(mocks, work_dir, port, server_log)
+        try:
+            results = {"config": {key: value for key, value in vars(options).items() if key not in ('output', 'baseline')},
+                       "corpus": [item['question'] for item in corpus], "paths": {}}
+            for name in names:
+                results['paths'][name] = summary = run_path(name, base_url, server.pid, corpus, options)
+                latency = summary['latency_seconds']
+                print(f"{name:>26}: {summary['throughput_rps'] or 0:.2f} req/s, p50 {latency['p50'] or float('nan'):.3f}s, "
+                      f"p95 {latency['p95'] or float('nan'):.3f}s, p99 {latency['p99'] or float('nan'):.3f}s, "
+                      f"{summary['errors']} errors, {summary['memory'].get('rss_delta_kb_per_request', float('nan')):.1f}KB RSS/request")
+            # the server's own per-stage breakdown (see /metrics)
+            results['server_metrics'] = requests.get(base_url + '/metrics?format=json', timeout=10).json()
+            results['mock_providers'] = dict(mocks.state.stats)
+        finally:
+            server.terminate()
+            server.wait(timeout=10)
+            mocks.stop()
+
+    if options.output:
+        with open(options.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    if options.baseline:
+        with open(options.baseline) as file:
+            regressions = compare(results, json.load(file), options.max_regression)
+        if regressions:
+            sys.exit('regressions: ' + '; '.join(regressions))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,385 @@
+# benchmarks/mock_providers.py
+
+# local stand-in for the parts of the OpenAI (assistants, vector stores, files, chat completions) and Anthropic (messages) apis
+# the server uses, with configurable latency, streaming speed and error injection - so the server's own overhead and concurrency
+# behaviour can be measured without spending real api money. point the sdks at it with OPENAI_BASE_URL=http://<host>:<port>/v1
+# and ANTHROPIC_BASE_URL=http://<host>:<port>, eg:
+#   python benchmarks/mock_providers.py --port 8089 --latency 0.5 --token-delay 0.01 --error-rate 0.02
+
+import re
+import sys
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Dict, Any, List, Optional
+
+# category prompts are recognised by their headings (see the handlers' category messages)
+CATEGORY_MARKERS = [
+    ('SPaG', 'Spelling, Punctuation and Grammar'),
+    ('historical_accuracy', 'Historical Accuracy'),
+    ('overall_comments', 'Overall Comments'),
+    ('marking', 'Marking:'),
+]
+TRANSCRIPTION = ("In 1979 the Soviet Union invaded Afganistan, which escalated Cold War tensions. The USA supported the Mujahideen "
+                 "with weapons and money. Billions of rubles was spent on the war and disscontent grew within the Soviet Union.")
+CHUNK_CHARS = 16
+
+def get_text(content: Any) -> str:
+    # message content as plain text - a string, or a list of typed parts (only the text parts are kept)
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return '\n'.join(part.get('text', '') if isinstance(part.get('text'), str) else '' for part in content if isinstance(part, dict))
+    return ''
+
+def generate_output(conversation: str, prompt: str) -> str:
+    # a plausible reply to the last message - category feedback in the requested JSON format, quoting real words from the
+    # submission so the server's highlight matching does realistic work, or a transcription
+    for category, marker in CATEGORY_MARKERS:
+        if marker in prompt:
+            break
+    else:
+        if 'transcribe' in prompt.lower():
+            return TRANSCRIPTION
+        return 'OK'
+    submission = conversation.split('Student submission', 1)[-1]
+    words = list(dict.fromkeys(re.findall(r"\b[A-Za-z]{7,}\b", submission)))
+    if category == 'SPaG':
+        bullets = [f"- `{word} -> {word.lower()}`" for word in words[:4]]
+    elif category == 'historical_accuracy':
+        phrases = re.findall(r"\b[A-Za-z]+ [A-Za-z]+ [A-Za-z]+\b", submission)
+        bullets = [f"- `{phrase} -> check this against the sources`" for phrase in phrases[1:3]]
+    elif category == 'overall_comments':
+        bullets = ["- `You explain the consequences clearly, but could support them with more specific evidence.`",
+                   "- `Link each consequence back to the question to strengthen your analysis.`"]
+    else:
+        bullets = ["- `I would award 6 out of 8 marks (3 for AO1 and 3 for AO2).`"]
+    return json.dumps({category: bullets})
+
+def get_chunks(text: str) -> List[str]:
+    return [text[i:i + CHUNK_CHARS] for i in range(0, len(text), CHUNK_CHARS)] or ['']
+
+def count_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+class MockState:
+    # in-memory assistants/threads/runs, shared by every request to one mock server
+    def __init__(self, latency: float, token_delay: float, error_rate: float, error_status: int, poll_ms: int, seed: Optional[int],
+                 retry_after: Optional[float] = None):
+        self.latency = latency
+        self.token_delay = token_delay
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.poll_ms = poll_ms
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.threads = {}
+        self.runs = {}
+        self.stats = {"requests": 0, "model_calls": 0, "injected_errors": 0}
+
+    def should_fail(self) -> bool:
+        with self.lock:
+            self.stats['model_calls'] += 1
+            if self.error_rate and self.random.random() < self.error_rate:
+                self.stats['injected_errors'] += 1
+                return True
+        return False
+
+    def generation_seconds(self, output: str) -> float:
+        return self.latency + self.token_delay * len(get_chunks(output))
+
+def new_id(prefix: str) -> str:
+    return f'{prefix}_{uuid.uuid4().hex[:24]}'
+
+class MockProviderHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    state: MockState = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_HEAD(self):
+        # connection prewarm requests
+        self.send_response(404)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def _dispatch(self, method: str):
+        with self.state.lock:
+            self.state.stats['requests'] += 1
+        url = urlparse(self.path)
+        body = self._body = self._read_body()
+        path = url.path.rstrip('/')
+        routes = [
+            ('POST', r'/v1/messages', self._anthropic_messages),
+            ('POST', r'/v1/chat/completions', self._chat_completions),
+            ('GET', r'/v1/assistants', lambda: self._send_json({"object": "list", "data": [], "has_more": False})),
+            ('POST', r'/v1/assistants', lambda: self._send_json(self._assistant(new_id('asst'), body))),
+            ('GET', r'/v1/assistants/([^/]+)', lambda id: self._send_json(self._assistant(id, {}))),
+            ('POST', r'/v1/files', lambda: self._send_json({"id": new_id('file'), "object": "file", "bytes": len(body), "created_at": int(time.time()),
+                                                            "filename": "upload", "purpose": "assistants", "status": "processed"})),
+            ('POST', r'/v1/vector_stores', lambda: self._send_json(self._vector_store(new_id('vs')))),
+            ('GET', r'/v1/vector_stores/([^/]+)', lambda id: self._send_json(self._vector_store(id))),
+            ('POST', r'/v1/vector_stores/([^/]+)/files', lambda id: self._send_json(self._vector_store_file(id, json.loads(body or b'{}').get('file_id')))),
+            ('GET', r'/v1/vector_stores/([^/]+)/files/([^/]+)', lambda id, file_id: self._send_json(self._vector_store_file(id, file_id))),
+            ('POST', r'/v1/threads', lambda: self._create_thread(json.loads(body or b'{}'))),
+            ('POST', r'/v1/threads/([^/]+)/messages', lambda id: self._create_message(id, json.loads(body or b'{}'))),
+            ('GET', r'/v1/threads/([^/]+)/messages', lambda id: self._list_messages(id, parse_qs(url.query).get('run_id', [None])[0])),
+            ('POST', r'/v1/threads/([^/]+)/runs', lambda id: self._create_run(id, json.loads(body or b'{}'))),
+            ('GET', r'/v1/threads/([^/]+)/runs/([^/]+)', lambda thread_id, run_id: self._retrieve_run(run_id)),
+        ]
+        for route_method, pattern, handle in routes:
+            match = re.fullmatch(pattern, path)
+            if match and route_method == method:
+                try:
+                    handle(*match.groups())
+                except (BrokenPipeError, ConnectionResetError):
+                    self.close_connection = True
+                return
+        self._send_json({"error": {"message": f"Not mocked: {method} {path}", "type": "invalid_request_error"}}, 404)
+
+    def _read_body(self) -> bytes:
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _send_json(self, data: Dict[str, Any], status: int = 200, headers: Optional[Dict[str, str]] = None):
+        payload = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _send_error(self):
+        retry_after = self.state.retry_after if self.state.retry_after is not None else (1 if self.state.error_status == 429 else None)
+        self._send_json({"error": {"message": "Injected mock provider error", "type": "server_error"}, "type": "error"},
+                        self.state.error_status, {"retry-after": f'{retry_after:g}'} if retry_after is not None else None)
+
+    def _start_stream(self):
+        # chunked encoding, so the connection stays open for reuse after the stream ends
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+    def _send_event(self, data: Any, event: Optional[str] = None):
+        text = (f'event: {event}\n' if event else '') + f'data: {data if isinstance(data, str) else json.dumps(data)}\n\n'
+        payload = text.encode('utf-8')
+        self.wfile.write(f'{len(payload):x}\r\n'.encode('ascii') + payload + b'\r\n')
+        self.wfile.flush()
+
+    def _end_stream(self):
+        self.wfile.write(b'0\r\n\r\n')
+        self.wfile.flush()
+
+    def _stream_chunks(self, output: str, send_chunk):
+        time.sleep(self.state.latency)
+        for chunk in get_chunks(output):
+            time.sleep(self.state.token_delay)
+            send_chunk(chunk)
+
+    # chat completions
+
+    def _chat_completions(self):
+        request = json.loads(self._body or b'{}')
+        if self.state.should_fail():
+            return self._send_error()
+        messages = request.get('messages', [])
+        conversation = '\n'.join(get_text(message.get('content')) for message in messages)
+        output = generate_output(conversation, get_text(messages[-1].get('content')) if messages else '')
+        usage = {"prompt_tokens": count_tokens(conversation), "completion_tokens": count_tokens(output), "total_tokens": 0}
+        usage['total_tokens'] = usage['prompt_tokens'] + usage['completion_tokens']
+        completion_id = new_id('chatcmpl')
+        base = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": request.get('model')}
+        if not request.get('stream'):
+            time.sleep(self.state.generation_seconds(output))
+            return self._send_json({**base, "object": "chat.completion", "usage": usage,
+                                    "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": output}}]})
+        self._start_stream()
+        self._stream_chunks(output, lambda chunk: self._send_event({**base, "choices": [{"index": 0, "delta": {"content": chunk}, "finish_reason": None}]}))
+        self._send_event({**base, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+        if (request.get('stream_options') or {}).get('include_usage'):
+            self._send_event({**base, "choices": [], "usage": usage})
+        self._send_event('[DONE]')
+        self._end_stream()
+
+    # assistants
+
+    def _assistant(self, assistant_id: str, request: Any) -> Dict[str, Any]:
+        request = json.loads(request) if isinstance(request, bytes) else request
+        return {"id": assistant_id, "object": "assistant", "created_at": int(time.time()), "name": request.get('name', assistant_id),
+                "model": request.get('model', 'gpt-4o'), "instructions": request.get('instructions', ''), "tools": request.get('tools', []),
+                "tool_resources": request.get('tool_resources', {}), "metadata": request.get('metadata', {}), "temperature": request.get('temperature')}
+
+    def _vector_store(self, vector_store_id: str) -> Dict[str, Any]:
+        return {"id": vector_store_id, "object": "vector_store", "created_at": int(time.time()), "name": vector_store_id, "usage_bytes": 0,
+                "status": "completed", "file_counts": {"in_progress": 0, "completed": 1, "failed": 0, "cancelled": 0, "total": 1}}
+
+    def _vector_store_file(self, vector_store_id: str, file_id: str) -> Dict[str, Any]:
+        return {"id": file_id, "object": "vector_store.file", "created_at": int(time.time()), "vector_store_id": vector_store_id,
+                "status": "completed", "usage_bytes": 0, "last_error": None}
+
+    def _message(self, thread_id: str, role: str, text: str, run_id: Optional[str] = None) -> Dict[str, Any]:
+        return {"id": new_id('msg'), "object": "thread.message", "created_at": int(time.time()), "thread_id": thread_id, "role": role, "run_id": run_id,
+                "status": "completed", "content": [{"type": "text", "text": {"value": text, "annotations": []}}]}
+
+    def _create_thread(self, request: Dict[str, Any]):
+        thread_id = new_id('thread')
+        with self.state.lock:
+            self.state.threads[thread_id] = [self._message(thread_id, message.get('role', 'user'), get_text(message.get('content')))
+                                             for message in request.get('messages', [])]
+        self._send_json({"id": thread_id, "object": "thread", "created_at": int(time.time()), "metadata": {}})
+
+    def _create_message(self, thread_id: str, request: Dict[str, Any]):
+        message = self._message(thread_id, request.get('role', 'user'), get_text(request.get('content')))
+        with self.state.lock:
+            self.state.threads.setdefault(thread_id, []).append(message)
+        self._send_json(message)
+
+    def _list_messages(self, thread_id: str, run_id: Optional[str]):
+        with self.state.lock:
+            messages = [message for message in self.state.threads.get(thread_id, []) if not run_id or message['run_id'] == run_id]
+        self._send_json({"object": "list", "data": list(reversed(messages)), "has_more": False})
+
+    def _run(self, run: Dict[str, Any]) -> Dict[str, Any]:
+        completed = time.time() >= run['completes_at']
+        return {"id": run['id'], "object": "thread.run", "created_at": int(run['created_at']), "thread_id": run['thread_id'],
+                "assistant_id": run['assistant_id'], "status": "completed" if completed else "in_progress",
+                "usage": run['usage'] if completed else None}
+
+    def _create_run(self, thread_id: str, request: Dict[str, Any]):
+        if self.state.should_fail():
+            return self._send_error()
+        with self.state.lock:
+            messages = list(self.state.threads.get(thread_id, []))
+        texts = [''.join(content['text']['value'] for content in message['content'] if content.get('type') == 'text') for message in messages]
+        output = generate_output('\n'.join(texts), texts[-1] if texts else '')
+        run = {"id": new_id('run'), "thread_id": thread_id, "assistant_id": request.get('assistant_id'), "created_at": time.time(),
+               "completes_at": time.time() + self.state.generation_seconds(output),
+               "usage": {"prompt_tokens": count_tokens('\n'.join(texts)), "completion_tokens": count_tokens(output), "total_tokens": 0}}
+        reply = self._message(thread_id, 'assistant', output, run['id'])
+        with self.state.lock:
+            self.state.runs[run['id']] = run
+            self.state.threads.setdefault(thread_id, []).append(reply)
+        if not request.get('stream'):
+            return self._send_json(self._run({**run, "completes_at": float('inf')}), headers={"openai-poll-after-ms": str(self.state.poll_ms)})
+
+        self._start_stream()
+        self._send_event(self._run({**run, "completes_at": float('inf')}), 'thread.run.created')
+        self._send_event({**reply, "status": "in_progress", "content": []}, 'thread.message.created')
+        self._stream_chunks(output, lambda chunk: self._send_event({"id": reply['id'], "object": "thread.message.delta", "delta": {
+            "content": [{"index": 0, "type": "text", "text": {"value": chunk, "annotations": []}}]}}, 'thread.message.delta'))
+        self._send_event(reply, 'thread.message.completed')
+        self._send_event(self._run({**run, "completes_at": 0}), 'thread.run.completed')
+        self._send_event('[DONE]', 'done')
+        self._end_stream()
+
+    def _retrieve_run(self, run_id: str):
+        with self.state.lock:
+            run = self.state.runs.get(run_id)
+        if not run:
+            return self._send_json({"error": {"message": f"No run found with id '{run_id}'", "type": "invalid_request_error"}}, 404)
+        self._send_json(self._run(run), headers={"openai-poll-after-ms": str(self.state.poll_ms)})
+
+    # anthropic messages
+
+    def _anthropic_messages(self):
+        request = json.loads(self._body or b'{}')
+        if self.state.should_fail():
+            return self._send_error()
+        messages = request.get('messages', [])
+        conversation = '\n'.join(get_text(message.get('content')) for message in messages)
+        output = generate_output(conversation, get_text(messages[-1].get('content')) if messages else '')
+        if request.get('max_tokens') == 1:
+            output = 'OK'
+        usage = {"input_tokens": count_tokens(conversation), "output_tokens": count_tokens(output)}
+        message = {"id": new_id('msg'), "type": "message", "role": "assistant", "model": request.get('model'), "stop_reason": "end_turn",
+                   "stop_sequence": None, "content": [{"type": "text", "text": output}], "usage": usage}
+        if not request.get('stream'):
+            time.sleep(self.state.generation_seconds(output))
+            return self._send_json(message)
+        self._start_stream()
+        self._send_event({"type": "message_start", "message": {**message, "content": [], "stop_reason": None, "usage": {**usage, "output_tokens": 1}}}, 'message_start')
+        self._send_event({"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}}, 'content_block_start')
+        self._stream_chunks(output, lambda chunk: self._send_event({"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": chunk}},
+                                                                   'content_block_delta'))
+        self._send_event({"type": "content_block_stop", "index": 0}, 'content_block_stop')
+        self._send_event({"type": "message_delta", "delta": {"stop_reason": "end_turn", "stop_sequence": None}, "usage": {"output_tokens": usage['output_tokens']}},
+                         'message_delta')
+        self._send_event({"type": "message_stop"}, 'message_stop')
+        self._end_stream()
+
+class MockHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients closing idle keep-alive connections isn't an error
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+class MockProviderServer:
+    # runs the mock apis on a background thread - use base_url (the same server answers for both providers)
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: float = 0.5, token_delay: float = 0.01, error_rate: float = 0.0,
+                 error_status: int = 500, poll_ms: int = 100, seed: Optional[int] = None, retry_after: Optional[float] = None):
+        self.state = MockState(latency, token_delay, error_rate, error_status, poll_ms, seed, retry_after)
+        handler = type('BoundMockProviderHandler', (MockProviderHandler,), {"state": self.state})
+        self.server = MockHTTPServer((host, port), handler)
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def get_env(self) -> Dict[str, str]:
+        # environment for a server process using these mocks instead of the real apis
+        return {"OPENAI_BASE_URL": f'{self.base_url}/v1', "ANTHROPIC_BASE_URL": self.base_url, "OPENAI_API_KEY": 'mock', "ANTHROPIC_API_KEY": 'mock'}
+
+    def start(self) -> 'MockProviderServer':
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve mock OpenAI/Anthropic apis for local benchmarking')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency', type=float, default=0.5, help='seconds before the first token of every model call')
+    parser.add_argument('--token-delay', type=float, default=0.01, help=f'seconds per streamed chunk of {CHUNK_CHARS} characters')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of model calls that fail')
+    parser.add_argument('--error-status', type=int, default=500, help='http status of injected errors (eg 429, 500, 529)')
+    parser.add_argument('--retry-after', type=float, help='Retry-After seconds sent with injected errors (default: 1 for 429s, otherwise none)')
+    parser.add_argument('--poll-ms', type=int, default=100, help='assistant run polling interval suggested to the sdk')
+    parser.add_argument('--seed', type=int)
+    options = parser.parse_args()
+
+    server = MockProviderServer(options.host, options.port, options.latency, options.token_delay, options.error_rate, options.error_status,
+                                options.poll_ms, options.seed, options.retry_after)
+    print('mock providers listening:', ' '.join(f'{key}={value}' for key, value in server.get_env().items() if key.endswith('BASE_URL')))
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(json.dumps(server.state.stats), file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
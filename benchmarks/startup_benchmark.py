@@ -0,0 +1,90 @@
+# benchmarks/startup_benchmark.py
+
+# measures server cold start - how long `import app` takes, the time to the first response, and which heavy libraries were loaded
+# along the way - in fresh interpreters, so regressions in startup cost get caught, eg:
+#   python benchmarks/startup_benchmark.py --runs 5 --max-import-ms 800
+# the first feedback request uses the offline 'stub' provider, so this needs no api keys and makes no network calls
+
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+from typing import Dict, Any, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MARK_SCHEME = os.path.join(ROOT, 'example_files', 'GCSE_History', '8 marks', 'O26Q1_MS.pdf')
+# libraries that should only be loaded by the requests that need them
+HEAVY_MODULES = ['openai', 'anthropic', 'fitz', 'PIL', 'rich', 'httpx']
+
+# runs in a new interpreter for every measurement, so nothing is already imported or cached
+PROBE = '''
+import sys, json, time, warnings
+warnings.simplefilter('ignore')
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+client = app.app.test_client()
+response = client.get('/')
+first_response = time.perf_counter()
+loaded_at_first_response = [module for module in HEAVY_MODULES if module in sys.modules]
+with open(MARK_SCHEME, 'rb') as mark_scheme:
+    feedback = client.post('/api/feedback', data={
+        'assignment_id': 'startup', 'assignment_title': 'Startup', 'question_id': '1', 'question_title': 'Startup',
+        'subject': 'History', 'qualification': 'GCSE', 'feedback_category': 'SPaG', 'model': 'stub', 'temperature': '1',
+        'submission': 'In 1979 the Soviet Union invaded Afganistan.', 'mark_scheme': (mark_scheme, 'mark_scheme.pdf')
+    })
+first_feedback = time.perf_counter()
+print(json.dumps({
+    "import_ms": (imported - start) * 1000,
+    "first_response_ms": (first_response - start) * 1000,
+    "first_feedback_ms": (first_feedback - start) * 1000,
+    "status": [response.status_code, feedback.status_code],
+    "loaded_at_first_response": loaded_at_first_response,
+    "loaded_at_first_feedback": [module for module in HEAVY_MODULES if module in sys.modules]
+}))
+'''
+
+def run_probe() -> Dict[str, Any]:
+    env = dict(os.environ, ENABLE_STUB_PROVIDER='true', PRELOAD_HANDLERS='')
+    code = f'HEAVY_MODULES = {HEAVY_MODULES!r}\nMARK_SCHEME = {MARK_SCHEME!r}\n' + PROBE
+    output = subprocess.run([sys.executable, '-c', code], cwd=ROOT, env=env, capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def summarise(runs: List[Dict[str, Any]]) -> Dict[str, Any]:
+    summary = {"runs": len(runs)}
+    for key in ('import_ms', 'first_response_ms', 'first_feedback_ms'):
+        values = sorted(run[key] for run in runs)
+        summary[key] = {
+            "median": round(statistics.median(values), 1),
+            "min": round(values[0], 1),
+            "max": round(values[-1], 1)
+        }
+    summary["loaded_at_first_response"] = runs[-1]["loaded_at_first_response"]
+    summary["loaded_at_first_feedback"] = runs[-1]["loaded_at_first_feedback"]
+    summary["status"] = runs[-1]["status"]
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure server import time and time to first response in fresh interpreters')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--max-import-ms', type=float, help='exit with an error if the median import time is above this')
+    parser.add_argument('--output', help='also write the results to this JSON file')
+    options = parser.parse_args()
+
+    summary = summarise([run_probe() for _ in range(options.runs)])
+    print(f"import app: {summary['import_ms']['median']:.0f}ms, first response: {summary['first_response_ms']['median']:.0f}ms, "
+          f"first feedback (stub): {summary['first_feedback_ms']['median']:.0f}ms (median of {summary['runs']})")
+    print(f"loaded by the first response: {', '.join(summary['loaded_at_first_response']) or 'none'}; "
+          f"by the first feedback: {', '.join(summary['loaded_at_first_feedback']) or 'none'}")
+    if options.output:
+        with open(options.output, 'w') as file:
+            json.dump(summary, file, indent=2)
+    if summary['status'] != [200, 200]:
+        sys.exit(f"unexpected response status: {summary['status']}")
+    if options.max_import_ms and summary['import_ms']['median'] > options.max_import_ms:
+        sys.exit(f"import time {summary['import_ms']['median']:.0f}ms is above the {options.max_import_ms:.0f}ms limit")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+# cache_store.py
+
+import os
+import copy
+import json
+import time
+import hashlib
+import inspect
+import functools
+import threading
+from collections import OrderedDict
+from typing import Any, Optional, Dict, List, Callable
+from utils import file_sha256
+
+class TieredCache:
+    # two-tier cache for JSON-serialisable values: a bounded in-memory LRU in front of an on-disk store,
+    # with the least recently used disk entries evicted once the store grows past max_disk_bytes.
+    # entries older than ttl_seconds (if set) are treated as missing and removed when next read. the memory tier can also be
+    # limited by max_memory_bytes - the bytes/str data its values hold, for caches of large binary values (eg rendered pages)
+    def __init__(self, name: str, max_items: int, disk_dir: Optional[str], max_disk_bytes: int, ttl_seconds: Optional[int] = None,
+                 max_memory_bytes: Optional[int] = None):
+        self.name = name
+        self.max_items = max_items
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl_seconds = ttl_seconds
+        self.max_memory_bytes = max_memory_bytes
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self._disk_bytes = None
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            if key in self._memory:
+                value, stored_at = self._memory[key]
+                if not self._is_expired(stored_at):
+                    self._memory.move_to_end(key)
+                    self.stats['memory_hits'] += 1
+                    return value
+                self._pop_memory(key)
+        value, stored_at = self._read_disk(key)
+        with self._lock:
+            if value is None:
+                self.stats['misses'] += 1
+                return None
+            self.stats['disk_hits'] += 1
+            self._set_memory(key, value, stored_at)
+        return value
+
+    def set(self, key: str, value: Any):
+        stored_at = time.time()
+        with self._lock:
+            self._set_memory(key, value, stored_at)
+        self._write_disk(key, value, stored_at)
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+            if self.disk_dir and os.path.isdir(self.disk_dir):
+                for filename in os.listdir(self.disk_dir):
+                    os.remove(os.path.join(self.disk_dir, filename))
+            self._disk_bytes = 0
+
+    def _is_expired(self, stored_at: float) -> bool:
+        return bool(self.ttl_seconds) and time.time() - stored_at > self.ttl_seconds
+
+    def _set_memory(self, key: str, value: Any, stored_at: float):
+        if key in self._memory:
+            self._pop_memory(key)
+        size = get_value_bytes(value)
+        if self.max_memory_bytes is not None and size > self.max_memory_bytes:
+            # a value bigger than the whole memory tier isn't kept there, rather than evicting everything else for it
+            return
+        self._memory[key] = (value, stored_at)
+        self._memory_bytes += size
+        # least recently used first
+        while len(self._memory) > self.max_items or (self.max_memory_bytes is not None and self._memory_bytes > self.max_memory_bytes):
+            self._pop_memory(next(iter(self._memory)))
+
+    def _pop_memory(self, key: str):
+        value, _ = self._memory.pop(key)
+        self._memory_bytes -= get_value_bytes(value)
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, hashlib.sha256(key.encode('utf-8')).hexdigest() + '.json')
+
+    def _read_disk(self, key: str):
+        if not self.disk_dir:
+            return None, None
+        path = self._disk_path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                entry = json.load(file)
+        except (OSError, ValueError):
+            return None, None
+        if entry.get('key') != key:
+            return None, None
+        stored_at = entry.get('stored_at') or os.path.getmtime(path)
+        if self._is_expired(stored_at):
+            self._remove_disk(path)
+            with self._lock:
+                self.stats['expirations'] += 1
+            return None, None
+        # bump the mtime so eviction treats this entry as recently used
+        os.utime(path)
+        return entry['value'], stored_at
+
+    def _remove_disk(self, path: str):
+        with self._lock:
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+            except OSError:
+                return
+            if self._disk_bytes is not None:
+                self._disk_bytes -= size
+
+    def _write_disk(self, key: str, value: Any, stored_at: float):
+        if not self.disk_dir:
+            return
+        os.makedirs(self.disk_dir, exist_ok=True)
+        path = self._disk_path(key)
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump({"key": key, "value": value, "stored_at": stored_at}, file)
+        with self._lock:
+            disk_bytes = self._get_disk_bytes()
+            previous_size = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(tmp_path, path)
+            self._disk_bytes = disk_bytes - previous_size + os.path.getsize(path)
+            if self._disk_bytes > self.max_disk_bytes:
+                self._evict_disk()
+
+    def _get_disk_bytes(self) -> int:
+        # only walk the directory once, after that the running total is kept up to date on write/evict
+        if self._disk_bytes is None:
+            self._disk_bytes = sum(entry.stat().st_size for entry in os.scandir(self.disk_dir) if entry.name.endswith('.json'))
+        return self._disk_bytes
+
+    def _evict_disk(self):
+        entries = sorted((entry for entry in os.scandir(self.disk_dir) if entry.name.endswith('.json')), key=lambda entry: entry.stat().st_mtime)
+        for entry in entries:
+            if self._disk_bytes <= self.max_disk_bytes:
+                break
+            size = entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except OSError:
+                continue
+            self._disk_bytes -= size
+            self.stats['evictions'] += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"name": self.name, "memory_items": len(self._memory), "memory_bytes": self._memory_bytes, "disk_bytes": self._disk_bytes, **self.stats}
+
+def get_value_bytes(value: Any) -> int:
+    # the bytes and text held by a cached value (lists/tuples/dicts of them, eg rendered pages as (media type, bytes) pairs)
+    if isinstance(value, (bytes, bytearray, str)):
+        return len(value)
+    if isinstance(value, (list, tuple)):
+        return sum(get_value_bytes(item) for item in value)
+    if isinstance(value, dict):
+        return sum(get_value_bytes(item) for item in value.values())
+    return 0
+
+# transcriptions of uploaded submission files, keyed by provider, model and file content hash
+transcription_cache = TieredCache(
+    'transcription',
+    max_items=int(os.getenv('TRANSCRIPTION_CACHE_ITEMS', 256)),
+    disk_dir=os.getenv('TRANSCRIPTION_CACHE_DIR', '/tmp/transcription_cache'),
+    max_disk_bytes=int(os.getenv('TRANSCRIPTION_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+)
+
+def transcription_key(provider: str, model: str, file_sha256: str) -> str:
+    return f'{provider}:{model}:{file_sha256}'
+
+# complete feedback responses for identical (near-deterministic) requests, eg a teacher re-opening the same script
+RESULT_CACHE_MAX_TEMPERATURE = float(os.getenv('RESULT_CACHE_MAX_TEMPERATURE', 0.01))
+RESULT_CACHE_ENABLED = os.getenv('RESULT_CACHE_ENABLED', 'true').lower() == 'true'
+# bump to invalidate every cached result by hand - prompt/formatting code changes already invalidate them automatically
+PROMPT_VERSION = os.getenv('FEEDBACK_PROMPT_VERSION', '1')
+
+result_cache = TieredCache(
+    'result',
+    max_items=int(os.getenv('RESULT_CACHE_ITEMS', 256)),
+    disk_dir=os.getenv('RESULT_CACHE_DIR', '/tmp/result_cache'),
+    max_disk_bytes=int(os.getenv('RESULT_CACHE_MAX_BYTES', 64 * 1024 * 1024)),
+    ttl_seconds=int(os.getenv('RESULT_CACHE_TTL_SECONDS', 7 * 24 * 60 * 60))
+)
+
+@functools.lru_cache(maxsize=None)
+def get_prompt_version(handler_class: type, prompt_sources: tuple) -> str:
+    # hash of the source of everything that shapes a response (the prompt builders and output formatting, by method or module
+    # name), so any edit to a prompt gets a new version and old cached results are never served for it
+    sources = [PROMPT_VERSION]
+    for name in prompt_sources:
+        source = getattr(handler_class, name, None) or __import__(name)
+        sources.append(inspect.getsource(source))
+    return hashlib.sha256('\n'.join(sources).encode('utf-8')).hexdigest()[:16]
+
+def cached_feedback(provider: str, model: str, prompt_sources: List[str]):
+    # decorator for a handler's generate_feedback - identical requests at (near) zero temperature return the cached response,
+    # keyed by provider, model, engine, categories, prompt version, the other prompt inputs and the mark scheme/submission hashes
+    def decorator(generate_feedback: Callable) -> Callable:
+        signature = inspect.signature(generate_feedback)
+
+        @functools.wraps(generate_feedback)
+        def wrapper(self, *args, **kwargs):
+            request = signature.bind(self, *args, **kwargs)
+            request.apply_defaults()
+            request = request.arguments
+            # requests continuing an existing thread may not send the submission, so there's nothing to key them on
+            if not RESULT_CACHE_ENABLED or not request.get('submission') or float(request['temperature']) > RESULT_CACHE_MAX_TEMPERATURE:
+                return generate_feedback(self, *args, **kwargs)
+
+            categories = request['feedback_category'] if isinstance(request['feedback_category'], list) else [request['feedback_category']]
+            prompt_inputs = {field: request[field] for field in ('assignment_title', 'question_title', 'subject', 'qualification', 'max_completion_tokens', 'temperature')}
+            key = ':'.join([
+                provider,
+                model,
+                request.get('engine') or '',
+                ','.join(categories),
+                get_prompt_version(type(self), tuple(prompt_sources)),
+                file_sha256(request['mark_scheme']),
+                file_sha256(request['submission']),
+                hashlib.sha256(json.dumps(prompt_inputs, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+            ])
+            # results are copied in and out of the cache, so callers adding to a response (eg its rendered submission) can't
+            # change what later requests get
+            result = result_cache.get(key)
+            if result is not None:
+                print('feedback result cached')
+                return copy.deepcopy(result)
+            result = generate_feedback(self, *args, **kwargs)
+            # only complete responses are cached, so a truncated or partly failed one is retried next time - as is one whose file
+            # submission transcribed to nothing
+            if result.get('status') == 'completed' and (result.get('submission') or not os.path.isfile(request['submission'])):
+                result_cache.set(key, copy.deepcopy(result))
+            return result
+        return wrapper
+    return decorator
@@ -0,0 +1,185 @@
+# feedback_fanout.py
+
+import queue
+import contextvars
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Callable, Optional, Union, Iterator, Tuple, Set
+from highlight_matching import find_highlights, parse_bullet, split_correction
+from resilience import ProviderError
+
+FEEDBACK_CATEGORIES = ['SPaG', 'historical_accuracy', 'overall_comments', 'marking']
+# categories whose bullets are 'incorrect -> correct' pairs highlighted in the submission (the others are comments)
+HIGHLIGHT_CATEGORIES = ['SPaG', 'historical_accuracy']
+# each category's named colour, with the hex highlight background and text colours alongside it
+CATEGORY_COLOURS = {
+    "SPaG": {"colour": "orange", "background_colour": "FFBF00", "text_colour": "EC4E02"},
+    "historical_accuracy": {"colour": "blue", "background_colour": "02FFFF", "text_colour": "163E64"},
+    "overall_comments": {"colour": "green", "background_colour": "02FF5A", "text_colour": "12501B"},
+    "marking": {"colour": "purple", "background_colour": "FF4CFE", "text_colour": "501649"},
+}
+
+def parse_feedback_categories(value: Union[str, List[str]]) -> List[str]:
+    # accepts a single category, a comma-separated list of categories, or 'all'
+    if isinstance(value, str):
+        value = value.split(',')
+    categories = []
+    for category in (c.strip() for c in value):
+        if not category:
+            continue
+        if category.lower() == 'all':
+            return list(FEEDBACK_CATEGORIES)
+        if category not in FEEDBACK_CATEGORIES:
+            raise ValueError(f"Invalid feedback_category: {category} (must be one of {FEEDBACK_CATEGORIES} or 'all')")
+        if category not in categories:
+            categories.append(category)
+    if not categories:
+        raise ValueError("Missing required field: feedback_category")
+    return categories
+
+# called with (category, result) as each category of a fan_out finishes, eg so a queued job can save partial results
+_category_done = contextvars.ContextVar('category_done', default=None)
+
+@contextmanager
+def on_category_done(callback: Callable[[str, Any], None]):
+    token = _category_done.set(callback)
+    try:
+        yield
+    finally:
+        _category_done.reset(token)
+
+def get_category_done() -> Optional[Callable[[str, Any], None]]:
+    return _category_done.get()
+
+def fan_out(fn: Callable[[str], Any], categories: List[str], max_workers: Optional[int] = None) -> Dict[str, Any]:
+    # run fn once per category concurrently - results (or the exception raised) are returned keyed by category, in request order
+    def run(category: str) -> Any:
+        result = fn(category)
+        callback = _category_done.get()
+        if callback:
+            callback(category, result)
+        return result
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers or len(categories)) as executor:
+        # each category runs in a copy of the caller's context, so the request's deadline (resilience.py) applies to it too
+        futures = {category: executor.submit(contextvars.copy_context().run, run, category) for category in categories}
+        for category, future in futures.items():
+            try:
+                results[category] = future.result()
+            except Exception as e:
+                print(f'{category} query failed:', e)
+                results[category] = e
+    return results
+
+def merge_category_results(results: Dict[str, Any], submission: str) -> Dict[str, Any]:
+    feedback = []
+    categories = {}
+    for category, result in results.items():
+        if isinstance(result, Exception):
+            categories[category] = {"status": "failed", "error": str(result)}
+            continue
+        feedback.extend(result.get('feedback') or [])
+        categories[category] = {key: value for key, value in result.items() if key not in ('submission', 'feedback')}
+
+    if all(c['status'] == 'failed' for c in categories.values()):
+        # only a plain ValueError is about the request itself - anything else (an sdk error, an open circuit) is the provider's
+        input_error = all(isinstance(result, ValueError) and not isinstance(result, ProviderError) for result in results.values())
+        raise (ValueError if input_error else ProviderError)("; ".join(f"{category}: {c['error']}" for category, c in categories.items()))
+
+    merged = {
+        "status": "completed" if all(c['status'] == 'completed' for c in categories.values()) else "incomplete",
+        "submission": submission,
+        "feedback": feedback,
+        "categories": categories
+    }
+    usages = [c['usage'] for c in categories.values() if c.get('usage')]
+    if usages:
+        merged['usage'] = sum_usage(usages)
+    return merged
+
+def get_common_result(result: Dict[str, Any], provider: str, model: str, feedback_category: Union[str, List[str]]) -> Dict[str, Any]:
+    # the response shape every handler's generate_feedback shares (so the provider router can return any of them) - status,
+    # provider, model, submission, feedback, per-category results under 'categories', and summed 'usage' where the provider
+    # reports it. a single category's result also keeps its own fields (eg openai's assistant_id/thread_id) at the top level
+    if 'categories' not in result:
+        category = feedback_category[0] if isinstance(feedback_category, list) else feedback_category
+        result = {**result, "categories": {category: {key: value for key, value in result.items() if key not in ('submission', 'feedback')}}}
+    return {**result, "provider": provider, "model": model}
+
+def format_feedback_bullet(bullet: str, category: str, submission: str, seen: Optional[Set[Tuple[str, str]]] = None) -> List[Dict[str, Any]]:
+    # the feedback item every provider returns for one bullet of model output (as a list - empty if the bullet is unusable):
+    # category, incorrect_or_highlight, correct_or_feedback, citations, start/end (lists of the offsets of every match of the
+    # highlight in the submission, or None for comments) and the category's colours. corrections already in seen are skipped
+    bullet, citations = parse_bullet(bullet)
+    if category in HIGHLIGHT_CATEGORIES:
+        parts = split_correction(bullet)
+        if not parts:
+            print(f"Warning: LLM output correction '{bullet}' does not contain ' -> ' character")
+            return []
+        if seen is not None:
+            if parts in seen:
+                print(parts, 'already in unique_parts')
+                return []
+            seen.add(parts)
+        # the same span can be matched more than once - each is kept once, in the order found
+        spans = list(dict.fromkeys(find_highlights(parts[0], submission)))
+        return [{
+            'category': category,
+            'incorrect_or_highlight': parts[0],
+            'correct_or_feedback': parts[1],
+            'citations': citations,
+            'start': [start for start, _ in spans],
+            'end': [end for _, end in spans],
+            **CATEGORY_COLOURS[category],
+        }]
+    if category in CATEGORY_COLOURS:
+        return [{
+            'category': category,
+            'incorrect_or_highlight': None,
+            'correct_or_feedback': bullet.strip().strip('`').strip('...'),
+            'citations': citations,
+            'start': None,
+            'end': None,
+            **CATEGORY_COLOURS[category],
+        }]
+    print(f"Warning: Invalid category '{category}'")
+    return []
+
+def get_student_record(student_id: str, results: Dict[str, Any], submission: str) -> Dict[str, Any]:
+    # one line of a batch's JSONL results - the merged feedback for a student, or the error if every category failed
+    try:
+        return {"student_id": student_id, **merge_category_results(results, submission)}
+    except ValueError as e:
+        return {"student_id": student_id, "status": "failed", "error": str(e)}
+
+def sum_usage(usages: List[Dict[str, int]]) -> Dict[str, int]:
+    total = {}
+    for usage in usages:
+        for key, value in (usage or {}).items():
+            total[key] = total.get(key, 0) + (value or 0)
+    return total
+
+def fan_out_stream(fn: Callable[[str, Callable[[str, Dict[str, Any]], None]], None], categories: List[str]) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    # streaming counterpart of fan_out - fn(category, emit) runs once per category concurrently and calls emit(event, data)
+    # as results arrive, and the (event, data) pairs are yielded in the order they were emitted across all categories
+    events = queue.Queue()
+    def run(category: str):
+        try:
+            fn(category, lambda event, data: events.put((event, data)))
+        except Exception as e:
+            print(f'{category} query failed:', e)
+            events.put(('category_done', {"category": category, "status": "failed", "error": str(e)}))
+        finally:
+            events.put(None)
+
+    with ThreadPoolExecutor(max_workers=len(categories)) as executor:
+        for category in categories:
+            executor.submit(contextvars.copy_context().run, run, category)
+        remaining = len(categories)
+        while remaining:
+            event = events.get()
+            if event is None:
+                remaining -= 1
+            else:
+                yield event
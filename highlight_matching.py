@@ -0,0 +1,168 @@
+# highlight_matching.py
+
+import os
+import re
+import string
+from collections import deque
+from difflib import SequenceMatcher
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+# phrases with no exact (normalised) match are matched to the most similar run of words scoring at least this
+HIGHLIGHT_FUZZY_THRESHOLD = float(os.getenv('HIGHLIGHT_FUZZY_THRESHOLD', 0.85))
+HIGHLIGHT_FUZZY_MIN_CHARS = 4
+HIGHLIGHT_INDEX_CACHE_SIZE = 32
+
+# characters the llm commonly writes differently to the submission (smart quotes, dashes, ellipses) and invisible characters
+CHAR_MAP = {
+    '‘': "'", '’': "'", '‚': "'", '‛': "'", '′': "'", '`': "'",
+    '“': '"', '”': '"', '„': '"', '‟': '"', '″': '"',
+    '‐': '-', '‑': '-', '‒': '-', '–': '-', '—': '-', '―': '-', '−': '-',
+    '…': '...',
+    '​': '', '‌': '', '‍': '', '﻿': '', '­': '',
+}
+
+def normalize_text(text: str) -> Tuple[str, List[int]]:
+    # lower-cased text with quotes/dashes unified and every run of whitespace (including line breaks) collapsed to one space,
+    # plus the index in the original text of every normalised character so matches can be mapped back exactly
+    normalized, offsets = [], []
+    for i, char in enumerate(text):
+        if char.isspace():
+            if normalized and normalized[-1] != ' ':
+                normalized.append(' ')
+                offsets.append(i)
+            continue
+        for normalized_char in CHAR_MAP.get(char, char).casefold():
+            normalized.append(normalized_char)
+            offsets.append(i)
+    if normalized and normalized[-1] == ' ':
+        normalized.pop()
+        offsets.pop()
+    return ''.join(normalized), offsets
+
+def _is_word_char(char: str) -> bool:
+    return char.isalnum() or char == '_'
+
+class HighlightIndex:
+    # the normalised form of one submission, for finding every span of the original text that bullet phrases refer to
+    def __init__(self, submission: str):
+        self.submission = submission
+        self.normalized, self.offsets = normalize_text(submission)
+        self._words = None
+        self._matches = {}
+
+    def find(self, phrase: str) -> List[Tuple[int, int]]:
+        return self.find_all([phrase])[phrase]
+
+    def find_all(self, phrases: List[str]) -> Dict[str, List[Tuple[int, int]]]:
+        # (start, end) spans in the original submission for each phrase - every whole-word exact match (ignoring case, whitespace
+        # and quote/dash style), or failing that the single closest fuzzy match. all new phrases are matched in one pass
+        new_phrases = {phrase: normalize_text(phrase.strip())[0] for phrase in set(phrases) if phrase not in self._matches}
+        if new_phrases:
+            exact = self._find_exact(set(pattern for pattern in new_phrases.values() if pattern))
+            for phrase, pattern in new_phrases.items():
+                spans = exact.get(pattern) or self._find_fuzzy(pattern)
+                self._matches[phrase] = [(self.offsets[start], self.offsets[end - 1] + 1) for start, end in spans]
+        return {phrase: self._matches[phrase] for phrase in phrases}
+
+    def _find_exact(self, patterns: set) -> Dict[str, List[Tuple[int, int]]]:
+        # aho-corasick automaton over all the patterns, so the text is scanned once however many bullets there are
+        goto, fail, output = [{}], [0], [[]]
+        for pattern in patterns:
+            state = 0
+            for char in pattern:
+                if char not in goto[state]:
+                    goto.append({})
+                    fail.append(0)
+                    output.append([])
+                    goto[state][char] = len(goto) - 1
+                state = goto[state][char]
+            output[state].append(pattern)
+
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in goto[state].items():
+                queue.append(next_state)
+                fallback = fail[state]
+                while fallback and char not in goto[fallback]:
+                    fallback = fail[fallback]
+                fail[next_state] = goto[fallback].get(char, 0)
+                output[next_state] = output[next_state] + output[fail[next_state]]
+
+        text = self.normalized
+        matches = {pattern: [] for pattern in patterns}
+        state = 0
+        for i, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for pattern in output[state]:
+                start, end = i + 1 - len(pattern), i + 1
+                # whole words only, so a short correction like 'there' doesn't highlight inside 'therefore'
+                if _is_word_char(pattern[0]) and start > 0 and _is_word_char(text[start - 1]):
+                    continue
+                if _is_word_char(pattern[-1]) and end < len(text) and _is_word_char(text[end]):
+                    continue
+                matches[pattern].append((start, end))
+        return matches
+
+    def _find_fuzzy(self, pattern: str) -> List[Tuple[int, int]]:
+        # near-misses (eg a transcription slip or the llm 'correcting' the phrase it quotes) - compares the pattern against every
+        # run of about the same number of words, returning the best window if it is similar enough
+        if len(pattern) < HIGHLIGHT_FUZZY_MIN_CHARS:
+            return []
+        if self._words is None:
+            self._words = [(match.start(), match.end()) for match in re.finditer(r'\S+', self.normalized)]
+        word_count = len(pattern.split())
+        matcher = SequenceMatcher(autojunk=False)
+        matcher.set_seq2(pattern)
+        best = None
+        for size in range(max(1, word_count - 1), word_count + 2):
+            for i in range(len(self._words) - size + 1):
+                start, end = self._trim_punctuation(self._words[i][0], self._words[i + size - 1][1], pattern)
+                matcher.set_seq1(self.normalized[start:end])
+                if matcher.real_quick_ratio() < HIGHLIGHT_FUZZY_THRESHOLD or matcher.quick_ratio() < HIGHLIGHT_FUZZY_THRESHOLD:
+                    continue
+                ratio = matcher.ratio()
+                if ratio >= HIGHLIGHT_FUZZY_THRESHOLD and (best is None or ratio > best[0]):
+                    best = (ratio, start, end)
+        return [best[1:]] if best else []
+
+    def _trim_punctuation(self, start: int, end: int, pattern: str) -> Tuple[int, int]:
+        while start < end - 1 and self.normalized[start] in string.punctuation and self.normalized[start] != pattern[0]:
+            start += 1
+        while end > start + 1 and self.normalized[end - 1] in string.punctuation and self.normalized[end - 1] != pattern[-1]:
+            end -= 1
+        return start, end
+
+@lru_cache(maxsize=HIGHLIGHT_INDEX_CACHE_SIZE)
+def get_highlight_index(submission: str) -> HighlightIndex:
+    # one index per submission, shared by every bullet (including streamed bullets, which arrive one at a time)
+    return HighlightIndex(submission)
+
+def find_highlights(phrase: str, submission: str) -> List[Tuple[int, int]]:
+    return get_highlight_index(submission).find(phrase)
+
+def parse_bullet(bullet: str) -> Tuple[str, Optional[str]]:
+    # strips the bullet marker and any 【citation】, returning (text, citations)
+    bullet = bullet.strip('- ').strip()
+    match = re.search(r'【([^】]+)】', bullet)
+    if not match:
+        return bullet, None
+    return re.sub(r'【([^】]+)】', '', bullet).strip(), match.group(1)
+
+def split_correction(text: str) -> Optional[Tuple[str, str]]:
+    # 'incorrect -> correct' bullets, as (incorrect, correct) with the quoting the llm adds removed
+    parts = re.split(r' -> ', text, maxsplit=1)
+    if len(parts) != 2:
+        return None
+    return tuple(part.strip().strip('`').strip('...').strip("'") for part in parts)
+
+def get_correction_phrases(bullets: List[str]) -> List[str]:
+    phrases = []
+    for bullet in bullets:
+        correction = split_correction(parse_bullet(bullet)[0]) if isinstance(bullet, str) else None
+        if correction:
+            phrases.append(correction[0])
+    return phrases
@@ -1,7 +1,17 @@
-from rich.text import Text
-from rich.console import Console
+import sys
 import json
-from collections import defaultdict
+import html
+from collections import Counter
+from typing import Dict, Any, List, Tuple, Union
+
+# items have a named 'colour' and a hex 'background_colour' (responses saved before they had both may have only one)
+COLOURS = {
+    'orange': '#FFA500',
+    'blue': '#89CFF0',
+    'green': '#90EE90',
+    'purple': '#D8B4FE',
+}
+RENDER_FORMATS = ['html', 'ansi', 'runs']
 
 def blend_colors(colors):
     r = sum(int(c[1:3], 16) for c in colors) // len(colors)
@@ -9,68 +19,114 @@ def blend_colors(colors):
     b = sum(int(c[5:7], 16) for c in colors) // len(colors)
     return f'#{r:02x}{g:02x}{b:02x}'
 
-def highlight_text(json_feedback):
-    data = json.loads(json_feedback)
-    submission = data["submission"]
-    feedback = data["feedback"]
-    
-    text = Text(submission)
-    
-    # Create a list to store all highlighting instructions
+def get_colour(correction: Dict[str, Any]) -> str:
+    if correction.get("background_colour"):
+        return '#' + correction["background_colour"].lstrip('#')
+    color = correction.get("colour") or ''
+    return COLOURS.get(color.lower(), color if color.startswith('#') else '#FFFF00')
+
+def get_highlights(feedback: List[Dict[str, Any]], text_length: int) -> List[Tuple[int, int, str, str]]:
+    # (start, end, colour, category) for every highlighted span - start/end are lists (or ints, in older saved openai responses)
     highlights = []
-    
     for correction in feedback:
-        color = correction["colour"]
-        if color.lower() == 'orange':
-            color = '#FFA500'  # hex code for orange
-        elif color.lower() == 'blue':
-            color = '#89CFF0'
-        
         start = correction.get("start")
         end = correction.get("end")
-        
         if start is None or end is None:
             continue
-        
-        if isinstance(start, list) and isinstance(end, list):
-            for s, e in zip(start, end):
-                highlights.append((s, e, color))
-        elif isinstance(start, int) and isinstance(end, int):
-            highlights.append((start, end, color))
-    
-    # Sort highlights by start index
-    highlights.sort(key=lambda x: x[0])
-    
-    # Merge overlapping highlights
-    merged_highlights = defaultdict(list)
-    for start, end, color in highlights:
-        for i in range(start, end):
-            merged_highlights[i].append(color)
-    
-    # Apply merged highlights
-    current_color = None
-    start = None
-    
-    for i in range(len(submission)):
-        if i in merged_highlights:
-            new_color = blend_colors(merged_highlights[i])
-            if new_color != current_color:
-                if start is not None:
-                    text.stylize(f"on {current_color}", start, i)
-                start = i
-                current_color = new_color
-        elif current_color is not None:
-            text.stylize(f"on {current_color}", start, i)
-            start = None
-            current_color = None
-    
-    # Apply final highlight if it extends to the end
-    if start is not None:
-        text.stylize(f"on {current_color}", start, len(submission))
-    
-    Console().print(text)
+        spans = zip(start, end) if isinstance(start, list) and isinstance(end, list) else [(start, end)]
+        for s, e in spans:
+            s, e = max(0, s), min(e, text_length)
+            if s < e:
+                highlights.append((s, e, get_colour(correction), correction.get("category")))
+    return highlights
+
+def get_runs(submission: str, feedback: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    # splits the submission into consecutive runs of text that each have a single set of highlights, by sweeping over the sorted
+    # span endpoints - O(n log n) in the number of highlights however long they are. overlapping colours are blended
+    events = []
+    for start, end, color, category in get_highlights(feedback, len(submission)):
+        events.append((start, 1, color, category))
+        events.append((end, -1, color, category))
+    events.sort(key=lambda event: (event[0], event[1]))
+
+    runs = []
+    colors, categories = Counter(), Counter()
+    position = 0
+    for index, change, color, category in events:
+        if index > position:
+            runs.append(_get_run(submission, position, index, colors, categories))
+            position = index
+        colors[color] += change
+        categories[category] += change
+    if position < len(submission):
+        runs.append(_get_run(submission, position, len(submission), colors, categories))
+    return _merge_runs(runs)
+
+def _get_run(submission: str, start: int, end: int, colors: Counter, categories: Counter) -> Dict[str, Any]:
+    active_colors = list(colors.elements())
+    return {
+        "start": start,
+        "end": end,
+        "text": submission[start:end],
+        "colour": blend_colors(active_colors) if active_colors else None,
+        "categories": sorted(category for category, count in categories.items() if count > 0 and category)
+    }
+
+def _merge_runs(runs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    # neighbouring runs can end up identical, eg where one highlight ends exactly where another of the same colour starts
+    merged = []
+    for run in runs:
+        previous = merged[-1] if merged else None
+        if previous and previous["colour"] == run["colour"] and previous["categories"] == run["categories"]:
+            previous["end"] = run["end"]
+            previous["text"] += run["text"]
+        else:
+            merged.append(run)
+    return merged
 
-# example usage
+def render_rich(runs: List[Dict[str, Any]]) -> 'Text':
+    # rich is only imported for terminal output, so the server doesn't load it unless 'ansi' rendering is asked for
+    from rich.text import Text
+    text = Text()
+    for run in runs:
+        text.append(run["text"], style=f"on {run['colour']}" if run["colour"] else None)
+    return text
+
+def render_ansi(runs: List[Dict[str, Any]], width: int = 100) -> str:
+    from rich.console import Console
+    console = Console(force_terminal=True, color_system='truecolor', width=width)
+    with console.capture() as capture:
+        console.print(render_rich(runs))
+    return capture.get()
+
+def render_html(runs: List[Dict[str, Any]]) -> str:
+    parts = []
+    for run in runs:
+        text = html.escape(run["text"])
+        if run["colour"]:
+            text = f'<mark style="background-color: {run["colour"]}" data-categories="{" ".join(run["categories"])}">{text}</mark>'
+        parts.append(text)
+    return f'<div class="feedback-submission" style="white-space: pre-wrap">{"".join(parts)}</div>'
+
+def render_feedback(response: Dict[str, Any], render_format: str) -> Union[str, List[Dict[str, Any]]]:
+    # pre-renders a feedback response's submission with its highlights - 'html', 'ansi' (terminal escape codes) or the
+    # 'runs' themselves as JSON-ready dicts, for clients that do their own rendering
+    if render_format not in RENDER_FORMATS:
+        raise ValueError(f"Invalid render format: {render_format} (must be one of {RENDER_FORMATS})")
+    runs = get_runs(response.get("submission") or '', response.get("feedback") or [])
+    if render_format == 'html':
+        return render_html(runs)
+    if render_format == 'ansi':
+        return render_ansi(runs)
+    return runs
+
+def highlight_text(json_feedback):
+    from rich.console import Console
+    data = json.loads(json_feedback)
+    Console().print(render_rich(get_runs(data["submission"], data["feedback"])))
+
+# example response, printed when run directly - or pass a saved response and optionally a format, eg
+#   python highlight_text.py response.json html > response.html
 json_feedback = r'''
 {
     "feedback": [
@@ -269,4 +325,13 @@ json_feedback = r'''
     "submission": "Explain two consequences of the Soviet invasion of Afghanistan\n\nIn 1979, the Soviet Union's invasion of Afganistan seriously escalated\nCold War tensions even more. The USA got involved, supporting the\nAfgan Mujahidene by sending them weapons and financial aid to fight\nthe Soviets. This American support aimed to counter Soviet expansion,\nbut actually, it made the conflict in Afganistan much worse and more\ndrawn out, lasting until 1989 and creating a lot of instability in the area.\nIt's seen that this strategy by the USA, which intended to weaken\nSoviet influence, led to a prolonged war in Afganistan, causing\nextensive suffering and chaos.\n\nOn the economic side, the Soviet Union felt a massive strain because of\nthe war in Afganistan. Billions of dollars was poured into the military\ncampaign, and the Soviet economy, which was not very strong to begin\nwith, faced even more pressure. This was exacerbated by US economic\nsanctions. As war dragged on without a clear victory, disscontent grew\nwithin the Soviet Union. People began questioning the purpose and the\nhigh cost of continuing the war, leading to widespread critisicm of the\ngovernment. This financial drain and public disatisfaction was\nsignificantly weakened the Soviet Union's economic and political\nstability, contributing to its eventual decline and collapse."
 }
 '''
-highlight_text(json_feedback)
\ No newline at end of file
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], 'r', encoding='utf-8') as file:
+            json_feedback = file.read()
+    if len(sys.argv) > 2:
+        rendered = render_feedback(json.loads(json_feedback), sys.argv[2])
+        print(rendered if isinstance(rendered, str) else json.dumps(rendered, indent=2))
+    else:
+        highlight_text(json_feedback)
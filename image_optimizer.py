@@ -0,0 +1,179 @@
+# image_optimizer.py
+
+import io
+import os
+import math
+import contextvars
+from contextlib import contextmanager
+from typing import Dict, Any, List, Tuple, Optional
+from PIL import Image, ImageOps
+from cache_store import TieredCache
+from pdf_render import render_pdf_pages, MEDIA_TYPES, PDF_RENDER_FORMAT
+from utils import file_sha256
+from metrics import metrics, span
+
+# images sent to the providers (submission pages to transcribe, mark scheme pages, uploaded images) are cropped to their content,
+# converted to greyscale, sized to what the provider will actually use within a token budget and sent as whichever of jpeg or
+# png is smaller - IMAGE_OPTIMIZATION_ENABLED=false sends them as rendered/uploaded instead
+IMAGE_OPTIMIZATION_ENABLED = os.getenv('IMAGE_OPTIMIZATION_ENABLED', 'true').lower() == 'true'
+# estimated vision tokens allowed for one file's images, split evenly across its pages (requests can set their own with the
+# 'image_token_budget' field)
+IMAGE_TOKEN_BUDGET = int(os.getenv('IMAGE_TOKEN_BUDGET', 6000))
+# pdf pages are rendered at this resolution before being sized down, so small handwriting survives the resize
+IMAGE_SOURCE_DPI = int(os.getenv('IMAGE_SOURCE_DPI', 150))
+# images are never made smaller than this on their longest side to fit the budget, so text stays readable
+IMAGE_MIN_LONG_EDGE = int(os.getenv('IMAGE_MIN_LONG_EDGE', 1000))
+IMAGE_GREYSCALE = os.getenv('IMAGE_GREYSCALE', 'true').lower() == 'true'
+IMAGE_JPEG_QUALITY = int(os.getenv('IMAGE_JPEG_QUALITY', 85))
+# margins are cropped to the first pixels darker than this (0-255), leaving IMAGE_CROP_PADDING pixels around them
+IMAGE_CROP_THRESHOLD = int(os.getenv('IMAGE_CROP_THRESHOLD', 240))
+IMAGE_CROP_PADDING = int(os.getenv('IMAGE_CROP_PADDING', 16))
+
+# anthropic downscales images past 1568px on the long edge or ~1.15 megapixels and charges (width * height) / 750 tokens.
+# openai (high detail) fits images in 2048x2048, then scales the short side to 768px and charges 170 tokens per 512px tile plus 85
+ANTHROPIC_MAX_LONG_EDGE = 1568
+ANTHROPIC_MAX_PIXELS = 1150000
+ANTHROPIC_PIXELS_PER_TOKEN = 750
+OPENAI_MAX_LONG_EDGE = 2048
+OPENAI_MAX_SHORT_EDGE = 768
+OPENAI_TILE_SIZE = 512
+OPENAI_TOKENS_PER_TILE = 170
+OPENAI_BASE_TOKENS = 85
+
+# optimised pages are kept in memory only (keyed by file hash, provider and budget), like the rendered pages they come from -
+# up to IMAGE_CACHE_BYTES of images
+optimized_image_cache = TieredCache('optimized_images', max_items=int(os.getenv('IMAGE_CACHE_ITEMS', 64)), disk_dir=None, max_disk_bytes=0,
+                                    max_memory_bytes=int(os.getenv('IMAGE_CACHE_BYTES', 64 * 1024 * 1024)))
+
+# the budget is a context variable (like the request deadline in resilience.py), so it reaches the handlers' image calls at
+# any depth, including the threads pages are transcribed on
+_token_budget = contextvars.ContextVar('image_token_budget', default=None)
+
+@contextmanager
+def image_token_budget(tokens: Optional[int]):
+    # images sent inside this block are sized to fit tokens per file (None for IMAGE_TOKEN_BUDGET)
+    token = _token_budget.set(tokens)
+    try:
+        yield
+    finally:
+        _token_budget.reset(token)
+
+def get_token_budget() -> int:
+    budget = _token_budget.get()
+    return IMAGE_TOKEN_BUDGET if budget is None else budget
+
+def get_provider_size(provider: str, width: int, height: int) -> Tuple[int, int]:
+    # the size the provider resizes an image to before reading it - any pixels beyond that are only wasted bytes
+    if provider == 'openai':
+        scale = min(1.0, OPENAI_MAX_LONG_EDGE / max(width, height))
+        if min(width, height) * scale > OPENAI_MAX_SHORT_EDGE:
+            scale = OPENAI_MAX_SHORT_EDGE / min(width, height)
+    else:
+        scale = min(1.0, ANTHROPIC_MAX_LONG_EDGE / max(width, height), math.sqrt(ANTHROPIC_MAX_PIXELS / (width * height)))
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+def estimate_image_tokens(provider: str, width: int, height: int) -> int:
+    width, height = get_provider_size(provider, width, height)
+    if provider == 'openai':
+        return OPENAI_BASE_TOKENS + OPENAI_TOKENS_PER_TILE * math.ceil(width / OPENAI_TILE_SIZE) * math.ceil(height / OPENAI_TILE_SIZE)
+    return math.ceil(width * height / ANTHROPIC_PIXELS_PER_TOKEN)
+
+def get_target_size(provider: str, width: int, height: int, token_budget: float) -> Tuple[int, int]:
+    # the largest size within the token budget (stepping down 5% at a time, which for openai lands just inside a tile boundary),
+    # but no smaller than IMAGE_MIN_LONG_EDGE
+    width, height = get_provider_size(provider, width, height)
+    min_scale = min(1.0, IMAGE_MIN_LONG_EDGE / max(width, height))
+    scale = 1.0
+    while scale > min_scale and estimate_image_tokens(provider, int(width * scale), int(height * scale)) > token_budget:
+        scale = max(min_scale, scale * 0.95)
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+def _crop_margins(image: Image.Image) -> Image.Image:
+    # crops to the bounding box of everything darker than IMAGE_CROP_THRESHOLD (blank pages are left as they are)
+    grey = image if image.mode == 'L' else image.convert('L')
+    bbox = grey.point(lambda value: 255 if value < IMAGE_CROP_THRESHOLD else 0).getbbox()
+    if not bbox:
+        return image
+    left, top, right, bottom = bbox
+    return image.crop((max(0, left - IMAGE_CROP_PADDING), max(0, top - IMAGE_CROP_PADDING),
+                       min(image.width, right + IMAGE_CROP_PADDING), min(image.height, bottom + IMAGE_CROP_PADDING)))
+
+def _encode(image: Image.Image) -> Tuple[str, bytes]:
+    # whichever of png (best for clean typed pages) and jpeg (best for photos and scans) comes out smaller
+    candidates = []
+    for image_format, options in (('PNG', {}), ('JPEG', {"quality": IMAGE_JPEG_QUALITY, "optimize": True})):
+        buffer = io.BytesIO()
+        image.save(buffer, format=image_format, **options)
+        candidates.append((Image.MIME[image_format], buffer.getvalue()))
+    return min(candidates, key=lambda candidate: len(candidate[1]))
+
+def optimize_image(data: bytes, provider: str, token_budget: float, media_type: Optional[str] = None) -> Dict[str, Any]:
+    # {"media_type", "data", "width", "height", "bytes", "tokens", "original_bytes", "original_tokens"} - the original image is
+    # kept if it can't be read or the optimised one wouldn't be any smaller or cheaper
+    try:
+        with Image.open(io.BytesIO(data)) as original:
+            original.load()
+            media_type = Image.MIME.get(original.format, media_type)
+            image = ImageOps.exif_transpose(original)
+    except Exception as e:
+        print('image could not be optimised, sending it as it is:', e)
+        return {"media_type": media_type, "data": data, "width": None, "height": None, "bytes": len(data), "tokens": None,
+                "original_bytes": len(data), "original_tokens": None}
+    original_tokens = estimate_image_tokens(provider, image.width, image.height)
+    kept = {"media_type": media_type, "data": data, "width": image.width, "height": image.height, "bytes": len(data),
+            "tokens": original_tokens, "original_bytes": len(data), "original_tokens": original_tokens}
+
+    # transparent areas become white, rather than the black they would otherwise turn into
+    if image.mode in ('RGBA', 'LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info):
+        background = Image.new('RGB', image.size, 'white')
+        background.paste(image.convert('RGBA'), mask=image.convert('RGBA').getchannel('A'))
+        image = background
+    image = image.convert('L') if IMAGE_GREYSCALE else image.convert('RGB')
+    image = _crop_margins(image)
+    size = get_target_size(provider, image.width, image.height, token_budget)
+    if size != image.size:
+        image = image.resize(size, Image.LANCZOS)
+    optimized_type, optimized = _encode(image)
+    tokens = estimate_image_tokens(provider, image.width, image.height)
+    if len(optimized) >= len(data) and tokens >= original_tokens:
+        return kept
+    return {**kept, "media_type": optimized_type, "data": optimized, "width": image.width, "height": image.height,
+            "bytes": len(optimized), "tokens": tokens}
+
+def optimize_images(images: List[bytes], provider: str, token_budget: Optional[int] = None, media_type: Optional[str] = None) -> List[Tuple[str, bytes]]:
+    # (media type, bytes) for each image, sharing the token budget (the request's, or IMAGE_TOKEN_BUDGET) between them. the
+    # bytes and estimated tokens saved are printed and counted in the image_bytes_saved_total/image_tokens_saved_total metrics
+    if not images:
+        return []
+    if not IMAGE_OPTIMIZATION_ENABLED:
+        return [(get_media_type(image, media_type), image) for image in images]
+    budget = (get_token_budget() if token_budget is None else token_budget) / len(images)
+    with span('image_optimization', provider=provider):
+        results = [optimize_image(image, provider, budget, media_type) for image in images]
+    original_bytes = sum(result['original_bytes'] for result in results)
+    optimized_bytes = sum(result['bytes'] for result in results)
+    print(f'{provider} images optimised: {len(results)} images, {original_bytes} -> {optimized_bytes} bytes,',
+          f'~{sum(result["original_tokens"] or 0 for result in results)} -> ~{sum(result["tokens"] or 0 for result in results)} tokens')
+    metrics.increment('image_bytes_saved_total', original_bytes - optimized_bytes, provider=provider)
+    metrics.increment('image_tokens_saved_total', sum(result['original_tokens'] - result['tokens'] for result in results if result['tokens'] is not None), provider=provider)
+    return [(result['media_type'], result['data']) for result in results]
+
+def get_media_type(data: bytes, default: Optional[str] = None) -> Optional[str]:
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            return Image.MIME.get(image.format, default)
+    except Exception:
+        return default
+
+def render_optimized_pages(file_path: str, provider: str, token_budget: Optional[int] = None) -> List[Tuple[str, bytes]]:
+    # every page of a pdf as (media type, bytes), rendered at IMAGE_SOURCE_DPI and optimised for the provider - the budget is
+    # shared by all the pages, whether or not they are all sent
+    if not IMAGE_OPTIMIZATION_ENABLED:
+        return [(MEDIA_TYPES[PDF_RENDER_FORMAT], page) for page in render_pdf_pages(file_path)]
+    budget = get_token_budget() if token_budget is None else token_budget
+    cache_key = f'{file_sha256(file_path)}:{provider}:{budget}'
+    pages = optimized_image_cache.get(cache_key)
+    if pages is None:
+        pages = optimize_images(render_pdf_pages(file_path, dpi=IMAGE_SOURCE_DPI), provider, budget)
+        optimized_image_cache.set(cache_key, pages)
+    return pages
@@ -0,0 +1,211 @@
+# job_queue.py
+
+import os
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import threading
+from contextlib import nullcontext
+from typing import Dict, Any, Callable, Optional
+from feedback_fanout import on_category_done
+from highlight_text import render_feedback
+from resilience import deadline
+
+JOB_QUEUE_PATH = os.getenv('FEEDBACK_JOB_QUEUE_PATH', '/tmp/feedback_jobs.sqlite3')
+JOB_WORKERS = int(os.getenv('FEEDBACK_JOB_WORKERS', 4))
+# running jobs are marked alive by their process every JOB_HEARTBEAT_SECONDS - one that hasn't been for JOB_STALE_SECONDS was
+# interrupted (its process stopped), and is re-queued by whichever process notices until it has been attempted this many times
+JOB_HEARTBEAT_SECONDS = float(os.getenv('FEEDBACK_JOB_HEARTBEAT_SECONDS', 10))
+JOB_STALE_SECONDS = float(os.getenv('FEEDBACK_JOB_STALE_SECONDS', 60))
+JOB_MAX_ATTEMPTS = int(os.getenv('FEEDBACK_JOB_MAX_ATTEMPTS', 2))
+# finished jobs are deleted once they are this old
+JOB_RETENTION_SECONDS = int(os.getenv('FEEDBACK_JOB_RETENTION_SECONDS', 7 * 24 * 60 * 60))
+JOB_POLL_SECONDS = 1
+
+class JobQueue:
+    # persistent queue of feedback requests, run by a bounded pool of worker threads so a request thread never waits on the llm.
+    # each job stores every category's feedback as it finishes, so it can be polled for partial results before it has finished.
+    # several processes (eg gunicorn workers) can share one queue file - each job is claimed by exactly one of them
+    def __init__(self, get_handler: Callable[[str], Any], path: str = JOB_QUEUE_PATH, workers: int = JOB_WORKERS):
+        self.get_handler = get_handler
+        self.path = path
+        self.workers = workers
+        # identifies this process's claims on jobs (a pid alone can be reused by a later process)
+        self.owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self._lock = threading.Lock()
+        self._wake = threading.Condition()
+        self._conn = None
+        self._started = False
+
+    def start(self):
+        # opens the queue and starts the workers on first use, rather than as a side effect of importing the app
+        with self._lock:
+            if self._started:
+                return
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            with self._conn:
+                self._conn.execute('PRAGMA journal_mode=WAL')
+                self._conn.execute("""
+                    CREATE TABLE IF NOT EXISTS jobs (
+                        job_id TEXT PRIMARY KEY,
+                        model TEXT NOT NULL,
+                        args TEXT NOT NULL,
+                        options TEXT,
+                        status TEXT NOT NULL,
+                        attempts INTEGER NOT NULL DEFAULT 0,
+                        partial TEXT,
+                        result TEXT,
+                        error TEXT,
+                        created_at REAL NOT NULL,
+                        started_at REAL,
+                        finished_at REAL,
+                        owner TEXT,
+                        heartbeat_at REAL
+                    )
+                """)
+                # queues created before jobs had an owner, heartbeat and options
+                columns = [row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")]
+                for column, column_type in (('owner', 'TEXT'), ('heartbeat_at', 'REAL'), ('options', 'TEXT')):
+                    if column not in columns:
+                        self._conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {column_type}")
+                self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+            self._started = True
+
+        threading.Thread(target=self._heartbeat, name='feedback-job-heartbeat', daemon=True).start()
+        for i in range(self.workers):
+            threading.Thread(target=self._work, name=f'feedback-job-worker-{i}', daemon=True).start()
+
+    def enqueue(self, model: str, feedback_args: Dict[str, Any], options: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        # options are the request's fields that aren't the handler's - its 'render' format and 'image_token_budget'
+        self.start()
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM jobs WHERE finished_at < ?", (now - JOB_RETENTION_SECONDS,))
+            self._conn.execute(
+                "INSERT INTO jobs (job_id, model, args, options, status, created_at) VALUES (?, ?, ?, ?, 'queued', ?)",
+                (job_id, model, json.dumps(feedback_args), json.dumps(options or {}), now)
+            )
+        with self._wake:
+            self._wake.notify()
+        return self.get(job_id)
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        self.start()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT job_id, model, status, attempts, partial, result, error, created_at, started_at, finished_at FROM jobs WHERE job_id = ?",
+                (job_id,)
+            ).fetchone()
+        if not row:
+            return None
+        job = {
+            "job_id": row[0],
+            "model": row[1],
+            "status": row[2],
+            "attempts": row[3],
+            "created_at": row[7],
+            "started_at": row[8],
+            "finished_at": row[9]
+        }
+        if row[5]:
+            job['result'] = json.loads(row[5])
+        elif row[4]:
+            job['partial'] = json.loads(row[4])
+        if row[6]:
+            job['error'] = row[6]
+        if row[2] == 'queued':
+            job['queue_position'] = self._get_queue_position(row[7])
+        return job
+
+    def _get_queue_position(self, created_at: float) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND created_at <= ?", (created_at,)).fetchone()[0]
+
+    def _claim(self) -> Optional[Dict[str, Any]]:
+        # takes the oldest queued job - the update only succeeds if it is still queued, so two workers (in this or another
+        # process) can never run the same one
+        with self._lock, self._conn:
+            while True:
+                row = self._conn.execute("SELECT job_id, model, args, options FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1").fetchone()
+                if not row:
+                    return None
+                now = time.time()
+                claimed = self._conn.execute(
+                    "UPDATE jobs SET status = 'running', attempts = attempts + 1, started_at = ?, owner = ?, heartbeat_at = ? "
+                    "WHERE job_id = ? AND status = 'queued'", (now, self.owner, now, row[0])
+                ).rowcount
+                if claimed:
+                    return {"job_id": row[0], "model": row[1], "args": json.loads(row[2]), "options": json.loads(row[3] or '{}')}
+
+    def _heartbeat(self):
+        # keeps this process's running jobs alive, and recovers any other process's that have gone stale
+        while True:
+            now = time.time()
+            with self._lock, self._conn:
+                self._conn.execute("UPDATE jobs SET heartbeat_at = ? WHERE status = 'running' AND owner = ?", (now, self.owner))
+                stale = "status = 'running' AND COALESCE(heartbeat_at, started_at, 0) < ?"
+                self._conn.execute(
+                    f"UPDATE jobs SET status = 'failed', error = 'Job was interrupted', finished_at = ? WHERE {stale} AND attempts >= ?",
+                    (now, now - JOB_STALE_SECONDS, JOB_MAX_ATTEMPTS)
+                )
+                requeued = self._conn.execute(
+                    f"UPDATE jobs SET status = 'queued', partial = NULL, owner = NULL WHERE {stale}", (now - JOB_STALE_SECONDS,)
+                ).rowcount
+            if requeued:
+                print('re-queued interrupted jobs:', requeued)
+                with self._wake:
+                    self._wake.notify_all()
+            time.sleep(JOB_HEARTBEAT_SECONDS)
+
+    def _update(self, job_id: str, **fields):
+        # only while this process still owns the job - if it was taken as stale and re-queued, the new run's results win
+        columns = ', '.join(f'{column} = ?' for column in fields)
+        values = [json.dumps(value) if column in ('partial', 'result') else value for column, value in fields.items()]
+        with self._lock, self._conn:
+            self._conn.execute(f"UPDATE jobs SET {columns} WHERE job_id = ? AND owner = ?", (*values, job_id, self.owner))
+
+    def _work(self):
+        while True:
+            job = self._claim()
+            if not job:
+                with self._wake:
+                    self._wake.wait(timeout=JOB_POLL_SECONDS)
+                continue
+            print('running job:', job['job_id'])
+            try:
+                result = self._run(job)
+                self._update(job['job_id'], status="completed", result=result, partial=None, finished_at=time.time())
+            except ValueError as e:
+                self._update(job['job_id'], status="failed", error=str(e), finished_at=time.time())
+            except Exception as e:
+                print(f"job {job['job_id']} failed:", e)
+                self._update(job['job_id'], status="failed", error="An unexpected error occurred", finished_at=time.time())
+
+    def _run(self, job: Dict[str, Any]) -> Dict[str, Any]:
+        # runs the handler's generate_feedback like /api/feedback does - within the request deadline and image token budget, and
+        # pre-rendered if asked (so jobs share the result cache, and the result is exactly the /api/feedback response) - saving
+        # each category's feedback as it finishes when several are requested
+        handler = self.get_handler(job['model'])
+        options = job['options']
+        budget = nullcontext()
+        if options.get('image_token_budget') is not None:
+            # image_optimizer loads Pillow and PyMuPDF, so (as in app.py) it is only imported for jobs that set a budget
+            from image_optimizer import image_token_budget
+            budget = image_token_budget(options['image_token_budget'])
+        partial = {"feedback": [], "categories": {}}
+        lock = threading.Lock()
+        def save_category(category: str, result: Any):
+            if not isinstance(result, dict):
+                return
+            with lock:
+                partial['feedback'].extend(result.get('feedback') or [])
+                partial['categories'][category] = {key: value for key, value in result.items() if key not in ('submission', 'feedback')}
+                self._update(job['job_id'], partial=partial)
+        with on_category_done(save_category), deadline(), budget:
+            result = handler.generate_feedback(**job['args'])
+        if options.get('render'):
+            result = {**result, "rendered": render_feedback(result, options['render'])}
+        return result
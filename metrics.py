@@ -0,0 +1,162 @@
+# metrics.py
+
+import os
+import time
+import bisect
+import inspect
+import functools
+import threading
+from contextlib import contextmanager
+from typing import Dict, Any, List, Tuple, Optional
+
+# in-process latency histograms and counters for each stage of a feedback request - recording is a lock, a bisect and a couple
+# of additions, so it is cheap enough to leave on (set METRICS_ENABLED=false to turn it off)
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
+# histogram bucket upper bounds, in seconds - from highlight matching (milliseconds) up to long assistant runs (minutes)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 60, 120, 300)
+METRIC_PREFIX = 'feedback_'
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        # the last count is for values above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> Optional[float]:
+        # upper bound of the bucket the quantile falls in (or the largest value seen, above the last bucket)
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 4),
+            "mean": round(self.sum / self.count, 4) if self.count else None,
+            "max": round(self.max, 4),
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99)
+        }
+
+class MetricsRegistry:
+    # histograms and counters keyed by name and a set of labels (eg provider and stage)
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def increment(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def get_stats(self) -> Dict[str, List[Dict[str, Any]]]:
+        with self._lock:
+            histograms = [{"name": name, "labels": dict(labels), **histogram.to_dict()} for (name, labels), histogram in self._histograms.items()]
+            counters = [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in self._counters.items()]
+        return {"histograms": sorted(histograms, key=lambda item: (item["name"], sorted(item["labels"].items()))),
+                "counters": sorted(counters, key=lambda item: (item["name"], sorted(item["labels"].items())))}
+
+    def render_prometheus(self) -> str:
+        # prometheus text exposition format, so the /metrics endpoint can be scraped directly
+        lines = []
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+        for name in sorted(set(name for (name, _), _ in histograms)):
+            lines.append(f'# TYPE {METRIC_PREFIX}{name} histogram')
+            for (histogram_name, labels), histogram in histograms:
+                if histogram_name != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append(f'{METRIC_PREFIX}{name}_bucket{_format_labels(labels + (("le", bound),))} {cumulative}')
+                lines.append(f'{METRIC_PREFIX}{name}_sum{_format_labels(labels)} {histogram.sum}')
+                lines.append(f'{METRIC_PREFIX}{name}_count{_format_labels(labels)} {histogram.count}')
+        for name in sorted(set(name for (name, _), _ in counters)):
+            lines.append(f'# TYPE {METRIC_PREFIX}{name} counter')
+            lines.extend(f'{METRIC_PREFIX}{name}{_format_labels(labels)} {value}' for (counter_name, labels), value in counters if counter_name == name)
+        return '\n'.join(lines) + '\n'
+
+def _format_labels(labels: Tuple[Tuple[str, Any], ...]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape_label(value)}"' for key, value in labels) + '}'
+
+def _escape_label(value: Any) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+metrics = MetricsRegistry()
+
+@contextmanager
+def span(stage: str, **labels):
+    # times one stage of a request - the duration goes in the stage's latency histogram, and an exception is also counted
+    # (by type) before being re-raised
+    if not METRICS_ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        metrics.increment('errors_total', stage=stage, error=type(e).__name__, **labels)
+        raise
+    finally:
+        metrics.observe('stage_seconds', time.perf_counter() - start, stage=stage, **labels)
+
+def timed(stage: str):
+    # decorator recording every call as a span - for handler methods the handler's provider is added as a label. generators
+    # (eg stream_feedback) are timed until they finish, or are closed by the client disconnecting
+    def get_labels(args) -> Dict[str, str]:
+        provider = getattr(args[0], 'provider', None) if args else None
+        return {"provider": provider} if isinstance(provider, str) else {}
+
+    def decorator(function):
+        if inspect.isgeneratorfunction(function):
+            @functools.wraps(function)
+            def generator_wrapper(*args, **kwargs):
+                with span(stage, **get_labels(args)):
+                    yield from function(*args, **kwargs)
+            return generator_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(stage, **get_labels(args)):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def record_usage(provider: str, usage: Any):
+    # token counts from a provider response (a usage dict or sdk usage object) - totals are left out, as they're the sum of the others
+    if not METRICS_ENABLED or not usage:
+        return
+    if not isinstance(usage, dict):
+        usage = {key: getattr(usage, key, None) for key in ('prompt_tokens', 'completion_tokens', 'input_tokens', 'output_tokens')}
+    for token_type, count in usage.items():
+        if isinstance(count, int) and count and token_type != 'total_tokens':
+            metrics.increment('tokens_total', count, provider=provider, type=token_type)
@@ -1,24 +1,70 @@
 # openai_handler.py
 
 import os
-from typing import Dict, Any, List
+import base64
+from typing import Dict, Any, List, Union, Iterator, Tuple
 import openai
 import json
 import re
+import threading
+from collections import defaultdict
+from feedback_fanout import fan_out, fan_out_stream, merge_category_results, get_common_result, get_student_record, format_feedback_bullet
+from stream_parser import BulletStreamParser, parse_category_output
+from highlight_matching import get_highlight_index, get_correction_phrases
+from assistant_registry import AssistantRegistry
+from utils import file_sha256
+from cache_store import transcription_cache, transcription_key, cached_feedback
+from image_optimizer import optimize_images, render_optimized_pages
+from pdf_text import extract_pdf_pages, PDF_TEXT_MIN_CHARS
+from transcription import transcribe_pdf, get_submission_pages, add_submission_pages
+from transport import get_http_client, get_timeout, prewarm
+from metrics import timed, span, record_usage
+from admission import admitted, admitted_transcriptions, admit_transcription
+from batch_grading import BATCH_TRANSCRIPTION_MAX_WORKERS
+from resilience import provider_error
+
+OPENAI_MODEL = "gpt-4o"
+# 'assistants' runs each category on an assistant thread with the mark scheme in a vector store, 'chat' sends the mark scheme text
+# and submission straight to chat completions in a single streamed call per category (no assistant, thread or upload round-trips)
+OPENAI_ENGINES = ['assistants', 'chat']
+IMAGE_MEDIA_TYPES = {'.png': 'image/png', '.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.gif': 'image/gif', '.webp': 'image/webp'}
 
 class OpenAIHandler:
+    provider = 'openai'
+
     def __init__(self):
         openai.api_key = os.getenv('OPENAI_API_KEY')
-        self.client = openai.OpenAI()
+        # pooled, keep-alive connections shared by every request (and the assistants, chat and batch apis)
+        # retries are left to the shared transport (transport.py), so the sdk's own are off
+        self.client = openai.OpenAI(http_client=get_http_client('openai'), timeout=get_timeout(), max_retries=0)
+        prewarm('openai', self.client.base_url)
+        self.registry = AssistantRegistry()
+        self._upload_locks = defaultdict(threading.Lock)
 
+    @timed('generate_feedback')
+    @cached_feedback('openai', OPENAI_MODEL, ['_get_instructions', '_get_category_message', '_get_chat_messages', '_format_category_output', 
+                                               '_format_bullet', 'highlight_matching', 'stream_parser', 'feedback_fanout', 'transcription'])
+    @admitted(OPENAI_MODEL)
     def generate_feedback(self, assignment_id: str, assignment_title: str, question_id: str, question_title: str, subject: str, 
-                          qualification: str, feedback_category: str, assistant_id: str, thread_id: str, submission: str, mark_scheme: str, 
-                          max_completion_tokens: int, temperature: float) -> Dict[str, Any]:
-        
-        if not thread_id and not assistant_id:
-            assistant = self._get_or_create_assistant(assignment_id, assignment_title, question_id, question_title, subject, qualification, feedback_category, mark_scheme, temperature)
-            thread, submission = self._init_thread(submission, assistant.id, question_title, max_completion_tokens, temperature)
-            assistant_id, thread_id = assistant.id, thread.id
+                          qualification: str, feedback_category: Union[str, List[str]], assistant_id: str, thread_id: str, submission: str, mark_scheme: str, 
+                          max_completion_tokens: int, temperature: float, engine: str = 'assistants') -> Dict[str, Any]:
+        submission_source = submission
+        if self._get_engine(engine) == 'chat':
+            result = self._generate_chat_feedback(assignment_title, question_title, subject, qualification, feedback_category, submission, mark_scheme, 
+                                                  max_completion_tokens, temperature)
+        elif isinstance(feedback_category, list):
+            result = self._generate_multi_category_feedback(assignment_id, assignment_title, question_id, question_title, subject, qualification, 
+                                                            feedback_category, submission, mark_scheme, max_completion_tokens, temperature)
+        else:
+            if not thread_id and not assistant_id:
+                assistant_id = self._get_or_create_assistant(assignment_id, assignment_title, question_id, question_title, subject, qualification, feedback_category, mark_scheme, temperature)
+                thread, submission = self._init_thread(submission, assistant_id, question_title, max_completion_tokens, temperature)
+                thread_id = thread.id
+            result = self._generate_category_feedback(qualification, subject, feedback_category, assistant_id, thread_id, submission, max_completion_tokens, temperature)
+        return get_common_result(add_submission_pages(result, submission_source), self.provider, OPENAI_MODEL, feedback_category)
+
+    def _generate_category_feedback(self, qualification: str, subject: str, feedback_category: str, assistant_id: str, thread_id: str, submission: str, 
+                                    max_completion_tokens: int, temperature: float) -> Dict[str, Any]:
         try:
             # feedback = []
             # for category, message in self._get_feedback_messages(qualification, subject).items():
@@ -33,41 +79,375 @@ class OpenAIHandler:
 
             print('returning feedback:', type(formatted_output))
             
-            return {
+            result = {
                 "status": run.status, 
                 "assistant_id": assistant_id,
                 "thread_id": thread_id,
                 "submission": submission,
                 "feedback": formatted_output
                 }
+            if run.usage:
+                result['usage'] = self._get_run_usage(run)
+            return result
         
         except openai.OpenAIError as e:
-            raise ValueError(f"OpenAI API error: {str(e)}")
+            raise provider_error(e, 'OpenAI')
+
+    def _generate_multi_category_feedback(self, assignment_id: str, assignment_title: str, question_id: str, question_title: str, subject: str, 
+                                          qualification: str, feedback_categories: List[str], submission: str, mark_scheme: str, 
+                                          max_completion_tokens: int, temperature: float) -> Dict[str, Any]:
+        # each category has its own assistant, so look up/create them all concurrently
+        assistants = fan_out(lambda category: self._get_or_create_assistant(assignment_id, assignment_title, question_id, question_title, subject, qualification, 
+                                                                            category, mark_scheme, temperature), feedback_categories)
+        for category, assistant_id in assistants.items():
+            if isinstance(assistant_id, Exception):
+                raise provider_error(assistant_id, 'OpenAI') from assistant_id
+
+        # transcribe the submission once on the first category's thread, then share the text with the other threads so all offsets agree
+        first_category = feedback_categories[0]
+        thread, submission = self._init_thread(submission, assistants[first_category], question_title, max_completion_tokens, temperature)
+        thread_ids = {first_category: thread.id}
+
+        def run_category(category: str) -> Dict[str, Any]:
+            thread_id = thread_ids.get(category) or self._init_thread(submission, assistants[category], question_title, max_completion_tokens, temperature)[0].id
+            # not through generate_feedback, which would admit (and time) each category again within this request
+            return self._generate_category_feedback(qualification, subject, category, assistants[category], thread_id, submission, max_completion_tokens, temperature)
+
+        return merge_category_results(fan_out(run_category, feedback_categories), submission)
+
+
+    @timed('stream_feedback')
+    @admitted(OPENAI_MODEL)
+    def stream_feedback(self, assignment_id: str, assignment_title: str, question_id: str, question_title: str, subject: str, 
+                        qualification: str, feedback_category: Union[str, List[str]], assistant_id: str, thread_id: str, submission: str, mark_scheme: str, 
+                        max_completion_tokens: int, temperature: float, engine: str = 'assistants') -> Iterator[Tuple[str, Dict[str, Any]]]:
+        # streaming counterpart of generate_feedback - yields (event, data) pairs, sending each bullet's highlights as soon as it is parsed
+        feedback_categories = feedback_category if isinstance(feedback_category, list) else [feedback_category]
+        if self._get_engine(engine) == 'chat':
+            yield from self._stream_chat_feedback(assignment_title, question_title, subject, qualification, feedback_categories, submission, mark_scheme, 
+                                                  max_completion_tokens, temperature)
+            return
+        submission_source = submission
+        if (thread_id or assistant_id) and len(feedback_categories) == 1:
+            assistant_ids, thread_ids = {feedback_categories[0]: assistant_id}, {feedback_categories[0]: thread_id}
+        else:
+            assistant_ids = fan_out(lambda category: self._get_or_create_assistant(assignment_id, assignment_title, question_id, question_title, subject, qualification, 
+                                                                                   category, mark_scheme, temperature), feedback_categories)
+            for category, category_assistant_id in assistant_ids.items():
+                if isinstance(category_assistant_id, Exception):
+                    raise provider_error(category_assistant_id, 'OpenAI') from category_assistant_id
+            thread, submission = self._init_thread(submission, assistant_ids[feedback_categories[0]], question_title, max_completion_tokens, temperature)
+            thread_ids = {feedback_categories[0]: thread.id}
+        yield 'submission', {"submission": submission, "pages": get_submission_pages(submission, submission_source)}
+
+        def stream_category(category: str, emit):
+            category_thread_id = thread_ids.get(category) or self._init_thread(submission, assistant_ids[category], question_title, max_completion_tokens, temperature)[0].id
+            message = self._get_category_message(category, qualification, subject)
+            self.client.beta.threads.messages.create(
+                thread_id=category_thread_id,
+                role=message['role'],
+                content=message['content'],
+            )
+            parser = BulletStreamParser()
+            unique_parts = set()
+            with self.client.beta.threads.runs.stream(thread_id=category_thread_id,
+                                                      assistant_id=assistant_ids[category],
+                                                      max_completion_tokens=max_completion_tokens,
+                                                      temperature=temperature
+                                                      ) as stream:
+                for text in stream.text_deltas:
+                    for bullet in parser.feed(text):
+                        emit('feedback', {"category": category, "feedback": self._format_bullet(bullet, category, submission, unique_parts)})
+                for bullet in parser.close():
+                    emit('feedback', {"category": category, "feedback": self._format_bullet(bullet, category, submission, unique_parts)})
+                run = stream.get_final_run()
+            record_usage(self.provider, run.usage)
+            print(f'{category} stream status:', run.status)
+            category_done = {"category": category, "status": run.status, "assistant_id": assistant_ids[category], "thread_id": category_thread_id}
+            if run.usage:
+                category_done['usage'] = self._get_run_usage(run)
+            emit('category_done', category_done)
+
+        yield from fan_out_stream(stream_category, feedback_categories)
+
+    def _get_engine(self, engine: str) -> str:
+        engine = (engine or 'assistants').lower()
+        if engine not in OPENAI_ENGINES:
+            raise ValueError(f"Invalid engine: {engine} (must be one of {OPENAI_ENGINES})")
+        return engine
+
+    def _generate_chat_feedback(self, assignment_title: str, question_title: str, subject: str, qualification: str, 
+                                feedback_category: Union[str, List[str]], submission: str, mark_scheme: str, 
+                                max_completion_tokens: int, temperature: float) -> Dict[str, Any]:
+        feedback_categories = feedback_category if isinstance(feedback_category, list) else [feedback_category]
+        mark_scheme_text = self._get_mark_scheme_text(mark_scheme)
+        submission = self._get_chat_submission(submission, max_completion_tokens, temperature)
+
+        def run_category(category: str) -> Dict[str, Any]:
+            messages = self._get_chat_messages(assignment_title, question_title, subject, qualification, category, submission, mark_scheme_text)
+            output, finish_reason, usage = self._stream_chat_completion(messages, max_completion_tokens, temperature)
+            print(f'{category} chat finish reason:', finish_reason)
+            return {
+                "status": "completed" if finish_reason == 'stop' else "incomplete",
+                "submission": submission,
+                "feedback": self._format_category_output(output, category, submission),
+                "usage": usage
+            }
+
+        if not isinstance(feedback_category, list):
+            try:
+                return run_category(feedback_category)
+            except openai.OpenAIError as e:
+                raise provider_error(e, 'OpenAI')
+        return merge_category_results(fan_out(run_category, feedback_categories), submission)
+
+    def _stream_chat_feedback(self, assignment_title: str, question_title: str, subject: str, qualification: str, feedback_categories: List[str], 
+                              submission: str, mark_scheme: str, max_completion_tokens: int, temperature: float) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        mark_scheme_text = self._get_mark_scheme_text(mark_scheme)
+        submission_source = submission
+        submission = self._get_chat_submission(submission, max_completion_tokens, temperature)
+        yield 'submission', {"submission": submission, "pages": get_submission_pages(submission, submission_source)}
+
+        def stream_category(category: str, emit):
+            messages = self._get_chat_messages(assignment_title, question_title, subject, qualification, category, submission, mark_scheme_text)
+            parser = BulletStreamParser()
+            unique_parts = set()
+            def on_text(text: str):
+                for bullet in parser.feed(text):
+                    emit('feedback', {"category": category, "feedback": self._format_bullet(bullet, category, submission, unique_parts)})
+            _, finish_reason, usage = self._stream_chat_completion(messages, max_completion_tokens, temperature, on_text)
+            for bullet in parser.close():
+                emit('feedback', {"category": category, "feedback": self._format_bullet(bullet, category, submission, unique_parts)})
+            print(f'{category} chat finish reason:', finish_reason)
+            emit('category_done', {"category": category, "status": "completed" if finish_reason == 'stop' else "incomplete", "usage": usage})
+
+        yield from fan_out_stream(stream_category, feedback_categories)
+
+    @timed('chat_completion')
+    def _stream_chat_completion(self, messages: List[Dict[str, Any]], max_completion_tokens: int, temperature: float, on_text=None):
+        # one streamed chat completion - on_text is called with each text delta as it arrives, and the full output, finish reason
+        # and token usage are returned at the end
+        stream = self.client.chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=messages,
+            max_tokens=max_completion_tokens,
+            temperature=temperature,
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        output, finish_reason, usage = [], None, None
+        for chunk in stream:
+            if chunk.usage:
+                usage = {"prompt_tokens": chunk.usage.prompt_tokens, "completion_tokens": chunk.usage.completion_tokens}
+            for choice in chunk.choices:
+                if choice.delta.content:
+                    output.append(choice.delta.content)
+                    if on_text:
+                        on_text(choice.delta.content)
+                if choice.finish_reason:
+                    finish_reason = choice.finish_reason
+        record_usage(self.provider, usage)
+        return ''.join(output), finish_reason, usage
 
+    def _get_mark_scheme_text(self, mark_scheme: str) -> str:
+        # the whole mark scheme as text - one with any scanned (or otherwise unreadable) pages is refused, rather than graded
+        # against with those pages missing
+        if not os.path.isfile(mark_scheme):
+            return mark_scheme
+        pages = extract_pdf_pages(mark_scheme)
+        # scanned pages (images with little or no text) and garbled text layers - a page with just a few words of text is fine
+        unreadable = [page['page'] + 1 for page in pages if page['needs_transcription'] and (page['has_images'] or len(page['text']) >= PDF_TEXT_MIN_CHARS)]
+        if unreadable:
+            raise ValueError(f"The mark scheme has no usable text layer on page(s) {unreadable}, so can't be sent as text (use the assistants engine instead)")
+        mark_scheme_text = '\n\n'.join(page['text'] for page in pages if page['text'])
+        if not mark_scheme_text:
+            raise ValueError("The mark scheme has no usable text layer, so can't be sent as text (use the assistants engine instead)")
+        return mark_scheme_text
 
+    @timed('transcription')
+    def _get_chat_submission(self, submission: str, max_completion_tokens: int, temperature: float) -> str:
+        # chat engine counterpart of _init_thread's transcription - cached text, then the pdf text layer, then the whole file
+        # sent as images, all without any assistant/thread (shares the transcription cache with the assistants engine). the
+        # chat engine and provider batches both transcribe through here
+        if not os.path.isfile(submission):
+            return submission
+        cache_key = transcription_key('openai', OPENAI_MODEL, file_sha256(submission))
+        cached_submission = transcription_cache.get(cache_key)
+        if cached_submission is not None:
+            print('submission = file (transcription cached)')
+            return cached_submission
+        admit_transcription(self.provider, OPENAI_MODEL, submission, max_completion_tokens)
+
+        finish_reasons = []
+        def transcribe(images: List[Tuple[str, bytes]]) -> str:
+            text, finish_reason = self._transcribe_chat_images(images, max_completion_tokens, temperature)
+            finish_reasons.append(finish_reason)
+            return text
+        # pdfs are transcribed a page per call, all at once - and typed pages use their own text layer instead
+        text = transcribe_pdf(submission, lambda page_number: transcribe([render_optimized_pages(submission, self.provider)[page_number]]),
+                              render_pages=lambda file_path: render_optimized_pages(file_path, self.provider))
+        if text is not None:
+            print('submission = file (pdf pages)')
+        else:
+            print('submission = file')
+            text = transcribe(self._get_file_images(submission))
+        if all(finish_reason == 'stop' for finish_reason in finish_reasons):
+            transcription_cache.set(cache_key, text)
+        return text
+
+    def _get_file_images(self, file_path: str) -> List[Tuple[str, bytes]]:
+        # the whole file as optimised (media type, bytes) images - an uploaded image, or every page of a pdf
+        extension = os.path.splitext(file_path)[1].lower()
+        if extension in IMAGE_MEDIA_TYPES:
+            with open(file_path, 'rb') as file:
+                return optimize_images([file.read()], self.provider, media_type=IMAGE_MEDIA_TYPES[extension])
+        if extension == '.pdf':
+            return render_optimized_pages(file_path, self.provider)
+        raise ValueError(f"Unsupported submission file type for the chat engine: {extension}")
+
+    def _transcribe_chat_images(self, images: List[Tuple[str, bytes]], max_completion_tokens: int, temperature: float):
+        # images are (media type, bytes) - optimised pdf pages or uploaded image files (see image_optimizer.py)
+        content = [{
+            "type": "text",
+            "text": """Please transcribe this student submission EXACTLY to text and return it as a string.
+            It is important that the string representation is as accurate and faithful as possible.
+            Give ONLY the transcribed submission in your response below (no extra text before and after).
+            For this transciption only, the response does not have to be a JSON.""",
+        }]
+        for media_type, data in images:
+            content.append({"type": "image_url", "image_url": {"url": f"data:{media_type};base64,{base64.b64encode(data).decode('utf-8')}"}})
+        output, finish_reason, _ = self._stream_chat_completion([{"role": "user", "content": content}], max_completion_tokens, temperature)
+        return self._format_string(output), finish_reason
+
+    def submit_batch(self, assignment_id: str, assignment_title: str, question_id: str, question_title: str, subject: str, 
+                     qualification: str, feedback_category: Union[str, List[str]], mark_scheme: str, submissions: Dict[str, str], 
+                     max_completion_tokens: int, temperature: float, **kwargs) -> Dict[str, Any]:
+        # the batch api only supports chat completions (not assistants), so every request is self-contained - the mark scheme is
+        # extracted once and inlined as text, and submissions are transcribed up front the same way as the chat engine (cache,
+        # text layer or llm), without creating an assistant or any threads
+        feedback_categories = feedback_category if isinstance(feedback_category, list) else [feedback_category]
+        mark_scheme_text = self._get_mark_scheme_text(mark_scheme)
+        # a few submissions at a time, each transcription waiting for its tokens under the rate limit
+        with admitted_transcriptions():
+            submission_texts = fan_out(lambda student_id: self._get_chat_submission(submissions[student_id], max_completion_tokens, temperature), 
+                                       list(submissions), max_workers=BATCH_TRANSCRIPTION_MAX_WORKERS)
+
+        requests, custom_ids = [], {}
+        for i, (student_id, submission) in enumerate(submission_texts.items()):
+            if isinstance(submission, Exception):
+                raise ValueError(f"Could not transcribe submission for {student_id}: {str(submission)}")
+            for category in feedback_categories:
+                custom_id = f"{i}-{category}"
+                custom_ids[custom_id] = [student_id, category]
+                requests.append({
+                    "custom_id": custom_id,
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": {
+                        "model": OPENAI_MODEL,
+                        "messages": self._get_chat_messages(assignment_title, question_title, subject, qualification, category, submission, mark_scheme_text),
+                        "max_tokens": max_completion_tokens,
+                        "temperature": temperature,
+                    },
+                })
+        try:
+            batch_file = self.client.files.create(file=('batch.jsonl', '\n'.join(json.dumps(r) for r in requests).encode('utf-8')), purpose="batch")
+            batch = self.client.batches.create(input_file_id=batch_file.id, endpoint="/v1/chat/completions", completion_window="24h")
+        except openai.OpenAIError as e:
+            raise provider_error(e, 'OpenAI')
+        print('openai batch created:', batch.id, len(requests), 'requests')
+        return {"provider_batch_id": batch.id, "submissions": submission_texts, "custom_ids": custom_ids}
+
+    def get_batch_results(self, batch: Dict[str, Any]) -> List[Dict[str, Any]]:
+        # returns one merged feedback record per student once the provider batch has ended, or None while it is still running
+        provider_batch = self.client.batches.retrieve(batch['provider_batch_id'])
+        if provider_batch.status in ('validating', 'in_progress', 'finalizing'):
+            return None
+        if provider_batch.status != 'completed':
+            raise ValueError(f"OpenAI batch {provider_batch.id} {provider_batch.status}")
+
+        outputs = {}
+        if provider_batch.output_file_id:
+            for line in self.client.files.content(provider_batch.output_file_id).text.splitlines():
+                if line.strip():
+                    output = json.loads(line)
+                    outputs[output['custom_id']] = output
+        results = {student_id: {} for student_id in batch['submissions']}
+        for custom_id, (student_id, category) in batch['custom_ids'].items():
+            output = outputs.get(custom_id) or {}
+            response = output.get('response') or {}
+            if response.get('status_code') != 200:
+                results[student_id][category] = ValueError((output.get('error') or {}).get('message') or f"request {custom_id} failed")
+                continue
+            choice = response['body']['choices'][0]
+            results[student_id][category] = {
+                "status": "completed" if choice['finish_reason'] == 'stop' else "incomplete",
+                "feedback": self._format_category_output(choice['message']['content'], category, batch['submissions'][student_id]),
+                "usage": response['body'].get('usage'),
+            }
+        return [get_student_record(student_id, category_results, batch['submissions'][student_id]) for student_id, category_results in results.items()]
+
+    @timed('assistant')
     def _get_or_create_assistant(self, assignment_id: str, assignment_title: str, question_id: str, question_title: str, subject: str, 
-                                 qualification: str, feedback_category: str, mark_scheme: str, temperature: float):
+                                 qualification: str, feedback_category: str, mark_scheme: str, temperature: float) -> str:
         assistant_name = f"marking-assistant-a{assignment_id}-q{question_id}-c{feedback_category}"
         if os.path.isfile(mark_scheme):
             print('ms = file')
         else:
             print('ms = string')
+        mark_scheme_sha256 = file_sha256(mark_scheme)
+
+        # check the local registry first - entries are only re-checked against the API once they are stale
+        entry = self.registry.get_assistant(assignment_id, question_id, feedback_category, mark_scheme_sha256)
+        if entry:
+            if not entry['needs_validation']:
+                print('assistant found in registry:', entry['assistant_id'])
+                return entry['assistant_id']
+            try:
+                self.client.beta.assistants.retrieve(entry['assistant_id'])
+                self.registry.mark_validated(entry['assistant_id'])
+                print('assistant found in registry and validated:', entry['assistant_id'])
+                return entry['assistant_id']
+            except openai.NotFoundError:
+                print('registry assistant no longer exists:', entry['assistant_id'])
+                self.registry.remove_assistant(entry['assistant_id'])
+
+        # only scan the account's assistants on a registry miss (assistants created before the registry have no mark scheme hash)
         try:
-            assistant = next((a for a in self.client.beta.assistants.list() if a.name == assistant_name), None)
+            assistant = next((a for a in self.client.beta.assistants.list() if a.name == assistant_name 
+                              and (a.metadata or {}).get('mark_scheme_sha256') in (None, mark_scheme_sha256)), None)
             if assistant:
                 print('assistant exists:', assistant.name)
-                return assistant
+                self.registry.put_assistant(assignment_id, question_id, feedback_category, mark_scheme_sha256, assistant.id, self._get_vector_store_id(assistant))
+                return assistant.id
         except openai.OpenAIError as e:
             print('error:', e)
             print('assistant does not exist')
             pass
 
         # create new assistant if doesn't exist
-        vector_store = self._create_vector_store(assignment_id, question_id, mark_scheme)
+        vector_store_id = self._get_or_create_vector_store(mark_scheme, mark_scheme_sha256)
         print('assistant temp=', temperature)
         assistant = self.client.beta.assistants.create(
             name=assistant_name,
-            instructions=f"""You are an expert educational assessor for {qualification}-level {subject} - give accurate and extensive feedback for questions from the following assignment, entitled '{assignment_title}', carefully taking in to account the mark scheme provided where necessary.
+            instructions=self._get_instructions(assignment_title, qualification, subject),
+            model=OPENAI_MODEL,
+            temperature=temperature,
+            tools=[{"type": "file_search"}],
+            tool_resources={"file_search": {"vector_store_ids": [vector_store_id]}},
+            metadata={"mark_scheme_sha256": mark_scheme_sha256}
+        )
+        print('assistant created:', assistant.name, 'vector store:', vector_store_id)
+        self.registry.put_assistant(assignment_id, question_id, feedback_category, mark_scheme_sha256, assistant.id, vector_store_id)
+        # # update assistant with vector store
+        # assistant = self.client.beta.assistants.update(
+        #     assistant_id=assistant.id,
+        #     tool_resources={"file_search": {"vector_store_ids": [vector_store.id]}},
+        # )
+        return assistant.id
+
+    def _get_instructions(self, assignment_title: str, qualification: str, subject: str) -> str:
+        return f"""You are an expert educational assessor for {qualification}-level {subject} - give accurate and extensive feedback for questions from the following assignment, entitled '{assignment_title}', carefully taking in to account the mark scheme provided where necessary.
                         Break down your feedback in to categories, giving only feedback for that category and listing your comments as bullet points under that category's title, in the exact following JSON format:
                         {{
                             "<feedback category>": [
@@ -80,33 +460,75 @@ class OpenAIHandler:
                         }}
                         It is very important that you enclose each correction in backticks within the JSON output.
                         Do NOT write anything in your reply outside of this JSON, and make sure you always using double quotation marks "" for each key or value string, and single quotation marks '' for punctuation ONLY.
-                        """,
-            model="gpt-4o",
-            temperature=temperature,
-            tools=[{"type": "file_search"}],
-            tool_resources={"file_search": {"vector_store_ids": [vector_store.id]}}
-        )
-        print('assistant created:', assistant.name, 'vector store:', vector_store.name)
-        # # update assistant with vector store
-        # assistant = self.client.beta.assistants.update(
-        #     assistant_id=assistant.id,
-        #     tool_resources={"file_search": {"vector_store_ids": [vector_store.id]}},
-        # )
-        return assistant
+                        """
 
-    def _create_vector_store(self, assignment_id: str, question_id: str, mark_scheme: str):
-        vector_store_name = f"vector-store-a{assignment_id}-q{question_id}"
-        vector_store = self.client.beta.vector_stores.create(name=vector_store_name)
-        with open(mark_scheme, "rb") as file_stream:
-            self.client.beta.vector_stores.files.upload_and_poll(
+    def _get_chat_messages(self, assignment_title: str, question_title: str, subject: str, qualification: str, feedback_category: str, 
+                           submission: str, mark_scheme_text: str) -> List[Dict[str, str]]:
+        # self-contained chat completions messages for one category, with the mark scheme inlined as text instead of held in a vector store
+        category_message = self._get_category_message(feedback_category, qualification, subject)
+        return [
+            {"role": "system", "content": self._get_instructions(assignment_title, qualification, subject)},
+            {"role": "user", "content": f"The mark scheme is below:\n{mark_scheme_text}"},
+            {"role": "user", "content": f"Student submission is below, for the question '{question_title}':\n{submission}"},
+            {"role": category_message['role'], "content": category_message['content']},
+        ]
+
+    def _get_vector_store_id(self, assistant):
+        file_search = getattr(assistant.tool_resources, 'file_search', None) if assistant.tool_resources else None
+        vector_store_ids = getattr(file_search, 'vector_store_ids', None) or []
+        return vector_store_ids[0] if vector_store_ids else None
+
+    @timed('vector_store_upload')
+    def _get_or_create_vector_store(self, mark_scheme: str, mark_scheme_sha256: str) -> str:
+        # vector stores are keyed by the mark scheme contents, so each unique file is only uploaded once however many assistants use it -
+        # the per-hash lock stops concurrent category requests from racing to upload the same file
+        with self._upload_locks[mark_scheme_sha256]:
+            entry = self.registry.get_vector_store(mark_scheme_sha256)
+            if entry:
+                if not entry['needs_validation']:
+                    print('vector store found in registry:', entry['vector_store_id'])
+                    return entry['vector_store_id']
+                try:
+                    self.client.beta.vector_stores.retrieve(entry['vector_store_id'])
+                    self.registry.mark_vector_store_validated(entry['vector_store_id'])
+                    return entry['vector_store_id']
+                except openai.NotFoundError:
+                    print('registry vector store no longer exists:', entry['vector_store_id'])
+                    self.registry.remove_vector_store(entry['vector_store_id'])
+
+            with open(mark_scheme, "rb") as file_stream:
+                mark_scheme_file = self.client.files.create(file=file_stream, purpose="assistants")
+            vector_store = self.client.beta.vector_stores.create(name=f"vector-store-ms-{mark_scheme_sha256[:16]}")
+            self.client.beta.vector_stores.files.create_and_poll(
                 vector_store_id=vector_store.id,
-                file=file_stream,
+                file_id=mark_scheme_file.id,
             )
-        return vector_store
+            self.registry.put_vector_store(mark_scheme_sha256, vector_store.id, mark_scheme_file.id)
+            return vector_store.id
 
+    @timed('transcription')
     def _init_thread(self, submission: str, assistant_id: str, question_title: str, max_completion_tokens: int, temperature: float):
         # if submission and submission.startswith('@'):
         #     file_path = submission[1:]
+        # identical submission files have already been transcribed, so reuse the cached text and treat it as a text submission
+        cache_key = transcription_key('openai', OPENAI_MODEL, file_sha256(submission)) if os.path.isfile(submission) else None
+        cached_submission = transcription_cache.get(cache_key) if cache_key else None
+        if cached_submission is not None:
+            print('submission = file (transcription cached)')
+            submission = cached_submission
+        elif cache_key:
+            # pdfs are transcribed a page per run, all at once - and typed pages use their own text layer instead
+            statuses = []
+            def transcribe_page(page_number: int) -> str:
+                text, status = self._transcribe_page(submission, page_number, assistant_id, max_completion_tokens, temperature)
+                statuses.append(status)
+                return text
+            pdf_submission = transcribe_pdf(submission, transcribe_page, render_pages=lambda file_path: render_optimized_pages(file_path, self.provider))
+            if pdf_submission is not None:
+                print('submission = file (pdf pages)')
+                if all(status == 'completed' for status in statuses):
+                    transcription_cache.set(cache_key, pdf_submission)
+                submission = pdf_submission
         if os.path.isfile(submission): # file_path
             print('submission = file')
             try:
@@ -134,12 +556,18 @@ class OpenAIHandler:
                                                                     max_completion_tokens=max_completion_tokens,
                                                                     temperature=temperature
                                                                     )
+                record_usage(self.provider, run.usage)
                 submission = self._get_run_output(thread.id, run.id)
                 print('unformatted submission:\n', submission)
                 submission = self._format_string(submission)
+                if run.status == 'completed':
+                    transcription_cache.set(cache_key, submission)
                 print('formatted submission:\n', type(submission), submission, "\nsub_string_ended")
+            except (openai.OpenAIError, ValueError):
+                raise
             except Exception as e:
-                return f'Error processing file: {str(e)}'
+                # callers unpack (thread, submission) - a failed transcription is an error, not text to grade
+                raise ValueError(f'Error processing file: {str(e)}') from e
         # else:
         #     return 'File not found on the server'
         else:
@@ -151,6 +579,31 @@ class OpenAIHandler:
             thread = self.client.beta.threads.create(messages=[initial_message])
         return thread, submission
 
+    def _transcribe_page(self, file_path: str, page_number: int, assistant_id: str, max_completion_tokens: int, temperature: float):
+        # transcribes a single rendered page as a vision input, for pdf pages that have no usable text layer
+        media_type, page_image = render_optimized_pages(file_path, self.provider)[page_number]
+        image_file = self.client.files.create(file=(f'page-{page_number}.{media_type.split("/")[-1]}', page_image), purpose="vision")
+        thread = self.client.beta.threads.create(messages=[{
+            "role": "user",
+            "content": [
+                {
+                    "type": "text",
+                    "text": """Please transcribe this page of a student submission EXACTLY to text and return it as a string.
+                    It is important that the string representation is as accurate and faithful as possible.
+                    Give ONLY the transcribed page in your response below (no extra text before and after).
+                    For this transciption only, the response does not have to be a JSON.""",
+                },
+                {"type": "image_file", "image_file": {"file_id": image_file.id}},
+            ],
+        }])
+        run = self.client.beta.threads.runs.create_and_poll(thread_id=thread.id,
+                                                            assistant_id=assistant_id,
+                                                            max_completion_tokens=max_completion_tokens,
+                                                            temperature=temperature
+                                                            )
+        record_usage(self.provider, run.usage)
+        return self._format_string(self._get_run_output(thread.id, run.id)), run.status
+
     def _get_category_message(self, feedback_category: str, qualification: str, subject: str) -> Dict[str, Dict[str, str]]:
         return {
             "SPaG": {
@@ -189,18 +642,24 @@ class OpenAIHandler:
             },
         }[feedback_category]
 
+    @timed('run')
     def _create_and_poll_run(self, thread_id: str, assistant_id: str, message: Dict[str, str], max_completion_tokens: int, temperature: float):
         self.client.beta.threads.messages.create(
             thread_id=thread_id,
             role=message['role'],
             content=message['content'],
         )
-        return self.client.beta.threads.runs.create_and_poll(
+        run = self.client.beta.threads.runs.create_and_poll(
             thread_id=thread_id, 
             assistant_id=assistant_id,
             max_completion_tokens=max_completion_tokens,
             temperature=temperature
         )
+        record_usage(self.provider, run.usage)
+        return run
+
+    def _get_run_usage(self, run) -> Dict[str, int]:
+        return {"prompt_tokens": run.usage.prompt_tokens, "completion_tokens": run.usage.completion_tokens}
 
     def _format_string(self, text):
         # replace single newlines with empty string
@@ -209,105 +668,27 @@ class OpenAIHandler:
         text = re.sub(r'\n{2,}', lambda m: '\n' * (len(m.group()) - 1), text)
         return text
 
+    @timed('run_output')
     def _get_run_output(self, thread_id: str, run_id: str):
         messages = self.client.beta.threads.messages.list(thread_id=thread_id, run_id=run_id)
         return messages.data[0].content[0].text.value if messages.data else ""
 
     def _format_category_output(self, output: str, category: str, submission: str) -> List[Dict[str, Any]]:
-        colour_dict = {
-            "SPaG": ["FFBF00", "EC4E02"],
-            "historical_accuracy": ["02FFFF", "163E64"],
-            "overall_comments": ["02FF5A", "12501B"],
-            "marking": ["FF4CFE", "501649"],
-        }
-        # remove code block markers if present
-        json_content = re.sub(r'```json\s*|\s*```', '', output.strip())
-        # replace single quotes with double quotes for keys/string values
-        json_content = re.sub(r'(^|[,{\[]\s*)\'(?=\S)|(?<=\S)\'(\s*[,}\]]|$)', '"', json_content)
-        # remove trailing commas if present
-        json_content = re.sub(r',\s*}', '}', json_content)
-        json_content = re.sub(r',\s*]', ']', json_content)
-        ###
-        try:
-            data = json.loads(json_content)
-        except json.JSONDecodeError as e:
-            print(f"JSON Decode Error: {e}")
-            print(f"Problematic JSON content: {json_content}")
-            
-            # if parsing fails try  ast.literal_eval as a fallback
-            try:
-                import ast
-                data = ast.literal_eval(json_content)
-            except:
-                print("Failed to parse JSON.")
-                return None
-
-        # extract list of bullets from output and iterate through
-        json_key = list(data.keys())[0]
-        bullets = data[json_key]
-        # print('bullets=', bullets)
-        response_data = []
-        unique_parts = set()
-        for bullet in bullets:
-            bullet = bullet.strip('- ').strip()
-
-            pattern = r'【([^】]+)】'
-            match = re.search(pattern, bullet)
-            if match:
-                citations = match.group(1)
-                bullet = re.sub(pattern, '', bullet).strip()
-            else:
-                citations = None
-            
-            # assemble JSON response for each bullet, noting categories are handled differently based on if the output must be split into parts
-            if category in ['SPaG', 'historical_accuracy']:###
-                parts = re.split(r' -> ', bullet, maxsplit=1)
-                
-                if len(parts) == 2:
-                    incorrect_response, correct_response = parts
-                    incorrect_response = incorrect_response.strip().strip('`').strip('...').strip("'")
-                    correct_response = correct_response.strip().strip('`').strip('...').strip("'")
-                    parts = (incorrect_response, correct_response)
-                    if parts not in unique_parts:
-                        print(parts, 'not in unique_parts')
-                        unique_parts.add(parts)
-                        start_indices = [match.start() for match in re.finditer(re.escape(parts[0]), submission, re.IGNORECASE)]
-                        end_indices = [ind + len(parts[0]) for ind in start_indices]   
-                        unique_pairs = set()
-                        for start_index, end_index in zip(start_indices, end_indices):  
-                            pair = (start_index, end_index)
-                            if pair not in unique_pairs:
-                                unique_pairs.add(pair)          
-                                response_data.append({
-                                    'category': category,
-                                    'incorrect_or_highlight': parts[0],
-                                    'correct_or_feedback': parts[1],
-                                    'citations': citations,
-                                    'start': pair[0],
-                                    'end': pair[1],
-                                    'background_colour': colour_dict.get(category)[0],
-                                    'text_colour': colour_dict.get(category)[1],
-                                })
-                            else:
-                                print(pair, 'already in unique_pairs')
-                    else:
-                        print(parts, 'already in unique_parts')
-                else:
-                    print(f"Warning: LLM output correction '{bullet}' does not contain ' -> ' character")
-            
-            elif category in ['marking', 'overall_comments']:###
-                bullet = bullet.strip().strip('`').strip('...')
-                response_data.append({
-                    'category': category,
-                    'incorrect_or_highlight': None,
-                    'correct_or_feedback': bullet,
-                    'citations': citations,
-                    'start': None,
-                    'end': None,
-                    'colour': colour_dict.get(category),
-                })
-            
-            else:
-                print(f"Warning: Invalid category '{category}'")
+        # extract list of bullets from output (tolerating fences, single quotes, trailing commas and truncation) and iterate through
+        with span('parse_output', provider=self.provider):
+            bullets = parse_category_output(output)
+        with span('highlight', provider=self.provider):
+            # match every correction against the submission in one pass, before formatting the bullets one by one
+            if category in ['SPaG', 'historical_accuracy']:
+                get_highlight_index(submission).find_all(get_correction_phrases(bullets))
+            response_data = []
+            unique_parts = set()
+            for bullet in bullets:
+                response_data.extend(self._format_bullet(bullet, category, submission, unique_parts))
+
+        return response_data
 
-        return response_data
\ No newline at end of file
+    def _format_bullet(self, bullet: str, category: str, submission: str, unique_parts: set) -> List[Dict[str, Any]]:
+        # the item schema is shared with the other providers (see feedback_fanout.format_feedback_bullet) - repeated corrections
+        # within a category are only returned once
+        return format_feedback_bullet(bullet, category, submission, unique_parts)
@@ -0,0 +1,67 @@
+# pdf_render.py
+
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+import fitz
+from cache_store import TieredCache
+from utils import file_sha256
+
+PDF_RENDER_DPI = int(os.getenv('PDF_RENDER_DPI', 72))
+PDF_RENDER_FORMAT = os.getenv('PDF_RENDER_FORMAT', 'png')
+PDF_RENDER_MAX_PAGES = int(os.getenv('PDF_RENDER_MAX_PAGES', 20))
+# documents with fewer pages than this are rendered in-process, since a process pool round-trip costs more than rendering them
+PDF_RENDER_PARALLEL_MIN_PAGES = int(os.getenv('PDF_RENDER_PARALLEL_MIN_PAGES', 3))
+PDF_RENDER_WORKERS = int(os.getenv('PDF_RENDER_WORKERS', min(4, os.cpu_count() or 1)))
+
+MEDIA_TYPES = {'png': 'image/png', 'jpeg': 'image/jpeg'}
+
+# rendered pages are kept in memory only (keyed by file hash), so repeated mark schemes are never rasterised twice - up to
+# PDF_RENDER_CACHE_BYTES of page images, as every entry holds all of a document's pages
+rendered_page_cache = TieredCache('rendered_pages', max_items=int(os.getenv('PDF_RENDER_CACHE_ITEMS', 64)), disk_dir=None, max_disk_bytes=0,
+                                  max_memory_bytes=int(os.getenv('PDF_RENDER_CACHE_BYTES', 64 * 1024 * 1024)))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def _render_page(file_path: str, page_number: int, dpi: int, image_format: str) -> bytes:
+    with fitz.open(file_path) as doc:
+        pix = doc.load_page(page_number).get_pixmap(dpi=dpi)
+        return pix.tobytes(image_format)
+
+def _get_pool() -> Optional[ProcessPoolExecutor]:
+    global _pool
+    with _pool_lock:
+        if _pool is None and PDF_RENDER_WORKERS > 1:
+            try:
+                _pool = ProcessPoolExecutor(max_workers=PDF_RENDER_WORKERS)
+            except (OSError, NotImplementedError) as e:
+                # eg serverless runtimes without /dev/shm - fall back to rendering in-process
+                print('process pool unavailable, rendering pages serially:', e)
+                return None
+        return _pool
+
+def render_pdf_pages(file_path: str, dpi: int = PDF_RENDER_DPI, image_format: str = PDF_RENDER_FORMAT) -> List[bytes]:
+    # renders every page of the pdf to image bytes in memory - pdfs of more than PDF_RENDER_MAX_PAGES pages are refused rather
+    # than sent with pages missing
+    if image_format not in MEDIA_TYPES:
+        raise ValueError(f"Unsupported image format: {image_format}")
+    cache_key = f'{file_sha256(file_path)}:{dpi}:{image_format}'
+    pages = rendered_page_cache.get(cache_key)
+    if pages is not None:
+        return pages
+
+    with fitz.open(file_path) as doc:
+        page_count = len(doc)
+        if page_count > PDF_RENDER_MAX_PAGES:
+            print(f'{os.path.basename(file_path)} not rendered: {page_count} pages, more than PDF_RENDER_MAX_PAGES ({PDF_RENDER_MAX_PAGES})')
+            raise ValueError(f"PDF has {page_count} pages, more than the {PDF_RENDER_MAX_PAGES} that can be sent as images")
+        pool = _get_pool() if page_count >= PDF_RENDER_PARALLEL_MIN_PAGES else None
+        if not pool:
+            pages = [doc.load_page(page_number).get_pixmap(dpi=dpi).tobytes(image_format) for page_number in range(page_count)]
+    if pool:
+        pages = list(pool.map(_render_page, [file_path] * page_count, range(page_count), [dpi] * page_count, [image_format] * page_count))
+
+    rendered_page_cache.set(cache_key, pages)
+    return pages
@@ -0,0 +1,47 @@
+# pdf_text.py
+
+import os
+import re
+from typing import Dict, Any, List
+import fitz
+
+# pages whose text layer scores below this are treated as scanned/handwritten and sent to the LLM for transcription instead
+PDF_TEXT_QUALITY_THRESHOLD = float(os.getenv('PDF_TEXT_QUALITY_THRESHOLD', 0.6))
+PDF_TEXT_MIN_CHARS = int(os.getenv('PDF_TEXT_MIN_CHARS', 20))
+
+def _get_page_text(page) -> str:
+    # text blocks in reading order (top-to-bottom, left-to-right), keeping line breaks within a block and a blank line between blocks
+    blocks = [block[4] for block in page.get_text('blocks', sort=True) if block[6] == 0]
+    paragraphs = ['\n'.join(line.strip() for line in block.strip().splitlines()) for block in blocks]
+    return '\n\n'.join(paragraph for paragraph in paragraphs if paragraph)
+
+def score_text_quality(text: str) -> float:
+    # rough 0-1 score of how much the text layer looks like real prose - empty/garbled layers (eg bad OCR or
+    # glyph-mapped fonts) have few printable characters or few word-like tokens
+    stripped = text.strip()
+    if len(stripped) < PDF_TEXT_MIN_CHARS:
+        return 0.0
+    printable = sum(1 for c in stripped if (c.isprintable() or c.isspace()) and c != '�')
+    tokens = stripped.split()
+    words = sum(1 for token in tokens if re.fullmatch(r"[^\W\d_]{1,20}(['’-][^\W\d_]+)*[.,;:!?)\"'’]*", token.lstrip('("\'‘“')) and re.search(r'[aeiouyAEIOUY]', token))
+    return round((printable / len(stripped)) * (words / len(tokens)), 3)
+
+def extract_pdf_pages(file_path: str) -> List[Dict[str, Any]]:
+    pages = []
+    with fitz.open(file_path) as doc:
+        for page_number, page in enumerate(doc):
+            text = _get_page_text(page)
+            quality = score_text_quality(text)
+            pages.append({
+                "page": page_number,
+                "text": text,
+                "quality": quality,
+                "needs_transcription": quality < PDF_TEXT_QUALITY_THRESHOLD,
+                "has_images": bool(page.get_images())
+            })
+    return pages
+
+def extract_pdf_text(file_path: str) -> str:
+    # the whole text layer of a pdf (eg a mark scheme), or '' if it has none worth using
+    pages = extract_pdf_pages(file_path)
+    return '\n\n'.join(page['text'] for page in pages if not page['needs_transcription'])
@@ -0,0 +1,211 @@
+# provider_router.py
+
+import os
+import time
+import inspect
+import contextvars
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Dict, Any, List, Callable, Iterator, Tuple, Optional
+from metrics import metrics
+from resilience import ProviderError, get_circuit_breaker, cancellable
+from feedback_fanout import on_category_done, get_category_done
+
+# providers the 'auto' model chooses between (in order of preference until they have enough history to compare)
+ROUTER_PROVIDERS = [name.strip() for name in os.getenv('ROUTER_PROVIDERS', 'openai,anthropic').split(',') if name.strip()]
+# each provider's latency and error rate are measured over its last ROUTER_WINDOW_SIZE requests within ROUTER_WINDOW_SECONDS
+ROUTER_WINDOW_SIZE = int(os.getenv('ROUTER_WINDOW_SIZE', 100))
+ROUTER_WINDOW_SECONDS = float(os.getenv('ROUTER_WINDOW_SECONDS', 600))
+# requests a provider needs in the window before its latency is trusted - until then it is tried first, to measure it
+ROUTER_MIN_SAMPLES = int(os.getenv('ROUTER_MIN_SAMPLES', 5))
+# providers failing more than this fraction of their requests are only used when no other provider is healthy
+ROUTER_MAX_ERROR_RATE = float(os.getenv('ROUTER_MAX_ERROR_RATE', 0.5))
+# hedging - if the chosen provider hasn't answered within its p95 latency (but at least ROUTER_HEDGE_MIN_SECONDS, or
+# ROUTER_HEDGE_DEFAULT_SECONDS without enough history), the request is also sent to the next provider and the first answer wins.
+# slow requests then cost twice over, so it's off by default
+ROUTER_HEDGE_ENABLED = os.getenv('ROUTER_HEDGE_ENABLED', 'false').lower() == 'true'
+ROUTER_HEDGE_MIN_SECONDS = float(os.getenv('ROUTER_HEDGE_MIN_SECONDS', 5))
+ROUTER_HEDGE_DEFAULT_SECONDS = float(os.getenv('ROUTER_HEDGE_DEFAULT_SECONDS', 30))
+
+class ProviderStats:
+    # rolling latency (of successful requests) and error rate for one provider
+    def __init__(self, window_size: int = ROUTER_WINDOW_SIZE, window_seconds: float = ROUTER_WINDOW_SECONDS):
+        self._lock = threading.Lock()
+        self._samples = deque(maxlen=window_size)
+        self.window_seconds = window_seconds
+
+    def record(self, seconds: float, ok: bool):
+        with self._lock:
+            self._samples.append((time.time(), seconds, ok))
+
+    def get_stats(self) -> Dict[str, Any]:
+        cutoff = time.time() - self.window_seconds
+        with self._lock:
+            samples = [sample for sample in self._samples if sample[0] >= cutoff]
+        latencies = sorted(seconds for _, seconds, ok in samples if ok)
+        errors = sum(1 for _, _, ok in samples if not ok)
+        return {
+            "requests": len(samples),
+            "errors": errors,
+            "error_rate": round(errors / len(samples), 3) if samples else 0.0,
+            "p50": percentile(latencies, 0.5),
+            "p95": percentile(latencies, 0.95),
+            "healthy": len(samples) < ROUTER_MIN_SAMPLES or errors / len(samples) <= ROUTER_MAX_ERROR_RATE
+        }
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    # nearest-rank percentile of sorted values
+    if not values:
+        return None
+    return round(values[min(len(values) - 1, int(fraction * len(values)))], 3)
+
+# shared by every router in the process, so the stats route doesn't need one to exist
+provider_stats = {provider: ProviderStats() for provider in ROUTER_PROVIDERS}
+
+def get_router_stats() -> Dict[str, Any]:
+    return {provider: stats.get_stats() for provider, stats in provider_stats.items()}
+
+def is_input_error(e: Exception) -> bool:
+    # a ValueError about the request itself (eg a submission the chat engine can't read) - it isn't the provider's failure, so
+    # it is neither recorded against the provider nor retried on another one
+    return isinstance(e, ValueError) and not isinstance(e, ProviderError)
+
+def get_handler_args(function: Callable, request: Dict[str, Any]) -> Dict[str, Any]:
+    # the request's fields the handler accepts (eg anthropic has no assistant_id/thread_id/engine)
+    parameters = inspect.signature(function).parameters
+    return {field: value for field, value in request.items() if field in parameters}
+
+class ProviderRouter:
+    # handler for model='auto' - sends each request to the provider with the lowest recent p50 latency among those that are
+    # healthy, falling back to the next provider if it fails (and optionally hedging slow requests, see above)
+    provider = 'auto'
+
+    def __init__(self, get_handler: Callable[[str], Any], providers: List[str] = ROUTER_PROVIDERS, hedge: bool = ROUTER_HEDGE_ENABLED):
+        self.get_handler = get_handler
+        self.providers = providers
+        self.hedge = hedge
+
+    def rank_providers(self, request: Dict[str, Any]) -> List[str]:
+        # requests continuing an openai assistant/thread can only go to openai
+        if request.get('assistant_id') or request.get('thread_id'):
+            return ['openai']
+        def rank(provider: str):
+            stats = provider_stats[provider].get_stats()
+            # a provider whose circuit breaker is open would only fail straight away
+            if get_circuit_breaker(provider).is_open():
+                return (3, 0.0)
+            if stats['requests'] < ROUTER_MIN_SAMPLES:
+                return (0, 0.0)
+            return (1 if stats['healthy'] else 2, stats['p50'] if stats['p50'] is not None else float('inf'))
+        return sorted(self.providers, key=rank)
+
+    def generate_feedback(self, **request) -> Dict[str, Any]:
+        providers = self.rank_providers(request)
+        if self.hedge and len(providers) > 1:
+            return self._generate_hedged(providers, request)
+        for provider in providers[:-1]:
+            try:
+                return self._generate(provider, request)
+            except ValueError as e:
+                if is_input_error(e):
+                    raise
+                print(f'{provider} failed, trying {providers[providers.index(provider) + 1]}:', e)
+        return self._generate(providers[-1], request)
+
+    def stream_feedback(self, **request) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        # streams aren't hedged (events already sent can't be taken back), but fall back to the next provider if the chosen one
+        # fails before sending anything
+        providers = self.rank_providers(request)
+        for index, provider in enumerate(providers):
+            handler = self.get_handler(provider)
+            metrics.increment('routed_requests_total', provider=provider)
+            start = time.perf_counter()
+            started = False
+            try:
+                for event, data in handler.stream_feedback(**get_handler_args(handler.stream_feedback, request)):
+                    if event == 'submission':
+                        data = {**data, "provider": provider}
+                    started = True
+                    yield event, data
+            except Exception as e:
+                if is_input_error(e):
+                    raise
+                provider_stats[provider].record(time.perf_counter() - start, False)
+                if started or index == len(providers) - 1:
+                    raise
+                print(f'{provider} failed, trying {providers[index + 1]}:', e)
+                continue
+            provider_stats[provider].record(time.perf_counter() - start, True)
+            return
+
+    def _generate(self, provider: str, request: Dict[str, Any], cancelled: Optional[threading.Event] = None) -> Dict[str, Any]:
+        handler = self.get_handler(provider)
+        metrics.increment('routed_requests_total', provider=provider)
+        start = time.perf_counter()
+        try:
+            result = handler.generate_feedback(**get_handler_args(handler.generate_feedback, request))
+        except Exception as e:
+            # a call cancelled because the other provider answered first didn't fail
+            if not is_input_error(e) and not (cancelled and cancelled.is_set()):
+                provider_stats[provider].record(time.perf_counter() - start, False)
+            raise
+        provider_stats[provider].record(time.perf_counter() - start, True)
+        return result
+
+    def _get_hedge_delay(self, provider: str) -> float:
+        stats = provider_stats[provider].get_stats()
+        if stats['requests'] < ROUTER_MIN_SAMPLES or stats['p95'] is None:
+            return ROUTER_HEDGE_DEFAULT_SECONDS
+        return max(ROUTER_HEDGE_MIN_SECONDS, stats['p95'])
+
+    def _generate_hedged(self, providers: List[str], request: Dict[str, Any]) -> Dict[str, Any]:
+        # the first provider gets the request straight away and the second once the first has taken longer than its p95 (or
+        # failed) - whichever answers first is returned, and the other is cancelled: its provider calls stop at their next http
+        # request or chunk of response (see transport.py), and its result is discarded
+        primary, secondary = providers[:2]
+        executor = ThreadPoolExecutor(max_workers=2)
+        cancel_events = {provider: threading.Event() for provider in (primary, secondary)}
+        category_done = get_category_done()
+        reporting = {}
+        reporting_lock = threading.Lock()
+
+        def generate(provider: str) -> Dict[str, Any]:
+            # only one call's categories are passed on as they finish (eg to a job's partial results) - the first to finish
+            # one, unless it is cancelled - so the two providers' results are never mixed
+            def report(category: str, result: Any):
+                with reporting_lock:
+                    if cancel_events[provider].is_set() or reporting.setdefault('provider', provider) != provider:
+                        return
+                if category_done:
+                    category_done(category, result)
+            with cancellable(cancel_events[provider]), on_category_done(report):
+                return self._generate(provider, request, cancel_events[provider])
+
+        futures = {executor.submit(contextvars.copy_context().run, generate, primary): primary}
+        hedge_at = time.time() + self._get_hedge_delay(primary)
+        hedged = False
+        error = None
+        try:
+            while futures:
+                done, _ = wait(futures, timeout=None if hedged else max(0.0, hedge_at - time.time()), return_when=FIRST_COMPLETED)
+                for future in done:
+                    provider = futures.pop(future)
+                    try:
+                        return future.result()
+                    except Exception as e:
+                        if is_input_error(e):
+                            raise
+                        print(f'{provider} failed:', e)
+                        error = e
+                if not hedged and (not done or not futures):
+                    print(f'hedging {primary} request with {secondary}')
+                    metrics.increment('hedged_requests_total', provider=primary)
+                    futures[executor.submit(contextvars.copy_context().run, generate, secondary)] = secondary
+                    hedged = True
+            raise error
+        finally:
+            for future, provider in futures.items():
+                cancel_events[provider].set()
+                future.cancel()
+            executor.shutdown(wait=False)
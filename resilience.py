@@ -0,0 +1,148 @@
+# resilience.py
+
+import os
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Dict, Any, Optional
+from metrics import metrics
+
+# provider errors, request deadlines and circuit breakers - kept free of http dependencies, as app.py imports this at startup.
+# every provider http call goes through ResilientTransport (see transport.py), which retries transient failures, stops calling
+# a provider whose circuit is open and keeps each call within what is left of its request's deadline
+
+# consecutive failures (5xx, timeouts, connection errors - not 429s) that open a provider's circuit, and how long it stays open
+# before one trial request is let through
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', 5))
+CIRCUIT_RESET_SECONDS = float(os.getenv('CIRCUIT_RESET_SECONDS', 30))
+# overall time allowed for a feedback request's provider calls (0 for no deadline)
+REQUEST_DEADLINE_SECONDS = float(os.getenv('REQUEST_DEADLINE_SECONDS', 300))
+
+class ProviderError(ValueError):
+    # a provider failing a request (an api error, an open circuit, its rate limit) - as opposed to a plain ValueError about
+    # the request itself (eg a file it can't read), which isn't held against the provider
+    pass
+
+class CallCancelled(Exception):
+    pass
+
+class CircuitOpenError(ProviderError):
+    def __init__(self, provider: str, retry_after: float):
+        super().__init__(f"{provider} is unavailable after repeated errors, try again in {retry_after:.0f}s")
+        self.provider = provider
+        self.retry_after = retry_after
+
+# the deadline is a context variable, so it follows the request into the threads feedback_fanout runs categories on
+_deadline = contextvars.ContextVar('deadline', default=None)
+
+@contextmanager
+def deadline(seconds: float = REQUEST_DEADLINE_SECONDS):
+    # provider calls made inside this block (at any depth) must finish within seconds of entering it - nested deadlines can
+    # only shorten it
+    if not seconds:
+        yield
+        return
+    current = _deadline.get()
+    token = _deadline.set(min(current, time.time() + seconds) if current else time.time() + seconds)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+def get_remaining_seconds() -> Optional[float]:
+    current = _deadline.get()
+    return None if current is None else current - time.time()
+
+# set once a call's answer is no longer wanted (the slower of two hedged calls, see provider_router.py) - also a context
+# variable, so it reaches every provider call the request makes
+_cancelled = contextvars.ContextVar('cancelled', default=None)
+
+@contextmanager
+def cancellable(event: threading.Event):
+    # provider calls made inside this block stop (raising CallCancelled) at their next http request or chunk of response body
+    # once event is set
+    token = _cancelled.set(event)
+    try:
+        yield
+    finally:
+        _cancelled.reset(token)
+
+def get_cancel_event() -> Optional[threading.Event]:
+    return _cancelled.get()
+
+def check_cancelled():
+    event = _cancelled.get()
+    if event is not None and event.is_set():
+        raise CallCancelled('the call was cancelled')
+
+def provider_error(e: Exception, name: str) -> ProviderError:
+    # the ValueError a provider sdk error is reported as - a circuit breaker rejection (which the sdk wraps as a connection
+    # error) keeps its own type and retry_after
+    if isinstance(e.__cause__, CircuitOpenError):
+        return e.__cause__
+    return ProviderError(f"{name} API error: {str(e)}")
+
+class CircuitBreaker:
+    def __init__(self, provider: str, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD, reset_seconds: float = CIRCUIT_RESET_SECONDS):
+        self.provider = provider
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_in_flight = False
+
+    def before_request(self):
+        # raises CircuitOpenError while the circuit is open - once it has been open for reset_seconds, a single trial request
+        # is let through (half open), and its outcome closes or re-opens the circuit
+        with self._lock:
+            if self.state == 'closed':
+                return
+            retry_after = self.opened_at + self.reset_seconds - time.time()
+            if self.state == 'open' and retry_after <= 0:
+                self.state = 'half_open'
+            if self.state == 'open' or self._trial_in_flight:
+                raise CircuitOpenError(self.provider, max(retry_after, 1.0))
+            self._trial_in_flight = True
+
+    def record_success(self):
+        with self._lock:
+            self.state = 'closed'
+            self.failures = 0
+            self._trial_in_flight = False
+
+    def release_trial(self):
+        # for a call that ended without saying anything about the provider (eg an error raised before it was sent) - a half
+        # open circuit lets the next call through as its trial instead
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_in_flight = False
+            if self.state == 'half_open' or (self.state == 'closed' and self.failures >= self.failure_threshold):
+                if self.state == 'closed':
+                    print(f'{self.provider} circuit opened after {self.failures} consecutive failures')
+                self.state = 'open'
+                self.opened_at = time.time()
+                metrics.increment('circuit_opened_total', provider=self.provider)
+
+    def is_open(self) -> bool:
+        with self._lock:
+            return self.state == 'open' and time.time() < self.opened_at + self.reset_seconds
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"state": self.state, "consecutive_failures": self.failures}
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+def get_circuit_breaker(provider: str) -> CircuitBreaker:
+    with _breakers_lock:
+        if provider not in _breakers:
+            _breakers[provider] = CircuitBreaker(provider)
+        return _breakers[provider]
@@ -0,0 +1,105 @@
+# stream_parser.py
+
+import re
+import json
+from typing import List
+
+class BulletStreamParser:
+    # incrementally pulls the bullet strings out of streamed '{"<category>": ["- ...", "- ..."]}' output,
+    # returning each bullet as soon as its closing quote arrives rather than waiting for the whole response.
+    # it only tracks strings and brackets, so it tolerates what the models commonly get wrong - code fences, single-quoted
+    # (python style) strings, trailing commas, and output cut off part way through by max_completion_tokens
+    def __init__(self):
+        self.bullets = []
+        self.truncated = False
+        self._depth = 0
+        self._seen_array = False
+        self._quote = None
+        self._escape = False
+        self._current = []
+        # a single quote inside a single-quoted string, and the whitespace after it, until the next character shows whether it
+        # closed the string or was an apostrophe (eg "don't")
+        self._pending = None
+        self._previous = ''
+        self._raw = []
+
+    def feed(self, text: str) -> List[str]:
+        self._raw.append(text)
+        completed = []
+        for char in text:
+            if self._pending is not None:
+                if char.isspace():
+                    self._pending.append(char)
+                    continue
+                if char in ',]}:':
+                    self._end_string(completed)
+                else:
+                    self._current.extend(self._pending)
+                    self._pending = None
+            if self._quote:
+                if self._escape:
+                    self._escape = False
+                elif char == '\\':
+                    self._escape = True
+                elif char == "'" and self._quote == "'":
+                    # only ends the string if what follows it is json punctuation
+                    self._pending = [char]
+                    continue
+                elif char == self._quote:
+                    self._end_string(completed)
+                    continue
+                self._current.append(char)
+                continue
+            if char == '"' or (char == "'" and self._previous in ('[', '{', ',', ':')):
+                self._quote = char
+            elif char == '[':
+                self._depth += 1
+                self._seen_array = True
+            elif char == ']':
+                self._depth = max(0, self._depth - 1)
+            if not char.isspace():
+                self._previous = char
+        self.bullets.extend(completed)
+        return completed
+
+    def close(self) -> List[str]:
+        # call once the output has ended - returns any bullets only recoverable from the output as a whole (a plain '- ...' list
+        # without any JSON). a bullet cut off part way through is dropped, since half a correction would highlight the wrong text
+        completed = []
+        # output ending just after a single quote - it closed the last string
+        if self._pending is not None:
+            self._end_string(completed)
+        self.truncated = self._quote is not None or self._depth > 0
+        if not self._seen_array:
+            completed = [line.strip() for line in ''.join(self._raw).splitlines() if re.match(r'\s*[-*•] ', line)]
+        self.bullets.extend(completed)
+        return completed
+
+    def _end_string(self, completed: List[str]):
+        # strings outside the bullet array are the category key
+        if self._depth > 0:
+            completed.append(self._decode(''.join(self._current), self._quote))
+        self._previous = self._quote
+        self._quote = None
+        self._current = []
+        self._pending = None
+
+    def _decode(self, raw: str, quote: str) -> str:
+        if quote == "'":
+            raw = raw.replace("\\'", "'").replace('"', '\\"')
+        try:
+            return json.loads(f'"{raw}"')
+        except json.JSONDecodeError:
+            # models sometimes emit invalid escapes (eg 'word\phrase'), so keep the raw text in that case
+            return raw.replace('\\"', '"')
+
+def parse_category_output(output: str) -> List[str]:
+    # every bullet in a complete (non-streamed) category output
+    parser = BulletStreamParser()
+    parser.feed(output or '')
+    parser.close()
+    if parser.truncated:
+        print(f'category output was cut off, recovered {len(parser.bullets)} bullets')
+    elif not parser.bullets and (output or '').strip():
+        print(f'no bullets found in category output: {output}')
+    return parser.bullets
@@ -0,0 +1,67 @@
+# stub_handler.py
+
+import os
+import re
+import json
+import time
+from typing import Dict, Any, List, Union, Iterator, Tuple
+from openai_handler import OpenAIHandler
+from feedback_fanout import fan_out, merge_category_results, get_common_result
+from pdf_text import extract_pdf_text
+from metrics import timed
+
+# offline stand-in provider (model='stub') that returns canned feedback without calling any api, so the request, streaming and
+# batch pipelines can be exercised locally (enable with ENABLE_STUB_PROVIDER=true) - it reuses the openai handler's output formatting,
+# so responses have the same schema
+STUB_LATENCY_SECONDS = float(os.getenv('STUB_LATENCY_SECONDS', 0))
+
+class StubHandler(OpenAIHandler):
+    provider = 'stub'
+
+    def __init__(self):
+        pass
+
+    @timed('generate_feedback')
+    def generate_feedback(self, assignment_id: str, assignment_title: str, question_id: str, question_title: str, subject: str, 
+                          qualification: str, feedback_category: Union[str, List[str]], submission: str, mark_scheme: str, 
+                          max_completion_tokens: int, temperature: float, assistant_id: str = None, thread_id: str = None) -> Dict[str, Any]:
+        feedback_categories = feedback_category if isinstance(feedback_category, list) else [feedback_category]
+        submission = self._get_submission(submission)
+        def run_category(category: str) -> Dict[str, Any]:
+            output = self._get_run_output(category, submission)
+            return {"status": "completed", "feedback": self._format_category_output(output, category, submission)}
+        return get_common_result(merge_category_results(fan_out(run_category, feedback_categories), submission), self.provider, 'stub', feedback_categories)
+
+    @timed('stream_feedback')
+    def stream_feedback(self, assignment_id: str, assignment_title: str, question_id: str, question_title: str, subject: str, 
+                        qualification: str, feedback_category: Union[str, List[str]], submission: str, mark_scheme: str, 
+                        max_completion_tokens: int, temperature: float, assistant_id: str = None, thread_id: str = None) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        feedback_categories = feedback_category if isinstance(feedback_category, list) else [feedback_category]
+        submission = self._get_submission(submission)
+        yield 'submission', {"submission": submission}
+        for category in feedback_categories:
+            unique_parts = set()
+            for bullet in json.loads(self._get_run_output(category, submission))[category]:
+                yield 'feedback', {"category": category, "feedback": self._format_bullet(bullet, category, submission, unique_parts)}
+            yield 'category_done', {"category": category, "status": "completed"}
+
+    # no provider batch api, so batches are always graded concurrently
+    submit_batch = None
+
+    def _get_submission(self, submission: str) -> str:
+        if not os.path.isfile(submission):
+            return submission
+        if submission.lower().endswith('.pdf'):
+            return extract_pdf_text(submission)
+        with open(submission, encoding='utf-8', errors='replace') as file:
+            return file.read()
+
+    def _get_run_output(self, category: str, submission: str) -> str:
+        # deterministic 'model output' in the same JSON format the real providers are asked for
+        time.sleep(STUB_LATENCY_SECONDS)
+        words = sorted(set(re.findall(r'[A-Za-z]{8,}', submission)), key=lambda word: (-len(word), word))[:3]
+        if category in ['SPaG', 'historical_accuracy']:
+            bullets = [f"- `{word} -> {word.upper()}`" for word in words]
+        else:
+            bullets = [f"- `Stub {category} comment {i + 1} ({len(submission)} characters)`" for i in range(3)]
+        return json.dumps({category: bullets})
@@ -0,0 +1,7 @@
+# tests/conftest.py
+
+import os
+import sys
+
+# the modules live at the repo root rather than in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
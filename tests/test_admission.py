@@ -0,0 +1,112 @@
+# tests/test_admission.py
+
+import pytest
+import admission
+from admission import AdmissionController, AdmissionError, MemoryBucketStore, SQLiteBucketStore
+
+CAPACITY = 600  # tokens per minute, so 10 a second
+
+class FakeClock:
+    # stands in for time.time, and for time.sleep so queued requests wait without the test waiting
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(admission.time, 'time', clock.time)
+    monkeypatch.setattr(admission.time, 'sleep', clock.sleep)
+    # no jitter, so a queued request waits exactly until the bucket has refilled
+    monkeypatch.setattr(admission.random, 'uniform', lambda low, high: low)
+    return clock
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    if request.param == 'sqlite':
+        return SQLiteBucketStore(str(tmp_path / 'admission.sqlite3'))
+    return MemoryBucketStore()
+
+def test_take_from_a_full_bucket(clock, store):
+    assert store.take('openai:model', CAPACITY, 400) == (True, 0.0)
+    admitted, wait = store.take('openai:model', CAPACITY, 400)
+    assert not admitted
+    assert wait == pytest.approx(20.0)
+
+def test_bucket_refills_at_its_rate(clock, store):
+    store.take('openai:model', CAPACITY, CAPACITY)
+    clock.now += 30
+    assert store.take('openai:model', CAPACITY, 301)[0] is False
+    assert store.take('openai:model', CAPACITY, 300) == (True, 0.0)
+    # never refills past its capacity
+    clock.now += 3600
+    assert store.take('openai:model', CAPACITY, CAPACITY + 1)[0] is True
+    # the one token over capacity is owed, so a single token is 2 tokens (0.2s) away
+    assert store.take('openai:model', CAPACITY, 1)[1] == pytest.approx(0.2)
+
+def test_oversized_request_waits_for_a_full_bucket_and_leaves_it_in_debt(clock, store):
+    store.take('openai:model', CAPACITY, 100)
+    admitted, wait = store.take('openai:model', CAPACITY, 2 * CAPACITY)
+    assert not admitted
+    assert wait == pytest.approx(10.0)
+    clock.now += 10
+    assert store.take('openai:model', CAPACITY, 2 * CAPACITY) == (True, 0.0)
+    # the debt is paid back before anything else is admitted
+    assert store.take('openai:model', CAPACITY, 60)[1] == pytest.approx(66.0)
+
+def test_give_refunds_unused_tokens(clock, store):
+    store.take('openai:model', CAPACITY, 500)
+    store.give('openai:model', CAPACITY, 300)
+    assert store.take('openai:model', CAPACITY, 400) == (True, 0.0)
+    # refunds can't overfill the bucket
+    store.give('openai:model', CAPACITY, 10 * CAPACITY)
+    assert store.take('openai:model', CAPACITY, CAPACITY) == (True, 0.0)
+    assert store.take('openai:model', CAPACITY, 1)[0] is False
+
+def test_give_takes_more_for_usage_over_the_estimate(clock, store):
+    store.take('openai:model', CAPACITY, 100)
+    store.give('openai:model', CAPACITY, -200)
+    assert store.take('openai:model', CAPACITY, 301)[0] is False
+    assert store.take('openai:model', CAPACITY, 300) == (True, 0.0)
+
+def test_buckets_are_per_key(clock, store):
+    store.take('openai:model', CAPACITY, CAPACITY)
+    assert store.take('openai:other-model', CAPACITY, CAPACITY) == (True, 0.0)
+
+def test_acquire_queues_for_refill_then_release_refunds(clock, store):
+    controller = AdmissionController(store, {'openai': CAPACITY}, max_wait=30)
+    controller.acquire('openai', 'model', CAPACITY)
+    reservation = controller.acquire('openai', 'model', 100)
+    assert reservation == {"key": "openai:model", "capacity": CAPACITY, "tokens": 100}
+    assert sum(clock.slept) == pytest.approx(10.0)
+
+    # the request only used 40 of its 100 tokens, so 60 go back
+    controller.release(reservation, 40)
+    assert store.take('openai:model', CAPACITY, 60) == (True, 0.0)
+    assert store.take('openai:model', CAPACITY, 1)[0] is False
+
+def test_release_without_reported_usage_keeps_the_estimate(clock, store):
+    controller = AdmissionController(store, {'openai': CAPACITY})
+    reservation = controller.acquire('openai', 'model', CAPACITY)
+    controller.release(reservation, None)
+    assert store.take('openai:model', CAPACITY, 1)[0] is False
+
+def test_acquire_turns_away_requests_that_would_wait_too_long(clock, store):
+    controller = AdmissionController(store, {'openai': CAPACITY}, max_wait=5)
+    controller.acquire('openai', 'model', CAPACITY)
+    with pytest.raises(AdmissionError) as error:
+        controller.acquire('openai', 'model', 100)
+    assert error.value.retry_after == pytest.approx(10.0)
+    assert clock.slept == []
+
+def test_providers_without_a_limit_are_always_admitted(clock, store):
+    controller = AdmissionController(store, {'openai': 0})
+    assert controller.acquire('openai', 'model', 10 * CAPACITY) is None
+    assert controller.acquire('anthropic', 'model', 10 * CAPACITY) is None
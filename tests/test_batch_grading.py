@@ -0,0 +1,149 @@
+# tests/test_batch_grading.py
+
+import json
+import time
+import threading
+import pytest
+from batch_grading import BatchStore, start_batch, poll_batch
+from stub_handler import StubHandler
+
+FEEDBACK_ARGS = dict(assignment_id='a1', assignment_title='Assignment', question_id='q1', question_title='Question', subject='History',
+                     qualification='GCSE', feedback_category=['SPaG', 'overall_comments'], mark_scheme='Mark scheme text',
+                     max_completion_tokens=1000, temperature=0.0)
+SUBMISSIONS = {f'student_{i}': f'Submission {i} about the Afganistan conflict and its consequences' for i in range(5)}
+
+class ProviderBatchStubHandler(StubHandler):
+    # a stub with a provider batch api, whose results are ready from the second poll on
+    def __init__(self):
+        self.polls = 0
+        self.submitting = threading.Event()
+        self.submitting.set()
+
+    def submit_batch(self, submissions, **kwargs):
+        self.submitting.wait(10)
+        self.submissions = submissions
+        self.feedback_args = kwargs
+        return {"provider_batch_id": "batch_stub"}
+
+    def get_batch_results(self, batch):
+        self.polls += 1
+        if self.polls == 1:
+            return None
+        time.sleep(0.05)
+        return [{"student_id": student_id, **self.generate_feedback(submission=submission, **self.feedback_args)}
+                for student_id, submission in self.submissions.items()]
+
+def read_results(store, batch_id):
+    with open(store.results_path(batch_id), encoding='utf-8') as file:
+        return [json.loads(line) for line in file]
+
+def wait_for_submission(store, batch_id, timeout=10):
+    end = time.time() + timeout
+    while time.time() < end:
+        batch = store.get(batch_id)
+        if batch.get('provider_batch_id') or batch['status'] != 'in_progress' or batch['mode'] != 'provider':
+            return batch
+        time.sleep(0.01)
+    raise AssertionError(f'batch {batch_id} was not submitted')
+
+def wait_for(store, batch_id, timeout=10):
+    end = time.time() + timeout
+    while time.time() < end:
+        batch = store.get(batch_id)
+        if batch['status'] != 'in_progress':
+            return batch
+        time.sleep(0.01)
+    raise AssertionError(f'batch {batch_id} did not finish')
+
+def test_auto_mode_falls_back_to_concurrent_grading(tmp_path):
+    store = BatchStore(str(tmp_path))
+    batch = start_batch(store, 'stub', StubHandler(), FEEDBACK_ARGS, SUBMISSIONS)
+    assert batch['mode'] == 'concurrent'
+    batch = wait_for(store, batch['batch_id'])
+    assert batch['status'] == 'completed'
+    assert (batch['completed'], batch['failed']) == (len(SUBMISSIONS), 0)
+    records = read_results(store, batch['batch_id'])
+    assert sorted(record['student_id'] for record in records) == sorted(SUBMISSIONS)
+    for record in records:
+        assert record['status'] == 'completed'
+        assert set(record['categories']) == {'SPaG', 'overall_comments'}
+
+def test_concurrent_results_match_single_requests(tmp_path):
+    store = BatchStore(str(tmp_path))
+    handler = StubHandler()
+    batch = wait_for(store, start_batch(store, 'stub', handler, FEEDBACK_ARGS, SUBMISSIONS, batch_mode='concurrent')['batch_id'])
+    for record in read_results(store, batch['batch_id']):
+        expected = handler.generate_feedback(submission=SUBMISSIONS[record['student_id']], **FEEDBACK_ARGS)
+        assert record['feedback'] == expected['feedback']
+
+def test_provider_mode_without_batch_api_raises(tmp_path):
+    with pytest.raises(ValueError):
+        start_batch(BatchStore(str(tmp_path)), 'stub', StubHandler(), FEEDBACK_ARGS, SUBMISSIONS, batch_mode='provider')
+
+def test_invalid_batch_mode_raises(tmp_path):
+    with pytest.raises(ValueError):
+        start_batch(BatchStore(str(tmp_path)), 'stub', StubHandler(), FEEDBACK_ARGS, SUBMISSIONS, batch_mode='overnight')
+
+def test_poll_writes_provider_results_once(tmp_path):
+    store = BatchStore(str(tmp_path))
+    handler = ProviderBatchStubHandler()
+    batch = start_batch(store, 'stub', handler, FEEDBACK_ARGS, SUBMISSIONS, batch_mode='provider')
+    assert batch['mode'] == 'provider'
+    wait_for_submission(store, batch['batch_id'])
+    assert poll_batch(store, batch['batch_id'], handler)['status'] == 'in_progress'
+
+    # concurrent polls all fetch the finished results, but only the first may write them
+    threads = [threading.Thread(target=poll_batch, args=(store, batch['batch_id'], handler)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    batch = store.get(batch['batch_id'])
+    assert batch['status'] == 'completed'
+    assert (batch['completed'], batch['failed']) == (len(SUBMISSIONS), 0)
+    records = read_results(store, batch['batch_id'])
+    assert sorted(record['student_id'] for record in records) == sorted(SUBMISSIONS)
+
+    # later polls leave a finished batch alone
+    polls = handler.polls
+    assert poll_batch(store, batch['batch_id'], handler)['status'] == 'completed'
+    assert handler.polls == polls
+    assert len(read_results(store, batch['batch_id'])) == len(SUBMISSIONS)
+
+def test_poll_marks_failed_provider_batches(tmp_path):
+    class FailingHandler(ProviderBatchStubHandler):
+        def get_batch_results(self, batch):
+            raise ValueError('Batch batch_stub failed: expired')
+
+    store = BatchStore(str(tmp_path))
+    handler = FailingHandler()
+    batch = start_batch(store, 'stub', handler, FEEDBACK_ARGS, SUBMISSIONS)
+    wait_for_submission(store, batch['batch_id'])
+    batch = poll_batch(store, batch['batch_id'], handler)
+    assert batch['status'] == 'failed'
+    assert batch['error'] == 'Batch batch_stub failed: expired'
+    assert read_results(store, batch['batch_id']) == []
+
+def test_provider_batch_is_submitted_in_the_background(tmp_path):
+    store = BatchStore(str(tmp_path))
+    handler = ProviderBatchStubHandler()
+    handler.submitting.clear()
+    batch = start_batch(store, 'stub', handler, FEEDBACK_ARGS, SUBMISSIONS, batch_mode='provider')
+    # returned before the submissions are transcribed and submitted, and not polled with the provider until they are
+    assert batch['status'] == 'in_progress' and 'provider_batch_id' not in batch
+    assert poll_batch(store, batch['batch_id'], handler)['status'] == 'in_progress'
+    assert handler.polls == 0
+    handler.submitting.set()
+    assert wait_for_submission(store, batch['batch_id'])['provider_batch_id'] == 'batch_stub'
+
+@pytest.mark.parametrize('batch_mode, status, mode', [('auto', 'completed', 'concurrent'), ('provider', 'failed', 'provider')])
+def test_failed_provider_submission(tmp_path, batch_mode, status, mode):
+    # auto mode falls back to grading concurrently, provider mode fails the batch
+    class FailingHandler(ProviderBatchStubHandler):
+        def submit_batch(self, submissions, **kwargs):
+            raise ValueError('Could not transcribe submission for student_0')
+
+    store = BatchStore(str(tmp_path))
+    batch = wait_for(store, start_batch(store, 'stub', FailingHandler(), FEEDBACK_ARGS, SUBMISSIONS, batch_mode=batch_mode)['batch_id'])
+    assert (batch['status'], batch['mode']) == (status, mode)
+    assert len(read_results(store, batch['batch_id'])) == (len(SUBMISSIONS) if status == 'completed' else 0)
@@ -0,0 +1,53 @@
+# tests/test_highlight_matching.py
+
+from highlight_matching import HighlightIndex, find_highlights, normalize_text, parse_bullet, split_correction
+
+SUBMISSION = "In 1979 the Soviet   invasion of\nAfganistan began. Billions of “dollars” were spent — and disscontent grew.\nAfganistan again."
+
+def spans_text(spans, submission=SUBMISSION):
+    return [submission[start:end] for start, end in spans]
+
+def test_normalize_text_maps_back_to_original_offsets():
+    text = "  Soviet   Invasion\n— “Afganistan”… "
+    normalized, offsets = normalize_text(text)
+    assert normalized == 'soviet invasion - "afganistan"...'
+    assert len(offsets) == len(normalized)
+    assert offsets[0] == text.index('Soviet')
+    assert offsets[normalized.index('invasion')] == text.index('Invasion')
+    assert offsets[normalized.index('-')] == text.index('—')
+    # the ellipsis expands to three normalised characters, all pointing at the one original character
+    assert offsets[-3:] == [text.index('…')] * 3
+
+def test_exact_matches_map_to_original_spans():
+    # whitespace, line breaks, case and quote/dash style are ignored, but the spans are of the original text
+    assert spans_text(find_highlights('soviet invasion of afganistan', SUBMISSION)) == ['Soviet   invasion of\nAfganistan']
+    assert spans_text(find_highlights('"dollars" were spent - and', SUBMISSION)) == ['“dollars” were spent — and']
+
+def test_every_exact_match_is_returned():
+    assert spans_text(find_highlights('Afganistan', SUBMISSION)) == ['Afganistan', 'Afganistan']
+
+def test_whole_words_only():
+    submission = "There are therefore three reasons, and they're there."
+    assert spans_text(find_highlights('there', submission), submission) == ['There', 'there']
+    assert find_highlights('fore', submission) == []
+
+def test_fuzzy_fallback_finds_the_closest_run_of_words():
+    # no exact match, so the most similar run of words (above HIGHLIGHT_FUZZY_THRESHOLD) is used
+    assert spans_text(find_highlights('Billions of dolars were spend', SUBMISSION)) == ['Billions of “dollars” were spent']
+
+def test_fuzzy_fallback_ignores_dissimilar_and_short_phrases():
+    assert find_highlights('the treaty of versailles', SUBMISSION) == []
+    assert find_highlights('gre', SUBMISSION) == []
+
+def test_find_all_matches_many_phrases_at_once():
+    index = HighlightIndex(SUBMISSION)
+    matches = index.find_all(['Afganistan', 'disscontent', 'invasion of afganistan', 'missing phrase here'])
+    assert spans_text(matches['Afganistan']) == ['Afganistan', 'Afganistan']
+    assert spans_text(matches['disscontent']) == ['disscontent']
+    assert spans_text(matches['invasion of afganistan']) == ['invasion of\nAfganistan']
+    assert matches['missing phrase here'] == []
+
+def test_bullet_parsing():
+    assert parse_bullet('- `Afganistan -> Afghanistan`【4:0†source】') == ('`Afganistan -> Afghanistan`', '4:0†source')
+    assert split_correction("`Afganistan` -> 'Afghanistan'") == ('Afganistan', 'Afghanistan')
+    assert split_correction('Good work') is None
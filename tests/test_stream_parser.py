@@ -0,0 +1,43 @@
+# tests/test_stream_parser.py
+
+import pytest
+from stream_parser import BulletStreamParser, parse_category_output
+
+def feed_in_chunks(output, size):
+    parser = BulletStreamParser()
+    bullets = []
+    for start in range(0, len(output), size):
+        bullets.extend(parser.feed(output[start:start + size]))
+    bullets.extend(parser.close())
+    return parser, bullets
+
+def test_json_output():
+    output = '{"SPaG": ["- `Afganistan -> Afghanistan`", "- `disscontent -> discontent`"]}'
+    assert parse_category_output(output) == ['- `Afganistan -> Afghanistan`', '- `disscontent -> discontent`']
+
+def test_code_fence_and_trailing_comma():
+    output = '```json\n{"SPaG": [\n  "- `Afganistan -> Afghanistan`",\n]}\n```'
+    assert parse_category_output(output) == ['- `Afganistan -> Afghanistan`']
+
+def test_truncated_output_keeps_complete_bullets():
+    parser, bullets = feed_in_chunks('{"SPaG": ["- `Afganistan -> Afghanistan`", "- `disscontent -> disc', 7)
+    assert bullets == ['- `Afganistan -> Afghanistan`']
+    assert parser.truncated
+
+@pytest.mark.parametrize('size', [1, 3, 1000])
+def test_single_quoted_strings_with_apostrophes(size):
+    output = "{'SPaG': ['- `dont -> don't`', '- `the students' work -> the students\\' work` ' , '- `its -> it's`']}"
+    parser, bullets = feed_in_chunks(output, size)
+    assert bullets == ["- `dont -> don't`", "- `the students' work -> the students' work` ", "- `its -> it's`"]
+    assert not parser.truncated
+
+def test_single_quoted_output_ending_after_a_string():
+    parser, bullets = feed_in_chunks("['- `dont -> don't`'", 1)
+    assert bullets == ["- `dont -> don't`"]
+    assert parser.truncated
+
+def test_double_quoted_strings_keep_apostrophes():
+    assert parse_category_output('{"SPaG": ["- `dont -> don\'t`"]}') == ["- `dont -> don't`"]
+
+def test_plain_bullet_list():
+    assert parse_category_output('Feedback:\n- `Good work`\n* `Check your dates`\nThanks') == ['- `Good work`', '* `Check your dates`']
@@ -0,0 +1,91 @@
+# transcription.py
+
+import os
+import hashlib
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Callable, Optional
+from pdf_text import extract_pdf_pages
+from pdf_render import render_pdf_pages
+from cache_store import transcription_cache
+
+# pages of one submission transcribed at once (one llm call each), so a multi-page answer takes about as long as its slowest page
+TRANSCRIPTION_MAX_WORKERS = int(os.getenv('TRANSCRIPTION_MAX_WORKERS', 4))
+PAGE_SEPARATOR = '\n\n'
+
+def transcribe_pdf(file_path: str, transcribe_page: Callable[[int], str], max_workers: int = TRANSCRIPTION_MAX_WORKERS,
+                   render_pages: Callable[[str], Any] = render_pdf_pages) -> Optional[str]:
+    # the submission text, page by page in order - each page's own text layer where it is good enough (typed pdfs), otherwise
+    # transcribe_page(page_number), run concurrently for all the pages that need it. where each page starts and ends in the
+    # text is recorded for get_submission_pages. returns None if the file isn't a readable pdf, for the caller to transcribe
+    # it whole instead. render_pages(file_path) is whatever (cached) rendering transcribe_page uses
+    if not is_pdf(file_path):
+        return None
+    try:
+        pages = extract_pdf_pages(file_path)
+    except Exception as e:
+        print('text layer extraction failed:', e)
+        return None
+    if not pages:
+        return None
+
+    print('text layer quality by page:', [page['quality'] for page in pages])
+    page_numbers = [page['page'] for page in pages if page['needs_transcription']]
+    transcriptions = {}
+    if page_numbers:
+        # rendered (and cached) once here, rather than by every page's call at the same time
+        render_pages(file_path)
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(page_numbers)))) as executor:
+            # each page runs in a copy of the caller's context, so the request's deadline (resilience.py) applies to it too
+            futures = {page_number: executor.submit(contextvars.copy_context().run, transcribe_page, page_number) for page_number in page_numbers}
+            transcriptions = {page_number: future.result() for page_number, future in futures.items()}
+
+    texts, submission_pages, position = [], [], 0
+    for page in pages:
+        text = (transcriptions[page['page']] if page['needs_transcription'] else page['text']).strip()
+        if not text:
+            continue
+        if texts:
+            position += len(PAGE_SEPARATOR)
+        submission_pages.append({"page": page['page'], "start": position, "end": position + len(text),
+                                 "source": "transcription" if page['needs_transcription'] else "text_layer"})
+        texts.append(text)
+        position += len(text)
+    submission = PAGE_SEPARATOR.join(texts)
+    transcription_cache.set(_pages_key(submission), submission_pages)
+    return submission
+
+def is_pdf(file_path: Optional[str]) -> bool:
+    return bool(file_path) and os.path.splitext(file_path)[1].lower() == '.pdf' and os.path.isfile(file_path)
+
+def _pages_key(submission: str) -> str:
+    # keyed by the text itself, so the pages can be found from any handler's (or cached) transcription
+    return f"pages:{hashlib.sha256(submission.encode('utf-8')).hexdigest()}"
+
+def get_submission_pages(submission: Optional[str], source: Optional[str]) -> Optional[List[Dict[str, Any]]]:
+    # [{"page", "start", "end", "source"}, ...] for a submission transcribed by transcribe_pdf from the pdf source (the submission
+    # as the request gave it), otherwise None - other submissions are never looked up, so they don't count as cache misses
+    if not submission or not is_pdf(source):
+        return None
+    return transcription_cache.get(_pages_key(submission))
+
+def get_page(offset: int, submission_pages: List[Dict[str, Any]]) -> Optional[int]:
+    for page in submission_pages:
+        if offset < page['end']:
+            return page['page'] if offset >= page['start'] else None
+    return None
+
+def add_submission_pages(result: Dict[str, Any], source: Optional[str]) -> Dict[str, Any]:
+    # adds the submission's page boundaries and the page each highlight starts on (a list, like its 'start'), so clients can
+    # map highlights back to the original pages
+    submission_pages = get_submission_pages(result.get('submission'), source)
+    if not submission_pages:
+        return result
+    def get_pages(start):
+        if start is None:
+            return None
+        if isinstance(start, list):
+            return [get_page(offset, submission_pages) for offset in start]
+        return get_page(start, submission_pages)
+    feedback = [{**item, "page": get_pages(item.get('start'))} for item in result.get('feedback') or []]
+    return {**result, "feedback": feedback, "submission_pages": submission_pages}
@@ -0,0 +1,293 @@
+# transport.py
+
+import os
+import time
+import random
+import threading
+from email.utils import parsedate_to_datetime
+from typing import Dict, Any, Optional
+import httpx
+from metrics import metrics
+from resilience import CallCancelled, get_circuit_breaker, get_remaining_seconds, get_cancel_event, check_cancelled
+
+# one pooled http client per provider, shared by every request in the process so connections (and their TLS sessions) are reused
+HTTP_POOL_MAX_CONNECTIONS = int(os.getenv('HTTP_POOL_MAX_CONNECTIONS', 20))
+HTTP_POOL_MAX_KEEPALIVE = int(os.getenv('HTTP_POOL_MAX_KEEPALIVE', 10))
+HTTP_KEEPALIVE_EXPIRY_SECONDS = float(os.getenv('HTTP_KEEPALIVE_EXPIRY_SECONDS', 60))
+HTTP_CONNECT_TIMEOUT_SECONDS = float(os.getenv('HTTP_CONNECT_TIMEOUT_SECONDS', 5))
+# how long a request may wait for a free pooled connection before failing
+HTTP_POOL_TIMEOUT_SECONDS = float(os.getenv('HTTP_POOL_TIMEOUT_SECONDS', 10))
+# overall budget for a single provider call - kept under the server's own request timeout so a slow call fails cleanly
+HTTP_TIMEOUT_SECONDS = float(os.getenv('HTTP_TIMEOUT_SECONDS', 120))
+# connections opened to each provider at startup, so the first requests don't pay for the TCP/TLS handshake (0 to disable)
+HTTP_PREWARM_CONNECTIONS = int(os.getenv('HTTP_PREWARM_CONNECTIONS', 0))
+
+# transient failures (and the provider's own Retry-After) are retried with jittered exponential backoff by ResilientTransport -
+# the sdks' own retries are turned off so they don't stack
+PROVIDER_MAX_RETRIES = int(os.getenv('PROVIDER_MAX_RETRIES', 2))
+RETRY_BASE_SECONDS = float(os.getenv('RETRY_BASE_SECONDS', 0.5))
+RETRY_MAX_BACKOFF_SECONDS = float(os.getenv('RETRY_MAX_BACKOFF_SECONDS', 8))
+# a longer Retry-After than this isn't waited for - the error is returned instead
+RETRY_MAX_RETRY_AFTER_SECONDS = float(os.getenv('RETRY_MAX_RETRY_AFTER_SECONDS', 60))
+RETRY_STATUSES = {408, 409, 429, 500, 502, 503, 504, 529}
+
+try:
+    import h2  # noqa: F401 - http/2 needs the optional 'h2' package (pip install httpx[http2])
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+HTTP2_ENABLED = HTTP2_AVAILABLE and os.getenv('HTTP2_ENABLED', 'true').lower() == 'true'
+
+class _TrackedStream(httpx.SyncByteStream):
+    # response body wrapper so a connection counts as in use until the (possibly streamed) body has been read and closed
+    def __init__(self, stream, on_close):
+        self._stream = stream
+        self._on_close = on_close
+
+    def __iter__(self):
+        yield from self._stream
+
+    def close(self):
+        try:
+            self._stream.close()
+        finally:
+            if self._on_close:
+                self._on_close()
+                self._on_close = None
+
+class _CancellableStream(httpx.SyncByteStream):
+    # response body wrapper that stops reading (closing the connection) once its call is cancelled - a cancelled call's
+    # streamed output then stops within a chunk rather than running on to the end
+    def __init__(self, stream, cancelled: threading.Event):
+        self._stream = stream
+        self._cancelled = cancelled
+
+    def __iter__(self):
+        for chunk in self._stream:
+            if self._cancelled.is_set():
+                self.close()
+                raise CallCancelled('the call was cancelled')
+            yield chunk
+
+    def close(self):
+        self._stream.close()
+
+class PooledTransport(httpx.HTTPTransport):
+    # http transport that records per-pool metrics: requests in flight, time spent waiting for a connection from the pool,
+    # and how many requests needed a new connection (a TCP/TLS handshake) rather than reusing a kept-alive one
+    def __init__(self, name: str, **kwargs):
+        super().__init__(**kwargs)
+        self.name = name
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "in_flight": 0, "max_in_flight": 0, "new_connections": 0, "errors": 0, "pool_wait_seconds": 0.0, "max_pool_wait_seconds": 0.0}
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        start = time.perf_counter()
+        first_event = []
+        previous_trace = request.extensions.get('trace')
+        def trace(event_name: str, info: Dict[str, Any]):
+            # the first connection/send event marks the point the pool handed this request a connection
+            if not first_event:
+                first_event.append(time.perf_counter())
+            if event_name == 'connection.connect_tcp.started':
+                with self._lock:
+                    self.stats['new_connections'] += 1
+            if previous_trace:
+                previous_trace(event_name, info)
+        request.extensions = {**request.extensions, 'trace': trace}
+
+        with self._lock:
+            self.stats['requests'] += 1
+            self.stats['in_flight'] += 1
+            self.stats['max_in_flight'] = max(self.stats['max_in_flight'], self.stats['in_flight'])
+        try:
+            response = super().handle_request(request)
+        except Exception:
+            self._finish()
+            with self._lock:
+                self.stats['errors'] += 1
+            raise
+        finally:
+            wait = (first_event[0] if first_event else time.perf_counter()) - start
+            with self._lock:
+                self.stats['pool_wait_seconds'] += wait
+                self.stats['max_pool_wait_seconds'] = max(self.stats['max_pool_wait_seconds'], wait)
+        response.stream = _TrackedStream(response.stream, self._finish)
+        return response
+
+    def _finish(self):
+        with self._lock:
+            self.stats['in_flight'] -= 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        # connection counts come straight from the underlying httpcore pool
+        connections = list(getattr(self._pool, 'connections', []))
+        with self._lock:
+            stats = dict(self.stats)
+        return {
+            "name": self.name,
+            "http2": HTTP2_ENABLED,
+            "max_connections": HTTP_POOL_MAX_CONNECTIONS,
+            "connections": len(connections),
+            "connections_in_use": sum(1 for connection in connections if not connection.is_idle() and not connection.is_closed()),
+            "connections_idle": sum(1 for connection in connections if connection.is_idle()),
+            **stats,
+            "pool_wait_seconds": round(stats['pool_wait_seconds'], 4),
+            "max_pool_wait_seconds": round(stats['max_pool_wait_seconds'], 4),
+            "mean_pool_wait_seconds": round(stats['pool_wait_seconds'] / stats['requests'], 4) if stats['requests'] else None,
+            "connection_reuse_ratio": round(1 - stats['new_connections'] / stats['requests'], 3) if stats['requests'] else None
+        }
+
+class DeadlineExceeded(httpx.TimeoutException):
+    pass
+
+def get_retry_after(response: httpx.Response) -> Optional[float]:
+    # openai sends retry-after-ms as well as the standard Retry-After (seconds or an http date)
+    if response.headers.get('retry-after-ms'):
+        try:
+            return float(response.headers['retry-after-ms']) / 1000
+        except ValueError:
+            pass
+    value = response.headers.get('retry-after')
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        try:
+            return parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+
+def get_backoff(attempt: int, retry_after: Optional[float] = None) -> float:
+    # full jitter exponential backoff, or the provider's Retry-After (plus a little jitter, so waiting requests spread out)
+    if retry_after is not None and retry_after >= 0:
+        return retry_after + random.uniform(0, min(1.0, retry_after * 0.1))
+    return random.uniform(0, min(RETRY_MAX_BACKOFF_SECONDS, RETRY_BASE_SECONDS * 2 ** attempt))
+
+class ResilientTransport(httpx.BaseTransport):
+    # wraps a provider's pooled transport - retries, circuit breaking and deadlines apply to every sdk call (including each poll
+    # of an assistant run), at the level of single http requests so nothing already streamed to the client is repeated
+    def __init__(self, provider: str, transport: httpx.BaseTransport, max_retries: int = PROVIDER_MAX_RETRIES):
+        self.provider = provider
+        self.transport = transport
+        self.max_retries = max_retries
+        self.breaker = get_circuit_breaker(provider)
+        self._lock = threading.Lock()
+        self.retries = 0
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        # the body is buffered so it can be sent again (the sdks build it in memory anyway)
+        request.read()
+        attempt = 0
+        while True:
+            check_cancelled()
+            self._apply_deadline(request)
+            self.breaker.before_request()
+            try:
+                response = self.transport.handle_request(request)
+            except (httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError) as e:
+                self.breaker.record_failure()
+                if not self._should_retry(attempt, get_backoff(attempt), type(e).__name__):
+                    raise
+                attempt += 1
+                continue
+            except httpx.TransportError:
+                # eg a proxy error - a failure to reach the provider, but not one worth retrying
+                self.breaker.record_failure()
+                raise
+            except BaseException:
+                # every call must settle the breaker, or a half open circuit would wait forever on this one as its trial
+                self.breaker.release_trial()
+                raise
+
+            if response.status_code >= 500:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+            should_retry = response.headers.get('x-should-retry')
+            if should_retry == 'false' or (response.status_code not in RETRY_STATUSES and should_retry != 'true'):
+                cancelled = get_cancel_event()
+                if cancelled is not None:
+                    response.stream = _CancellableStream(response.stream, cancelled)
+                return response
+            retry_after = get_retry_after(response)
+            if (retry_after is not None and retry_after > RETRY_MAX_RETRY_AFTER_SECONDS) or not self._should_retry(attempt, get_backoff(attempt, retry_after), str(response.status_code)):
+                return response
+            response.read()
+            response.close()
+            attempt += 1
+
+    def _should_retry(self, attempt: int, backoff: float, reason: str) -> bool:
+        # waits out the backoff if there's another attempt left and time for it within the deadline
+        remaining = get_remaining_seconds()
+        if attempt >= self.max_retries or (remaining is not None and backoff >= remaining):
+            return False
+        print(f'{self.provider} call failed ({reason}), retrying in {backoff:.1f}s')
+        metrics.increment('retries_total', provider=self.provider, reason=reason)
+        with self._lock:
+            self.retries += 1
+        time.sleep(backoff)
+        return True
+
+    def _apply_deadline(self, request: httpx.Request):
+        # each phase of the call (connect, pool, read, write) is capped at what is left of the request's deadline
+        remaining = get_remaining_seconds()
+        if remaining is None:
+            return
+        if remaining <= 0:
+            raise DeadlineExceeded(f'{self.provider} call not started, the request deadline has passed', request=request)
+        timeout = request.extensions.get('timeout') or {}
+        request.extensions = {**request.extensions, 'timeout': {phase: min(timeout.get(phase) or remaining, remaining) for phase in ('connect', 'read', 'write', 'pool')}}
+
+    def close(self):
+        self.transport.close()
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            retries = self.retries
+        return {**self.transport.get_stats(), "retries": retries, "circuit": self.breaker.get_stats()}
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_timeout(budget_seconds: Optional[float] = None) -> httpx.Timeout:
+    # timeouts for one provider call - connecting and waiting for a pooled connection are capped separately, and both fit
+    # within the call's overall budget (eg what is left of the request's own deadline)
+    budget = min(budget_seconds, HTTP_TIMEOUT_SECONDS) if budget_seconds else HTTP_TIMEOUT_SECONDS
+    return httpx.Timeout(budget, connect=min(HTTP_CONNECT_TIMEOUT_SECONDS, budget), pool=min(HTTP_POOL_TIMEOUT_SECONDS, budget))
+
+def get_http_client(provider: str) -> httpx.Client:
+    with _clients_lock:
+        if provider not in _clients:
+            transport = PooledTransport(
+                provider,
+                http2=HTTP2_ENABLED,
+                limits=httpx.Limits(
+                    max_connections=HTTP_POOL_MAX_CONNECTIONS,
+                    max_keepalive_connections=HTTP_POOL_MAX_KEEPALIVE,
+                    keepalive_expiry=HTTP_KEEPALIVE_EXPIRY_SECONDS
+                )
+            )
+            # retries, circuit breaking and request deadlines wrap the pool
+            _clients[provider] = httpx.Client(transport=ResilientTransport(provider, transport), timeout=get_timeout(), follow_redirects=True)
+        return _clients[provider]
+
+def prewarm(provider: str, base_url: str, connections: int = HTTP_PREWARM_CONNECTIONS):
+    # opens (and keeps alive) connections to the provider in the background - any response will do, it's only the handshake
+    # that matters, so this is a HEAD request with no credentials
+    if connections <= 0:
+        return
+    client = get_http_client(provider)
+    def connect():
+        try:
+            client.head(str(base_url), timeout=get_timeout(HTTP_CONNECT_TIMEOUT_SECONDS * 2))
+        except httpx.HTTPError as e:
+            print(f'{provider} connection prewarm failed:', e)
+    for _ in range(connections):
+        threading.Thread(target=connect, daemon=True).start()
+
+def get_transport_stats() -> list:
+    with _clients_lock:
+        clients = list(_clients.values())
+    return [client._transport.get_stats() for client in clients]
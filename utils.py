@@ -3,7 +3,31 @@
 from flask import Request
 from werkzeug.datastructures import FileStorage
 import os
+import re
+import time
+import hashlib
+import tempfile
+import threading
 from typing import Dict, Any
+from metrics import timed
+
+# uploads are streamed to UPLOAD_DIR under their content hash, so identical files are only stored once and never overwrite each other
+UPLOAD_DIR = os.getenv('UPLOAD_DIR', '/tmp/uploads')
+UPLOAD_MAX_BYTES = int(os.getenv('UPLOAD_MAX_BYTES', 20 * 1024 * 1024))
+# limit on a whole request body (eg a batch of many submissions), checked by flask before anything is read
+UPLOAD_MAX_REQUEST_BYTES = int(os.getenv('UPLOAD_MAX_REQUEST_BYTES', 200 * 1024 * 1024))
+UPLOAD_RETENTION_SECONDS = int(os.getenv('UPLOAD_RETENTION_SECONDS', 2 * 24 * 60 * 60))
+UPLOAD_GC_INTERVAL_SECONDS = 10 * 60
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+
+# allowed extensions and the leading bytes their contents must start with - only pdfs, the one file type every provider and
+# engine can read (text submissions are sent in the form field instead)
+UPLOAD_SIGNATURES = {
+    '.pdf': [b'%PDF-'],
+}
+
+_upload_gc_lock = threading.Lock()
+_last_upload_gc = 0
 
 def validate_input(request: Request, schema: Dict[str, Any]) -> Dict[str, Any]:
     validated_data = {}
@@ -23,8 +47,7 @@ def validate_input(request: Request, schema: Dict[str, Any]) -> Dict[str, Any]:
         file = request.files.get(field)
         if not file:
             raise ValueError(f"Missing required file: {field}")
-        new_filename = f"{field}-a{validated_data['assignment_id']}-q{validated_data['question_id']}{os.path.splitext(file.filename)[1]}"
-        validated_data[field] = save_file(file, new_filename)
+        validated_data[field] = save_upload(file, field)
 
     # check text or file fields
     for field in schema['text_or_file_fields']:
@@ -32,22 +55,119 @@ def validate_input(request: Request, schema: Dict[str, Any]) -> Dict[str, Any]:
         if not value:
             raise ValueError(f"Missing required field or file: {field}")
         if isinstance(value, FileStorage):
-            new_filename = f"{field}-a{validated_data['assignment_id']}-q{validated_data['question_id']}{os.path.splitext(value.filename)[1]}"
-            validated_data[field] = save_file(value, new_filename)
+            validated_data[field] = save_upload(value, field)
         else:
             validated_data[field] = value
 
     # convert types as needed
     validated_data['max_completion_tokens'] = int(validated_data['max_completion_tokens'])
     validated_data['temperature'] = float(validated_data['temperature'])
+    if validated_data.get('image_token_budget') is not None:
+        validated_data['image_token_budget'] = int(validated_data['image_token_budget'])
+        if validated_data['image_token_budget'] <= 0:
+            raise ValueError("image_token_budget must be a positive number of tokens")
 
     return validated_data
 
-def save_file(file: FileStorage, new_filename: str) -> str:
-    file_path = os.path.join('/tmp', new_filename)
-    file.save(file_path)
+def get_batch_submissions(request: Request, validated_data: Dict[str, Any], field: str = 'submissions', max_submissions: int = 200) -> Dict[str, str]:
+    # saves every file uploaded under 'field', keyed by student id - taken from the comma-separated 'student_ids' form field
+    # (one per file, in order) if given, otherwise from each file's name
+    files = [file for file in request.files.getlist(field) if file]
+    if not files:
+        raise ValueError(f"Missing required file: {field}")
+    if len(files) > max_submissions:
+        raise ValueError(f"Too many submissions: {len(files)} (maximum {max_submissions})")
+    student_ids = [student_id.strip() for student_id in request.form.get('student_ids', '').split(',') if student_id.strip()]
+    if student_ids and len(student_ids) != len(files):
+        raise ValueError(f"student_ids has {len(student_ids)} entries but {len(files)} submission files were uploaded")
+
+    submissions = {}
+    for i, file in enumerate(files):
+        student_id = student_ids[i] if student_ids else os.path.splitext(os.path.basename(file.filename or ''))[0] or f'student-{i + 1}'
+        if student_id in submissions:
+            student_id = f'{student_id}-{i + 1}'
+        submissions[student_id] = save_upload(file, f'{field} ({file.filename})')
+    return submissions
+
+@timed('upload')
+def save_upload(file: FileStorage, field: str) -> str:
+    # streams the upload to disk in chunks, hashing it as it goes, and stores it as UPLOAD_DIR/<sha256><ext> - the type is
+    # checked from the extension before anything is read and from the first chunk's contents, and the size as it is written
+    extension = os.path.splitext(file.filename or '')[1].lower()
+    if extension not in UPLOAD_SIGNATURES:
+        raise ValueError(f"Unsupported file type for {field}: '{extension}' (must be one of {list(UPLOAD_SIGNATURES)})")
+    if file.content_length and file.content_length > UPLOAD_MAX_BYTES:
+        raise ValueError(f"File too large for {field} (maximum {UPLOAD_MAX_BYTES} bytes)")
+
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    sha256 = hashlib.sha256()
+    size = 0
+    tmp_file = tempfile.NamedTemporaryFile(dir=UPLOAD_DIR, suffix='.tmp', delete=False)
+    try:
+        with tmp_file:
+            for chunk in iter(lambda: file.stream.read(UPLOAD_CHUNK_BYTES), b''):
+                if size == 0:
+                    _check_signature(chunk, extension, field)
+                size += len(chunk)
+                if size > UPLOAD_MAX_BYTES:
+                    raise ValueError(f"File too large for {field} (maximum {UPLOAD_MAX_BYTES} bytes)")
+                sha256.update(chunk)
+                tmp_file.write(chunk)
+        if size == 0:
+            raise ValueError(f"Empty file uploaded for {field}")
+        file_path = os.path.join(UPLOAD_DIR, sha256.hexdigest() + extension)
+        if os.path.exists(file_path):
+            # already uploaded - just mark it as recently used so it isn't garbage collected
+            os.utime(file_path)
+        else:
+            os.replace(tmp_file.name, file_path)
+    finally:
+        if os.path.exists(tmp_file.name):
+            os.remove(tmp_file.name)
+
+    collect_uploads()
     return file_path
 
+def _check_signature(chunk: bytes, extension: str, field: str):
+    if not any(chunk.startswith(signature) for signature in UPLOAD_SIGNATURES[extension]):
+        raise ValueError(f"File contents for {field} don't match its '{extension}' extension")
+
+def collect_uploads(force: bool = False) -> int:
+    # deletes uploads not used for UPLOAD_RETENTION_SECONDS (and any abandoned temp files) - runs at most every
+    # UPLOAD_GC_INTERVAL_SECONDS, from whichever request saves an upload
+    global _last_upload_gc
+    now = time.time()
+    with _upload_gc_lock:
+        if not force and now - _last_upload_gc < UPLOAD_GC_INTERVAL_SECONDS:
+            return 0
+        _last_upload_gc = now
+    removed = 0
+    for entry in os.scandir(UPLOAD_DIR):
+        try:
+            if entry.is_file() and now - entry.stat().st_mtime > UPLOAD_RETENTION_SECONDS:
+                os.remove(entry.path)
+                removed += 1
+        except OSError:
+            continue
+    if removed:
+        print('removed old uploads:', removed)
+    return removed
+
+def file_sha256(file_path: str) -> str:
+    # hash of the file contents (or of the string itself if it isn't a file) used to key caches/registries
+    sha256 = hashlib.sha256()
+    upload_hash = re.fullmatch(r'([0-9a-f]{64})\.\w+', os.path.basename(file_path)) if os.path.dirname(os.path.abspath(file_path)) == os.path.abspath(UPLOAD_DIR) else None
+    if upload_hash:
+        # uploads are already stored under their content hash, so there's no need to read them again
+        return upload_hash.group(1)
+    if not os.path.isfile(file_path):
+        sha256.update(file_path.encode('utf-8'))
+        return sha256.hexdigest()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
 # def save_file(file: FileStorage, new_filename: str) -> str:
 #     file_path = os.path.join('uploaded_files', new_filename)
 #     os.makedirs(os.path.dirname(file_path), exist_ok=True, mode=0o777)